@@ -1,4 +1,5 @@
-# this reads from .config and gets config info automatically
+# the configuration is read on first use, or call init to choose it
+from .config import init  # noqa
 from .interfaces.databroker.databases import databases  # noqa
 # cadb = databases['cms:analysis']
 # cddb = databases['cms:data']
@@ -1,11 +1,17 @@
 from distributed import Future
 from SciStreams.core.StreamDoc import StreamDoc
+from SciStreams.core.fingerprint import task_key
+from SciStreams.core.registry import futures_registry
+from SciStreams.callbacks.doctree import document_tree
 from SciStreams.config import client
-from SciStreams import config
 
 from functools import wraps
 
 
+def _name(obj):
+    return getattr(obj, '__name__', type(obj).__name__)
+
+
 class CallbackBase:
     def __call__(self, name, doc):
         "Dispatch to methods expecting particular doc types."
@@ -17,6 +23,9 @@ class CallbackBase:
     def bulk_events(self, doc):
         pass
 
+    def bundle(self, doc):
+        pass
+
     def descriptor(self, doc):
         pass
 
@@ -72,8 +81,8 @@ class SciStreamCallback(CallbackBase):
     '''
     # dictionary of start documents
     def __init__(self, func, *args, dbname='cms:data', remote=True,
-                 fill=False, remote_load=False,
-                 **kwargs):
+                 fill=False, remote_load=False, asynchronous=False,
+                 backpressure=None, documents=None, **kwargs):
         '''
             remote : bool, optional
                 decide whether or not to run on cluster
@@ -83,6 +92,18 @@ class SciStreamCallback(CallbackBase):
                 defaults to true (load on cluster)
             fill : bool, optional
                 decide whether or not to fill events
+            asynchronous : bool, optional
+                when not remote, wait for the documents on the event loop
+                instead of blocking (see core/asynchronous.py). The event
+                methods then return a Future, and must be called from the
+                loop (see run_in_loop)
+            backpressure : Backpressure, optional
+                the remote results are tracked (and capped) there.
+                Defaults to sink_backpressure (see core/backpressure.py)
+            documents : DocumentTree, optional
+                where the start and descriptor documents are kept until
+                the stop. Defaults to document_tree, shared by all the
+                callbacks (see callbacks/doctree.py)
         '''
         # args and kwargs reserved to forward to the functions
         # print("initiated with kwargs {}".format(kwargs))
@@ -93,8 +114,14 @@ class SciStreamCallback(CallbackBase):
         self.fill = fill
         self.remote = remote
         self.remote_load = remote_load
-        self.start_docs = dict()
-        self.descriptors = dict()
+        self.asynchronous = asynchronous
+        if backpressure is None:
+            from SciStreams.core.backpressure import sink_backpressure
+            backpressure = sink_backpressure
+        self.backpressure = backpressure
+        if documents is None:
+            documents = document_tree
+        self.documents = documents
         # right now init doesn't really do anything
         super(SciStreamCallback, self).__init__()
 
@@ -103,20 +130,20 @@ class SciStreamCallback(CallbackBase):
         # but still allows us to construct the tree
         # parent_uid, self_uid, doc
         _, start_uid, doc = doctuple
-        self.start_docs[start_uid] = (None, doc)
+        self.documents.add(None, start_uid, doc)
 
     def descriptor(self, doctuple):
         start_uid, descriptor_uid, doc = doctuple
         # start_uid = doc['run_start']
         # for symmetry, keep the _ and None etc.
-        if start_uid not in self.start_docs:
+        if start_uid not in self.documents:
             msg = "Missing start for descriptor"
             msg += "\nDescriptor uid : {}".format(descriptor_uid)
             msg += "\nStart uid: {}".format(start_uid)
             raise Exception(msg)
         # give pointer to start_uid
-        # dictionary[self_uid] = (parent_uid, doc)
-        self.descriptors[descriptor_uid] = (start_uid, doc)
+        # tree[self_uid] = (parent_uid, doc)
+        self.documents.add(start_uid, descriptor_uid, doc)
 
     def event(self, doctuple):
         dbname = self.dbname
@@ -124,14 +151,14 @@ class SciStreamCallback(CallbackBase):
         # parent_uid, self_uid, doc
         descriptor_uid, event_uid, doc = doctuple
         # descriptor_uid = doc['descriptor']
-        if descriptor_uid not in self.descriptors:
+        if descriptor_uid not in self.documents:
             msg = "Missing descriptor for event"
             msg += "\nEvent uid : {}".format(event_uid)
             msg += "\nDescriptor uid: {}".format(descriptor_uid)
             raise Exception(msg)
 
-        start_uid, descriptor = self.descriptors[descriptor_uid]
-        _, start = self.start_docs[start_uid]
+        start_uid, descriptor = self.documents[descriptor_uid]
+        _, start = self.documents[start_uid]
 
         kwargs = self.kwargs.copy()
         if self.remote:
@@ -144,15 +171,26 @@ class SciStreamCallback(CallbackBase):
             #print("doc : {}".format(doc))
             #res = client.submit(wraps(self.func)(eval_func), self.func, start,
             # TODO find out why I can't use "wraps" (scheduler complains about pickling)
+            # the event is identified by its uid, don't hash its data
+            key = task_key(eval_func, self.func, event_uid, self.args,
+                           fill=self.fill, remote_load=remote_load,
+                           dbname=dbname, **kwargs)
             res = client.submit(eval_func, self.func, start, descriptor, doc,
                                 *self.args, fill=self.fill,
                                 remote_load=remote_load, dbname=dbname,
-                                **kwargs)
+                                key=key, **kwargs)
             # the client may not submit remotely but return a value
             # (depending on the client setup)
             if isinstance(res, Future):
-                config.futures_cache_sinks.append(res)
-                config.futures_total.inc()
+                # kept until done
+                futures_registry.track(res, run=start_uid,
+                                       stage=_name(self.func),
+                                       sink=_name(self))
+                # blocks while too many results are computing
+                self.backpressure.track(res)
+        elif self.asynchronous:
+            return self._eval_async(eval_func, start, descriptor, doc,
+                                    **kwargs)
         else:
             # don't do things remotely, so block if things are Futures
             #print("not remote")
@@ -167,31 +205,71 @@ class SciStreamCallback(CallbackBase):
                       fill=self.fill, dbname=dbname, remote_load=remote_load,
                       **kwargs)
 
+    def bundle(self, doctuple):
+        ''' A start, descriptor, event and stop bundled into one document
+            (see to_event_stream). The function is run on the event in one
+            task and there is nothing to keep track of.'''
+        _, start_uid, documents = doctuple
+        kwargs = self.kwargs.copy()
+        if self.remote:
+            key = task_key(eval_bundle, self.func, start_uid, self.args,
+                           fill=self.fill, remote_load=self.remote_load,
+                           dbname=self.dbname, **kwargs)
+            res = client.submit(eval_bundle, self.func, documents,
+                                *self.args, fill=self.fill,
+                                remote_load=self.remote_load,
+                                dbname=self.dbname, key=key, **kwargs)
+            if isinstance(res, Future):
+                futures_registry.track(res, run=start_uid,
+                                       stage=_name(self.func),
+                                       sink=_name(self))
+                # blocks while too many results are computing
+                self.backpressure.track(res)
+        elif self.asynchronous:
+            return self._eval_async(eval_bundle, documents, **kwargs)
+        else:
+            if isinstance(documents, Future):
+                documents = documents.result()
+            eval_bundle(self.func, documents, *self.args, fill=self.fill,
+                        dbname=self.dbname, remote_load=self.remote_load,
+                        **kwargs)
+
+    def _eval_async(self, evaluator, *docs, **kwargs):
+        ''' Run evaluator (eval_func or eval_bundle) once the documents are
+            computed, without blocking.'''
+        from SciStreams.core.asynchronous import resolve, wait_all
+        from tornado import gen
+
+        @gen.coroutine
+        def run():
+            computed = yield [resolve(doc) for doc in docs]
+            result = evaluator(self.func, *computed, *self.args,
+                               fill=self.fill, dbname=self.dbname,
+                               remote_load=self.remote_load, **kwargs)
+            # the function is usually a stream emit
+            yield wait_all(result)
+            return result
+        return run()
+
     def stop(self, doctuple):
         ''' Stop is where the garbage collection happens.'''
         start_uid, stop_uid, doc = doctuple
         # cleanup the start with start_uid
         self.cleanup_start(start_uid)
+        # and the results held for the run
+        futures_registry.release_run(start_uid)
 
     def cleanup_start(self, start_uid):
-        if start_uid not in self.start_docs:
+        # the run (start and descriptors) is removed once all the callbacks
+        # sharing the tree are done with it
+        if not self.documents.release(start_uid):
             msg = "Warning missing start for stop, skipping"
             print(msg)
             return
             # raise Exception(msg)
-        self.start_docs.pop(start_uid)
-        desc_uids = list()
-        for desc_uid, doctuple in self.descriptors.items():
-            desc_start_uid, desc = doctuple
-            if desc_start_uid == start_uid:
-                desc_uids.append(desc_uid)
-
-        for desc_uid in desc_uids:
-            self.cleanup_descriptor(desc_uid)
 
     def cleanup_descriptor(self, desc_uid):
-        if desc_uid in self.descriptors:
-            self.descriptors.pop(desc_uid)
+        self.documents.remove(desc_uid)
 
 from SciStreams.interfaces.databroker.databases import databases
 def fill_events(doc, dbname=None):
@@ -251,6 +329,9 @@ def export_streamdoc(start, descriptor, event, fill=True,
     data = event['data']
     # now make data
     sdoc = StreamDoc()
+    # the data of the StreamDoc is identified by the event uid
+    if 'uid' in event:
+        sdoc['uid'] = event['uid']
     sdoc.add(attributes=start)
     # allow seq_num to be passed
     if 'seq_num' in event and 'seq_num' not in sdoc['attributes']:
@@ -281,3 +362,9 @@ def eval_func(func, start, descriptor, event, *args, dbname=None,
     # print("calling function {} with extra args : {}".format(func, args))
     # print("extra kwargs : {}".format(kwargs))
     return func(sdoc, *args, **kwargs)
+
+
+def eval_bundle(func, documents, *args, **kwargs):
+    ''' eval_func on a bundle of documents (see to_event_stream).'''
+    return eval_func(func, documents['start'], documents['descriptor'],
+                     documents['event'], *args, **kwargs)
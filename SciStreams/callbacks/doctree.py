@@ -0,0 +1,105 @@
+'''
+    The tree of the documents of the runs in flight.
+
+    A start document is the root of a run, its descriptors are its children
+    and the descriptors are the parents of the events. ``DocumentTree``
+    keeps each document with its parent, and the children of each
+    document, so that a run is removed in time proportional to its size
+    instead of scanning every document.
+
+    The tree can be shared: every callback that gets the start of a run
+    holds it, and the run is only removed once all of them have released
+    it (on its stop). The SciStreamCallbacks share ``document_tree`` by
+    default.
+
+    Examples
+    --------
+    >>> tree = DocumentTree()
+    >>> tree.add(None, start_uid, start)
+    >>> tree.add(start_uid, descriptor_uid, descriptor)
+    >>> start_uid, descriptor = tree[descriptor_uid]
+    >>> tree.release(start_uid)
+'''
+from collections import defaultdict
+import threading
+
+
+class DocumentTree:
+    ''' Documents by uid, with their parent and children.'''
+    def __init__(self):
+        # uid : (parent_uid, doc)
+        self._docs = dict()
+        self._children = defaultdict(set)
+        # the number of holders of each root (start)
+        self._holders = defaultdict(int)
+        self._lock = threading.RLock()
+
+    def add(self, parent_uid, uid, doc):
+        ''' Add doc under parent_uid (None for a start).
+
+            Adding a start again (from another callback) holds it once
+            more, see release.
+        '''
+        with self._lock:
+            if parent_uid is None:
+                self._holders[uid] += 1
+            else:
+                self._children[parent_uid].add(uid)
+            self._docs[uid] = parent_uid, doc
+
+    def __getitem__(self, uid):
+        ''' The (parent_uid, doc) of uid.'''
+        return self._docs[uid]
+
+    def __contains__(self, uid):
+        return uid in self._docs
+
+    def __len__(self):
+        return len(self._docs)
+
+    def children(self, uid):
+        return set(self._children.get(uid, ()))
+
+    def release(self, uid):
+        ''' Release a hold on the start uid, removing its run once no one
+            holds it.
+
+            Returns False if uid isn't held.
+        '''
+        with self._lock:
+            if self._holders.get(uid, 0) == 0:
+                return False
+            self._holders[uid] -= 1
+            if self._holders[uid] == 0:
+                del self._holders[uid]
+                self.remove(uid)
+            return True
+
+    def remove(self, uid):
+        ''' Remove uid and everything under it.'''
+        with self._lock:
+            parent_uid, doc = self._docs.pop(uid, (None, None))
+            if parent_uid is not None:
+                siblings = self._children.get(parent_uid)
+                if siblings is not None:
+                    siblings.discard(uid)
+            self._remove_children(uid)
+
+    def _remove_children(self, uid):
+        for child_uid in self._children.pop(uid, ()):
+            self._docs.pop(child_uid, None)
+            self._remove_children(child_uid)
+
+    def clear(self):
+        with self._lock:
+            self._docs.clear()
+            self._children.clear()
+            self._holders.clear()
+
+    def __repr__(self):
+        return "DocumentTree({} documents, {} runs)".format(
+            len(self._docs), len(self._holders))
+
+
+# the tree the SciStreamCallbacks share
+document_tree = DocumentTree()
@@ -1,38 +1,11 @@
 # these read the configuration file and setup extra configuration of parameters
-import yaml
+# Nothing is read (and no client is connected) on import. The configuration
+# is loaded the first time one of its settings is used, or explicitly with
+# SciStreams.init (see init below).
 import os
 import os.path
-import numpy as np
 import numbers
-
-# these are static things to the library
-from dask import set_options
-from collections import deque
-
-
-# First step is to read yaml file from user directory
-cwd = os.getcwd()
-filename = cwd + "/scistreams.yml"
-try:
-    f = open(filename)
-    config = yaml.load(f)
-except FileNotFoundError:
-    print("Warning, scistreams.yml in current working directory not found")
-    print("Not loading any configuration.")
-    config = dict()
-
-
-cwd = os.getcwd()
-filename_masks = cwd + "/masks.yml"
-try:
-    fmask = open(filename_masks)
-    masks_config = yaml.load(fmask)
-except FileNotFoundError:
-    print("Warning, could not find {}".format(filename_masks))
-    print("Will proceed without any masks")
-    masks_config = {}
-
-
+import threading
 
 detector_names = dict(pilatus300='saxs', psccd='waxs', pilatus2M='saxs')
 
@@ -47,24 +20,231 @@ _DEFAULTS = {
     'required_attributes': dict(main=dict()),
     'default_timeout': None,
     'resultsroot': os.path.expanduser("/GPFS/pipeline"),
-    'delayed': True,
     'server': None,
+    # without a server, run the tasks on a local pool of 'threads' or
+    # 'processes' (see core/local_client.py) with local_workers workers
+    # (defaults to the number of cores). None runs them inline
+    'local_executor': None,
+    'local_workers': None,
+    # the results held for reuse (see core/registry.py) are released after
+    # this many seconds, or when more than max_held_futures are held
+    'futures_ttl': 3600,
+    'max_held_futures': 1000,
+    # the file the ingest cursor (the last run sent to the pipeline) is
+    # saved to, to resume from (see interfaces/databroker/cursor.py)
+    'ingest_cursor': 'ingest_cursor.json',
+    # a YAML file of the pipeline to run (see core/pipeline.py). None runs
+    # the default one of startup/run_stream.py
+    'pipeline': None,
+    # run each remote StreamDoc stage as a single task
+    'fused': False,
+    # record per stage counters and timings (see core/instrumentation.py)
+    'instrumentation': False,
+    # run local (remote=False) stages on an event loop, see
+    # core/asynchronous.py, with this many threads
+    'asynchronous': False,
+    'async_workers': 4,
+    # bytes per namespace of the cache of derived arrays (masks, binnings,
+    # calibrations), see core/cache.py. Either a number or a dict of
+    # namespace : bytes, with 'default' for the others
+    'cache_bytes': 500e6,
+    # the precision of the calibration maps (q_map, r_map...), 'float32'
+    # halves their memory
+    'calibration_dtype': 'float64',
+    # a directory the calibration maps are also kept in (as .npy files), so
+    # that they're reused across restarts. None keeps them in memory only
+    'calibration_cache_dir': None,
+    # slice the maps that the beam center only translates from a master map,
+    # for the beam centers up to this many pixels off the image (see
+    # data/Calibration.py). None computes the maps of each beam center
+    'calibration_master_margin': None,
+    # the threads the calibration maps are computed on (in blocks)
+    'calibration_threads': 1,
     'databases': default_databases,
     # tensorflow storage stuff
     'TFLAGS': {'out_dir': '/GPFS/pipeline/ml-tmp',
                'num_batches': 16}
 }
 
-default_timeout = config.get('default_timeout', _DEFAULTS['default_timeout'])
-delayed = config.get('delayed', _DEFAULTS['delayed'])
-resultsroot = config.get('resultsroot', _DEFAULTS['resultsroot'])
-required_attributes = config.get('required_attributes',
-                                 _DEFAULTS['required_attributes'])
-debug = config.get('debug', _DEFAULTS['debug'])
 
-# TODO : need way of dynamically doing this
-modules = config.get('modules', {})
-tensorflow = modules.get('tensorflow', {})
+# the settings read from the configuration files, loaded on first access
+_LAZY_SETTINGS = ['config', 'masks_config', 'default_timeout', 'delayed',
+                  'resultsroot', 'resultsrootmap', 'required_attributes',
+                  'debug', 'fused', 'asynchronous', 'async_workers',
+                  'cache_bytes', 'calibration_dtype', 'calibration_cache_dir',
+                  'calibration_master_margin', 'calibration_threads',
+                  'modules', 'tensorflow', 'TFLAGS', 'server',
+                  'local_executor', 'local_workers', 'futures_ttl',
+                  'max_held_futures', 'ingest_cursor', 'pipeline',
+                  'databases']
+
+_lock = threading.RLock()
+_initialized = False
+_client = None
+
+
+def init(config_path=None, masks_path=None, client=None):
+    ''' Load the configuration and set the client.
+
+        This is done automatically (with the defaults) the first time a
+        setting or the client is used. Call it explicitly to choose the
+        files or the client.
+
+        Parameters
+        ----------
+        config_path : str, optional
+            the configuration file. Defaults to scistreams.yml in the current
+            working directory
+
+        masks_path : str, optional
+            the masks configuration file. Defaults to masks.yml in the
+            current working directory
+
+        client : optional
+            the client to submit to (a distributed Client for example). By
+            default, a client is connected to the configured server the
+            first time it's used (or everything runs locally if there is
+            none)
+    '''
+    global _initialized, _client
+    import yaml
+
+    cwd = os.getcwd()
+    if config_path is None:
+        config_path = cwd + "/scistreams.yml"
+    if masks_path is None:
+        masks_path = cwd + "/masks.yml"
+
+    with _lock:
+        # First step is to read yaml file from user directory
+        try:
+            f = open(config_path)
+            config = yaml.load(f)
+        except FileNotFoundError:
+            print("Warning, {} not found".format(config_path))
+            print("Not loading any configuration.")
+            config = dict()
+
+        try:
+            fmask = open(masks_path)
+            masks_config = yaml.load(fmask)
+        except FileNotFoundError:
+            print("Warning, could not find {}".format(masks_path))
+            print("Will proceed without any masks")
+            masks_config = {}
+
+        settings = _settings_from(config)
+        settings['config'] = config
+        settings['masks_config'] = masks_config
+        globals().update(settings)
+
+        _client = client
+        _initialized = True
+
+        _register_cache()
+        if config.get('instrumentation', _DEFAULTS['instrumentation']):
+            from .core.instrumentation import instrument
+            instrument.enable()
+
+
+def _settings_from(config):
+    ''' The settings derived from the configuration dict.'''
+    settings = dict()
+    settings['default_timeout'] = config.get('default_timeout',
+                                             _DEFAULTS['default_timeout'])
+    resultsroot = config.get('resultsroot', _DEFAULTS['resultsroot'])
+    settings['required_attributes'] = \
+        config.get('required_attributes', _DEFAULTS['required_attributes'])
+    settings['debug'] = config.get('debug', _DEFAULTS['debug'])
+    settings['fused'] = config.get('fused', _DEFAULTS['fused'])
+    settings['asynchronous'] = config.get('asynchronous',
+                                          _DEFAULTS['asynchronous'])
+    settings['async_workers'] = config.get('async_workers',
+                                           _DEFAULTS['async_workers'])
+    cache_bytes = config.get('cache_bytes', _DEFAULTS['cache_bytes'])
+    if isinstance(cache_bytes, dict):
+        cache_bytes = dict(cache_bytes)
+        cache_bytes.setdefault('default', _DEFAULTS['cache_bytes'])
+    settings['cache_bytes'] = cache_bytes
+    settings['calibration_dtype'] = config.get('calibration_dtype',
+                                               _DEFAULTS['calibration_dtype'])
+    settings['calibration_cache_dir'] = \
+        config.get('calibration_cache_dir', _DEFAULTS['calibration_cache_dir'])
+    settings['calibration_master_margin'] = \
+        config.get('calibration_master_margin',
+                   _DEFAULTS['calibration_master_margin'])
+    settings['calibration_threads'] = \
+        config.get('calibration_threads', _DEFAULTS['calibration_threads'])
+
+    # TODO : need way of dynamically doing this
+    modules = config.get('modules', {})
+    settings['modules'] = modules
+    settings['tensorflow'] = modules.get('tensorflow', {})
+
+    TFLAGS_tmp = dict()
+    TFLAGS_tmpin = config.get("TFLAGS", _DEFAULTS['TFLAGS'])
+    for key in _DEFAULTS['TFLAGS']:
+        TFLAGS_tmp[key] = TFLAGS_tmpin.get(key, _DEFAULTS['TFLAGS'][key])
+
+    class TFLAGS:
+        pass
+
+    for key, val in TFLAGS_tmp.items():
+        setattr(TFLAGS, key, val)
+    settings['TFLAGS'] = TFLAGS
+
+    if isinstance(resultsroot, list):
+        settings['resultsrootmap'] = resultsroot
+        settings['resultsroot'] = None
+    else:
+        settings['resultsrootmap'] = None
+        settings['resultsroot'] = resultsroot
+
+    settings['server'] = config.get('server', _DEFAULTS['server'])
+    settings['local_executor'] = config.get('local_executor',
+                                            _DEFAULTS['local_executor'])
+    settings['local_workers'] = config.get('local_workers',
+                                           _DEFAULTS['local_workers'])
+    settings['futures_ttl'] = config.get('futures_ttl',
+                                         _DEFAULTS['futures_ttl'])
+    settings['max_held_futures'] = config.get('max_held_futures',
+                                              _DEFAULTS['max_held_futures'])
+    settings['ingest_cursor'] = config.get('ingest_cursor',
+                                           _DEFAULTS['ingest_cursor'])
+    settings['pipeline'] = config.get('pipeline', _DEFAULTS['pipeline'])
+    settings['databases'] = config.get('databases', _DEFAULTS['databases'])
+
+    if config.get('delayed', _DEFAULTS['delayed']):
+        from dask import delayed
+    else:
+        def delayed(pure=None, pure_default=None):
+            def dec(f):
+                def fnew(*args, **kwargs):
+                    return f(*args, **kwargs)
+                return fnew
+            return dec
+    settings['delayed'] = delayed
+    return settings
+
+
+def _ensure_init():
+    with _lock:
+        if not _initialized:
+            init()
+
+
+def _setting(name):
+    ''' The setting name, read from the configuration files on first use.'''
+    _ensure_init()
+    return globals()[name]
+
+
+def __getattr__(name):
+    # the settings are only read when first asked for
+    if name in _LAZY_SETTINGS:
+        return _setting(name)
+    raise AttributeError("module {} has no attribute {}".format(__name__,
+                                                                 name))
 
 
 # TODO : formalize this with some global existing python structure?
@@ -87,7 +267,7 @@ def validate_md(md, name="main", validate_dict=None):
     '''
     # first check kwarg, then define if not
     if validate_dict is None:
-        validate_dict = required_attributes.get(name, {})
+        validate_dict = _setting('required_attributes').get(name, {})
     for key, val in validate_dict.items():
         if key not in md:
             errormsg = "Error, key {} not in metadata".format(key)
@@ -109,96 +289,89 @@ def validate_md(md, name="main", validate_dict=None):
     return True
 
 
-TFLAGS_tmp = dict()
-TFLAGS_tmpin = config.get("TFLAGS", _DEFAULTS['TFLAGS'])
-for key in _DEFAULTS['TFLAGS']:
-    TFLAGS_tmp[key] = TFLAGS_tmpin.get(key, _DEFAULTS['TFLAGS'][key])
+# client information
+# TODO : remove this client information
+
+#MAX_FUTURE_NUM = 1000
+
+class LocalClient:
+    ''' No client, compute should compute and return nothing.'''
+    # make unbound method
 
+    # key and pure are for the scheduler, don't pass them to f
+    def submit(self, f, *args, key=None, pure=None, **kwargs):
+        return f(*args, **kwargs)
 
-class TFLAGS:
-    pass
+    def gather(self, future):
+        # it's not a future, just a regular result
+        return future
 
 
-for key, val in TFLAGS_tmp.items():
-    setattr(TFLAGS, key, val)
+def _connect(server, local_executor=None, local_workers=None):
+    if server is not None:
+        try:
+            print("Adding a client: {}".format(server))
+            from distributed import Client
+            return Client(server)
+        except ValueError:
+            print("Tried to start server but failed.")
+            print("Tried to connect to {}".format(server))
+            print("Please remove this line in the yml file if no")
+            print(" server connection is desired.")
+    elif local_executor is not None:
+        from .core.local_client import PoolClient
+        client = PoolClient(local_executor, local_workers)
+        print("No server, running locally on {}".format(client))
+        return client
+    # no client, compute should compute and return nothing
+    else:
+        print("No client supported, running locally")
+    return LocalClient()
 
-if isinstance(resultsroot, list):
-    resultsrootmap = resultsroot
-    resultsroot = None
-else:
-    resultsrootmap = None
 
+def get_client():
+    ''' The client, connected (see init) on first use.'''
+    global _client
+    with _lock:
+        if _client is None:
+            _ensure_init()
+        if _client is None:
+            _client = _connect(_setting('server'),
+                               _setting('local_executor'),
+                               _setting('local_workers'))
+    return _client
 
-server = config.get('server', _DEFAULTS['server'])
-databases = config.get('databases', _DEFAULTS['databases'])
 
+class _ClientProxy:
+    ''' Stands in for the client, so that it can be imported before it's
+        connected.'''
+    def __getattr__(self, name):
+        return getattr(get_client(), name)
 
-if delayed:
-    from dask import delayed
-else:
-    def delayed(pure=None, pure_default=None):
-        def dec(f):
-            def fnew(*args, **kwargs):
-                return f(*args, **kwargs)
-            return fnew
-        return dec
+    def __repr__(self):
+        return "ClientProxy({})".format(_client)
 
 
-# client information
-# TODO : remove this client information
+client = _ClientProxy()
 
-#MAX_FUTURE_NUM = 1000
+# the remote results are kept in core/registry.py (futures_registry)
+
+
+_cache_registered = False
+
+
+def _register_cache():
+    global _cache_registered
+    if _cache_registered:
+        return
+    _cache_registered = True
+    # the derived arrays are cached by core/cache.py, sized in bytes per
+    # namespace (see cache_bytes)
+
+    # make everything pure by default
+    from dask import set_options
+    set_options(delayed_pure=True)
 
-if server is not None:
-    try:
-        print("Adding a client: {}".format(server))
-        from distributed import Client
-        client = Client(server)
-    except ValueError:
-        print("Tried to start server but failed.")
-        print("Tried to connect to {}".format(server))
-        print("Please remove this line in the yml file if no")
-        print(" server connection is desired.")
-# no client, compute should compute and return nothing
-else:
-    print("No client supported, running locally")
-
-    class Client:
-        # make unbound method
-
-        def submit(self, f, *args, **kwargs):
-            return f(*args, **kwargs)
-
-        def gather(self, future):
-            # it's not a future, just a regular result
-            return future
-
-    client = Client()
-
-#futures_total = 0
-class _COUNTER:
-    COUNT=0
-    def inc(self, *args, **kwargs):
-        self.COUNT+=1
-    def __call__(self):
-        return self.COUNT
-
-futures_total = _COUNTER()
-futures_cache = deque()#maxlen=MAX_FUTURE_NUM)
-# allow for 100,000 sinks for these (so we don't lose them)
-futures_cache_sinks = deque()#maxlen=100000)
-
-# assume all functions are pure globally
-try:
-    from dask.cache import Cache
-    cache = Cache(1e6)
-    cache.register()
-except ImportError:
-    print("Error cachey not available. Will not be caching")
-    pass
-
-# make everything pure by default
-set_options(delayed_pure=True)
 
 # TAU STUFF Profiler dictionaries
 profile_dict = dict()
@@ -3,6 +3,7 @@
     layer should reside. Conversions from other interfaces to StreamDoc are
     found in corresponding interface folders.
 '''
+from collections import namedtuple
 from functools import wraps, partial
 import time
 import sys
@@ -22,7 +23,7 @@ import numpy as np
 # from ..config import default_timeout as DEFAULT_TIMEOUT
 from SciStreams import config
 
-from ..config import debug, modules, client
+from ..config import client
 
 # tau stuff, ignore if not here
 #run_tau = modules.get('tau', {}).get('run', False)
@@ -33,6 +34,10 @@ from ..config import debug, modules, client
     #print("not runing tau")
 
 from ..config import profile_dict
+from .instrumentation import instrument
+from .fingerprint import fingerprint, task_key, tokenize_cheap
+from .batch import batch_kwargs, is_batch_stage, squash_payloads, \
+    unsquash_payload, event_attributes
 
 # TODO : Make sure each element is Future aware
 
@@ -110,63 +115,99 @@ def merge(sdocs):
     return sdocs[0].merge(*(sdocs[1:]))
 
 
-# TODO :  need to fix this
 def squash(sdocs):
-    ''' Squash results together.
-
+    ''' Squash a sequence of StreamDocs into one batch StreamDoc.
 
         For ex, a list of sdocs with a 2D np array
             will lead to one sdoc with a 3D np array
         etc.
+
+        Arrays are stacked into one preallocated array (keeping their dtype),
+        anything else into a list (see ``SciStreams.core.batch.stack``). The
+        stacking is one task if any of the data is remote.
+
+        The result stays a batch through the stages that accept batches (see
+        ``SciStreams.core.batch.accepts_batches``) and can be split back into
+        one StreamDoc per event with ``unsquash``.
     '''
+    sdocs = list(sdocs)
+    if len(sdocs) == 0:
+        raise ValueError("Error, no StreamDocs to squash")
     newsdoc = StreamDoc()
     for sdoc in sdocs:
         newsdoc.add(attributes=sdoc['attributes'])
-    N = len(sdocs)
-    cnt = 0
-    newargs = []
-    newkwargs = dict()
-    for sdoc in sdocs:
-        args, kwargs = sdoc['args'], sdoc['kwargs']
-        for i, arg in enumerate(args):
-            if cnt == 0:
-                if isinstance(arg, np.ndarray):
-                    newshape = []
-                    newshape.append(N)
-                    newshape.extend(arg.shape)
-                    newargs.append(np.zeros(newshape))
-                else:
-                    newargs.append([])
-            if isinstance(arg, np.ndarray):
-                newargs[i][cnt] = arg
-            else:
-                newargs[i].append[arg]
-
-        for key, val in kwargs.items():
-            if cnt == 0:
-                if isinstance(val, np.ndarray):
-                    newshape = []
-                    newshape.append(N)
-                    newshape.extend(val.shape)
-                    newkwargs[key] = np.zeros(newshape)
-                else:
-                    newkwargs[key] = []
-            if isinstance(val, np.ndarray):
-                newkwargs[key][cnt] = val
-            else:
-                newkwargs[key].append[val]
 
-        cnt = cnt + 1
+    payloads = [sdoc.payload for sdoc in sdocs]
+    if any(_payload_is_remote(payload) for payload in payloads):
+        res = client.submit(squash_payloads, *payloads,
+                            key=task_key(squash_payloads, *payloads))
+    else:
+        res = squash_payloads(*payloads)
+    newsdoc.set_payload(res)
+
+    base = newsdoc['attributes']
+    if not isinstance(base, Future):
+        base = dict(base)
+    newsdoc['_batch'] = dict(size=len(sdocs),
+                             attributes=[sdoc['attributes'] for sdoc in sdocs],
+                             base=base)
+    return newsdoc
+
 
-    newsdoc.add(args=newargs, kwargs=newkwargs)
+def unsquash(sdoc):
+    ''' Split a batch StreamDoc (see ``squash``) into a list of StreamDocs,
+        one per event.
 
-    return newsdoc
+        Arrays are split into views. The attributes are those of each event,
+        updated with whatever the stages on the batch changed.
+    '''
+    batch = sdoc['_batch']
+    if batch is None:
+        raise ValueError("Error, not a batch StreamDoc (see squash)")
+    payload = sdoc.payload
+    remote = _payload_is_remote(payload)
+    attributes = sdoc['attributes']
+    attributes_remote = isinstance(attributes, Future) or \
+        isinstance(batch['base'], Future)
+
+    sdocs = list()
+    for i in range(batch['size']):
+        event_attrs = batch['attributes'][i]
+        if attributes_remote or isinstance(event_attrs, Future):
+            key = task_key(event_attributes, batch['base'], attributes,
+                           event_attrs)
+            event_attrs = client.submit(event_attributes, batch['base'],
+                                        attributes, event_attrs, key=key)
+        else:
+            event_attrs = event_attributes(batch['base'], attributes,
+                                           event_attrs)
+        if remote:
+            res = client.submit(unsquash_payload, payload, i,
+                                key=task_key(unsquash_payload, payload, i))
+        else:
+            res = unsquash_payload(payload, i)
+        newsdoc = StreamDoc(attributes=event_attrs,
+                            sdoc_type=sdoc['_StreamDoc_Type'])
+        newsdoc.add(statistics=sdoc['statistics'])
+        newsdoc.set_payload(res)
+        sdocs.append(newsdoc)
+    return sdocs
 
 
-def to_event_stream(sdoc, tolist=False, remote=True):
+def _payload_is_remote(payload):
+    ''' True if an (args, kwargs) payload is (or has) a Future.'''
+    return isinstance(payload, Future) or \
+        any(isinstance(elem, Future) for elem in payload)
+
+
+def to_event_stream(sdoc, tolist=False, remote=True, bundle=False):
     ''' Convert stream documents to an event stream.
+
+        bundle : bool, optional
+            give one "bundle" document instead of the start, descriptor,
+            event and stop (see _to_event_stream)
     '''
-    event_stream = _to_event_stream(sdoc)
+    event_stream = _to_event_stream(sdoc, bundle=bundle)
     if tolist:
         event_stream = list(event_stream)
     return event_stream
@@ -284,13 +325,20 @@ def init_stop(stop_uid, start_uid):
     return stop
 
 
-def _to_event_stream(sdoc):
+def _to_event_stream(sdoc, bundle=False):
     ''' Convert a streamdoc to event stream.
 
         Gives event_stream as generator
 
         Generates just one event with all data contained.
 
+        If bundle is True, the four documents are given as one "bundle"
+        document instead : ("bundle", (None, start_uid, documents)), where
+        documents is a dict (or a Future of one) of the start, descriptor,
+        event and stop documents keyed by name. Otherwise, remote documents
+        are gathered here (once, rather than with a task per document), for
+        the callbacks that need them (e.g. the live plots).
+
         NOTE : Does not work with args (only considers kwargs)
             #(will just print a warning and try to add them)
             It will just ignore them now. Could add in future if needed,
@@ -309,12 +357,14 @@ def _to_event_stream(sdoc):
     #       newsdoc['kwargs'][argkey] = arg
     #   sdoc = newsdoc
     attributes = sdoc.attributes
-    kwargs = sdoc.kwargs
+    # the kwargs are taken from the payload on the cluster, so that a packed
+    # StreamDoc doesn't need to be unpacked here
+    payload, projection = sdoc._lazy_payload()
     sdoc_type = sdoc["_StreamDoc_Type"]
     # it's remote if either is a Future
     # NOTE: could have non remote attributes and remote kwargs, and thus local
     # start. But let's just make all events remote if they are
-    isremote = isinstance(kwargs, Future) or isinstance(attributes, Future)\
+    isremote = _payload_is_remote(payload) or isinstance(attributes, Future)\
         or isinstance(sdoc_type, Future)
 
     # create the uids in advance
@@ -323,31 +373,26 @@ def _to_event_stream(sdoc):
     event_uid = str(uuid4())
     stop_uid = str(uuid4())
 
+    # all four documents are made in one task
     if isremote:
-        start = client.submit(init_start, start_uid)
-        start = client.submit(update_start, start, attributes)
+        # the uids are new, so they are enough to key the task
+        documents = client.submit(_make_documents, start_uid, descriptor_uid,
+                                  event_uid, stop_uid, attributes, payload,
+                                  projection=projection,
+                                  key=task_key(_make_documents, start_uid))
     else:
-        start = init_start(start_uid)
-        start = update_start(start, attributes)
+        documents = _make_documents(start_uid, descriptor_uid, event_uid,
+                                    stop_uid, attributes, payload,
+                                    projection=projection)
 
-    if isremote:
-        descriptor = client.submit(init_descriptor, descriptor_uid, start_uid)
-        descriptor = client.submit(update_descriptor, descriptor, kwargs)
-    else:
-        descriptor = init_descriptor(descriptor_uid, start_uid)
-        descriptor = update_descriptor(descriptor, kwargs)
+    if bundle:
+        yield "bundle", (None, start_uid, documents)
+        return
 
     if isremote:
-        event = client.submit(init_event, event_uid, start, descriptor_uid)
-        event = client.submit(update_event, event, kwargs)
-    else:
-        event = init_event(event_uid, start, descriptor_uid)
-        event = update_event(event, kwargs)
-
-    if isremote:
-        stop = client.submit(init_stop, stop_uid, start_uid)
-    else:
-        stop = init_stop(stop_uid, start_uid)
+        documents = documents.result()
+    start, descriptor, event, stop = \
+        [documents[name] for name in ('start', 'descriptor', 'event', 'stop')]
 
     # for symmetry, put None for parent
     yield "start", (None, start_uid, start)
@@ -357,7 +402,72 @@ def _to_event_stream(sdoc):
     yield "stop", (start_uid, stop_uid, stop)
 
 
-class StreamDoc(dict):
+def _make_documents(start_uid, descriptor_uid, event_uid, stop_uid,
+                    attributes, payload, projection=None):
+    ''' Make the start, descriptor, event and stop documents.
+
+        Returns a dict of the documents keyed by name.
+    '''
+    kwargs = _project_payload(payload, projection)[1]
+    start = update_start(init_start(start_uid), attributes)
+    descriptor = update_descriptor(init_descriptor(descriptor_uid, start_uid),
+                                   kwargs)
+    event = update_event(init_event(event_uid, start, descriptor_uid), kwargs)
+    stop = init_stop(stop_uid, start_uid)
+    return dict(start=start, descriptor=descriptor, event=event, stop=stop)
+
+
+_STREAMDOC_VERSION = 'StreamDoc v1.0'
+
+
+def _new_statistics():
+    return dict(cumulative_time=0.)
+
+
+def _new_uid():
+    return str(uuid4())
+
+
+def _full_type():
+    return 'full'
+
+
+def _no_payload():
+    return None
+
+
+# the StreamDoc keys, with the slot they're stored in and a factory for their
+# default value. The defaults are only created once they are asked for
+_STREAMDOC_SLOTS = {
+    'attributes': ('_attributes', dict),
+    'kwargs': ('_kwargs', dict),
+    'args': ('_args', list),
+    'provenance': ('_provenance', dict),
+    'checkpoint': ('_checkpoint', dict),
+    '_unfilled': ('_unfilled', list),
+    # these two pieces are specific to the run
+    'statistics': ('_statistics', _new_statistics),
+    'uid': ('_uid', _new_uid),
+    # the batch info of a squashed StreamDoc (see squash), None if not a batch
+    '_batch': ('_batch', _no_payload),
+    # to propagate empty values
+    # TODO : maybe add 'partial'? (i.e. values need to be filled in)
+    '_StreamDoc_Type': ('_sdoc_type', _full_type),
+    # a packed (args, kwargs) pair (or a Future of it), set by fused
+    # stages. When set, it takes precedence over 'args' and 'kwargs'
+    '_payload': ('_payload', _no_payload),
+    # a select (see compile_mapping) that still has to be applied to the
+    # payload. It is applied by the next task that uses the payload
+    '_projection': ('_projection', _no_payload),
+}
+
+
+class StreamDoc(object):
+    # a StreamDoc is made per stage per event, so keep it small: no instance
+    # dict, and sub containers (and the uid) are only made when used
+    __slots__ = tuple(slot for slot, factory in _STREAMDOC_SLOTS.values()) \
+        + ('_extra', '_layers')
+
     def __init__(self, streamdoc=None, args=[], kwargs={},
                  attributes={}, unfilled=[], sdoc_type='full'):
         ''' A generalized document meant to be parsed by Streams.
@@ -374,38 +484,205 @@ class StreamDoc(dict):
 
                 statistics : some statistics of the stream that generated this
                     It can be anything, like run_start, run_stop etc
+
+            The components are accessed like a dict (sdoc['kwargs'] etc).
         '''
-        # initialize the dictionary class
-        super(StreamDoc, self).__init__(self)
-
-        # NOTE : removed args overall
-        # initialize the metadata and kwargs
-        self['attributes'] = dict()
-        self['kwargs'] = dict()
-        self['args'] = list()
-        self['provenance'] = dict()
-        self['checkpoint'] = dict()
-        self['_unfilled'] = []
-
-        # these two pieces are specific to the run
-        self['statistics'] = dict(cumulative_time=0.)
-        self['uid'] = str(uuid4())
-
-        # needed to distinguish that it is a StreamDoc by stream methods
-        self['_StreamDoc'] = 'StreamDoc v1.0'
-        # to propagate empty values
-        # TODO : maybe add 'partial'? (i.e. values need to be filled in)
-        self['_StreamDoc_Type'] = sdoc_type
+        if sdoc_type != 'full':
+            self._sdoc_type = sdoc_type
 
         # update
         if streamdoc is not None:
             self.updatedoc(streamdoc)
 
         # override with args
-        self.add(args=args, kwargs=kwargs, attributes=attributes, unfilled=unfilled)
+        self.add(args=args, kwargs=kwargs, attributes=attributes,
+                 unfilled=unfilled)
+
+    # dict interface
+    def __getitem__(self, key):
+        try:
+            slot, factory = _STREAMDOC_SLOTS[key]
+        except KeyError:
+            # needed to distinguish that it is a StreamDoc by stream methods
+            if key == '_StreamDoc':
+                return _STREAMDOC_VERSION
+            extra = getattr(self, '_extra', None)
+            if extra is None or key not in extra:
+                raise KeyError(key)
+            return extra[key]
+
+        # merged components are only flattened, and args and kwargs of a
+        # packed StreamDoc only split out, when someone actually asks for them
+        if getattr(self, '_layers', None) is not None:
+            self._flatten(key)
+        if key in _PAYLOAD_KEYS:
+            if getattr(self, '_projection', None) is not None:
+                self._apply_projection()
+            if getattr(self, '_payload', None) is not None:
+                self._unpack_payload()
+        try:
+            return getattr(self, slot)
+        except AttributeError:
+            val = factory()
+            setattr(self, slot, val)
+            return val
+
+    def __setitem__(self, key, value):
+        try:
+            slot, factory = _STREAMDOC_SLOTS[key]
+        except KeyError:
+            if key == '_StreamDoc':
+                raise KeyError("Can't set the StreamDoc version")
+            if getattr(self, '_extra', None) is None:
+                self._extra = dict()
+            self._extra[key] = value
+            return
+        if getattr(self, '_layers', None) is not None:
+            self._flatten(key)
+        if key in _PAYLOAD_KEYS:
+            if getattr(self, '_projection', None) is not None:
+                self._apply_projection()
+            if getattr(self, '_payload', None) is not None:
+                self._unpack_payload()
+        setattr(self, slot, value)
+
+    def __contains__(self, key):
+        return key in _STREAMDOC_SLOTS or key == '_StreamDoc' or \
+            key in (getattr(self, '_extra', None) or ())
+
+    def keys(self):
+        keys = list(_STREAMDOC_SLOTS)
+        keys.append('_StreamDoc')
+        keys.extend(getattr(self, '_extra', None) or ())
+        return keys
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def values(self):
+        return [self[key] for key in self.keys()]
+
+    def __getstate__(self):
+        # only what was set is pickled
+        self._flatten()
+        state = dict()
+        for slot in self.__slots__:
+            try:
+                state[slot] = getattr(self, slot)
+            except AttributeError:
+                pass
+        return state
+
+    def __setstate__(self, state):
+        for slot, val in state.items():
+            setattr(self, slot, val)
+
+    def __repr__(self):
+        state = self.__getstate__()
+        for slot in ('_payload', '_projection'):
+            if slot in state and state[slot] is None:
+                state.pop(slot)
+        return "StreamDoc({})".format(state)
+
+    @property
+    def payload(self):
+        ''' The (args, kwargs) of this StreamDoc, without unpacking.
+
+            This is either a tuple or a Future of a tuple (for fused stages)
+            and is what fused stages send to the cluster.
+        '''
+        if getattr(self, '_projection', None) is not None:
+            self._apply_projection()
+        payload, projection = self._lazy_payload()
+        return payload
+
+    def _lazy_payload(self):
+        ''' The payload and the select still to apply to it (or None).
+
+            For tasks that can apply the select themselves (see
+            _project_payload), this saves a task.
+        '''
+        if getattr(self, '_layers', None) is not None:
+            self._flatten('args')
+        payload = getattr(self, '_payload', None)
+        if payload is None:
+            payload = getattr(self, '_args', []), getattr(self, '_kwargs', {})
+        return payload, getattr(self, '_projection', None)
+
+    def _apply_projection(self):
+        payload, projection = self._lazy_payload()
+        self._projection = None
+        if _payload_is_remote(payload):
+            key = task_key(_project_payload, payload, projection)
+            self._args, self._kwargs = list(), dict()
+            self._payload = client.submit(_project_payload, payload,
+                                          projection, key=key)
+        else:
+            self._args, self._kwargs = _project_payload(payload, projection)
+            self._payload = None
+
+    def set_payload(self, payload):
+        ''' Set the (args, kwargs) from a packed pair (or a Future of one).
+
+            Only Futures are kept packed, local pairs are unpacked right away.
+        '''
+        if isinstance(payload, Future):
+            self._args, self._kwargs = list(), dict()
+            self._payload = payload
+        else:
+            self._args, self._kwargs = payload
+            self._payload = None
+        return self
+
+    def _unpack_payload(self):
+        payload = self._payload
+        self._args = client.submit(_payload_args, payload,
+                                   key=task_key(_payload_args, payload))
+        self._kwargs = client.submit(_payload_kwargs, payload,
+                                     key=task_key(_payload_kwargs, payload))
+        self._payload = None
+
+    def _is_bare(self):
+        ''' True if there are no args or kwargs yet.'''
+        if getattr(self, '_payload', None) is not None or \
+                getattr(self, '_layers', None) is not None or \
+                getattr(self, '_projection', None) is not None:
+            return False
+        args = getattr(self, '_args', ())
+        kwargs = getattr(self, '_kwargs', {})
+        return isinstance(args, (list, tuple)) and len(args) == 0 and \
+            isinstance(kwargs, dict) and len(kwargs) == 0
 
     def updatedoc(self, streamdoc):
         # print("in StreamDoc : {}".format(streamdoc))
+        # a packed streamdoc can be passed on as is, as long as there is
+        # nothing to merge it with
+        if isinstance(streamdoc, StreamDoc):
+            streamdoc._flatten()
+        payload = getattr(streamdoc, '_payload', None)
+        projection = getattr(streamdoc, '_projection', None)
+        if (payload is not None or projection is not None) and \
+                self._is_bare():
+            if projection is not None:
+                # pass the select on, still not applied
+                self._payload, self._projection = streamdoc._lazy_payload()
+            else:
+                self.set_payload(payload)
+            self.add(attributes=streamdoc['attributes'],
+                     statistics=streamdoc['statistics'],
+                     unfilled=streamdoc['_unfilled'])
+            return
         self.add(args=streamdoc['args'], kwargs=streamdoc['kwargs'],
                  attributes=streamdoc['attributes'],
                  statistics=streamdoc['statistics'],
@@ -427,35 +704,55 @@ class StreamDoc(dict):
         # Basically, if any computation is already remote, keep it remote
         # if it was all local, then keep local (the latter blocks, so be
         # careful)
-        if isinstance(kwargs, Future) or isinstance(self['kwargs'], Future):
-            self['kwargs'] = client.submit(update_future_dict, self['kwargs'],
-                                           kwargs)
-        else:
-            self['kwargs'].update(kwargs)
-
-        if isinstance(attributes, Future) or \
-                isinstance(self['attributes'], Future):
-            self['attributes'] = client.submit(update_future_dict,
-                                               self['attributes'],
-                                               attributes)
-        else:
-            self['attributes'].update(attributes)
-
-        if isinstance(args, Future) or isinstance(self['args'], Future):
-            def update_args(old_args, update_args):
-                new_args = list()
-                new_args.extend(old_args)
-                new_args.extend(update_args)
-                return new_args
-            self['args'] = client.submit(update_args, self['args'], args)
-        else:
-            self['args'].extend(args)
-
+        # NOTE : empty updates are skipped so that they don't unpack (or
+        # submit a task for) a remote payload, or allocate an empty container
+        if getattr(self, '_layers', None) is not None:
+            # a merged StreamDoc, just add another layer
+            self._add_layer(args, kwargs, attributes)
+            args, kwargs, attributes = [], {}, {}
+
+        if isinstance(kwargs, Future) or len(kwargs) > 0:
+            if isinstance(kwargs, Future) or \
+                    isinstance(self['kwargs'], Future):
+                key = task_key(update_future_dict, self['kwargs'], kwargs)
+                self['kwargs'] = client.submit(update_future_dict,
+                                               self['kwargs'], kwargs,
+                                               key=key)
+            else:
+                self['kwargs'].update(kwargs)
+
+        if isinstance(attributes, Future) or len(attributes) > 0:
+            if isinstance(attributes, Future) or \
+                    isinstance(self['attributes'], Future):
+                key = task_key(update_future_dict, self['attributes'],
+                               attributes)
+                self['attributes'] = client.submit(update_future_dict,
+                                                   self['attributes'],
+                                                   attributes, key=key)
+            else:
+                self['attributes'].update(attributes)
+
+        if isinstance(args, Future) or len(args) > 0:
+            if isinstance(args, Future) or isinstance(self['args'], Future):
+                def update_args(old_args, update_args):
+                    new_args = list()
+                    new_args.extend(old_args)
+                    new_args.extend(update_args)
+                    return new_args
+                key = task_key(update_args, self['args'], args)
+                self['args'] = client.submit(update_args, self['args'], args,
+                                             key=key)
+            else:
+                self['args'].extend(args)
 
-        self['statistics'].update(statistics)
-        self['provenance'].update(provenance)
-        self['checkpoint'].update(checkpoint)
-        self['_unfilled'].extend(unfilled)
+        if len(statistics) > 0:
+            self['statistics'].update(statistics)
+        if len(provenance) > 0:
+            self['provenance'].update(provenance)
+        if len(checkpoint) > 0:
+            self['checkpoint'].update(checkpoint)
+        if len(unfilled) > 0:
+            self['_unfilled'].extend(unfilled)
 
         return self
 
@@ -476,7 +773,9 @@ class StreamDoc(dict):
         return self['statistics']
 
     def get_return(self, elem=None):
-        res = client.submit(_get_return, self.args, self.kwargs, elem=elem)
+        key = task_key(_get_return, self.args, self.kwargs, elem=elem)
+        res = client.submit(_get_return, self.args, self.kwargs, elem=elem,
+                            key=key)
         return res
 
     def repr(self):
@@ -499,39 +798,107 @@ class StreamDoc(dict):
             The new streamdoc's attributes/kwargs will override this one upon
             collison.
         '''
-        streamdoc = StreamDoc(self)
-        for newstreamdoc in newstreamdocs:
-            streamdoc.updatedoc(newstreamdoc)
+        # copy on write : the args, kwargs and attributes of each streamdoc
+        # are only stacked here. They are flattened (once, and in one task
+        # if any of them are remote) when first accessed
+        streamdoc = StreamDoc()
+        streamdoc._layers = dict(payload=list(), attributes=list())
+        for newstreamdoc in (self,) + newstreamdocs:
+            streamdoc._add_streamdoc_layer(newstreamdoc)
         return streamdoc
 
+    def _add_streamdoc_layer(self, streamdoc):
+        # NOTE : this reads the slots directly, so that nothing is flattened
+        # or unpacked
+        if getattr(streamdoc, '_projection', None) is not None:
+            streamdoc._apply_projection()
+        layers = getattr(streamdoc, '_layers', None) or dict()
+        if 'payload' in layers:
+            # no need to flatten a merged streamdoc to merge it again
+            self._layers['payload'].extend(layers['payload'])
+        elif getattr(streamdoc, '_payload', None) is not None:
+            self._layers['payload'].append(streamdoc._payload)
+        else:
+            self._add_layer(args=getattr(streamdoc, '_args', []),
+                            kwargs=getattr(streamdoc, '_kwargs', {}))
+        if 'attributes' in layers:
+            self._layers['attributes'].extend(layers['attributes'])
+        else:
+            self._add_layer(attributes=getattr(streamdoc, '_attributes', {}))
+        # these are small, just merge them
+        self.add(statistics=streamdoc['statistics'],
+                 unfilled=streamdoc['_unfilled'])
+
+    def _add_layer(self, args=[], kwargs={}, attributes={}):
+        if isinstance(args, Future) or isinstance(kwargs, Future) or \
+                len(args) > 0 or len(kwargs) > 0:
+            self._layers['payload'].append((args, kwargs))
+        if isinstance(attributes, Future) or len(attributes) > 0:
+            self._layers['attributes'].append(attributes)
+
+    def _flatten(self, key=None):
+        ''' Flatten the merged layers needed for key (all if None).'''
+        layers = getattr(self, '_layers', None)
+        if layers is None:
+            return
+        if key is None or key in _PAYLOAD_KEYS:
+            parts = layers.pop('payload', None)
+            if parts is not None:
+                self._flatten_payload(parts)
+        if key is None or key == 'attributes':
+            parts = layers.pop('attributes', None)
+            if parts is not None:
+                if any(isinstance(part, Future) for part in parts):
+                    self._attributes = client.submit(
+                        _merge_dicts, *parts, key=task_key(_merge_dicts, *parts))
+                else:
+                    self._attributes = _merge_dicts(*parts)
+        if len(layers) == 0:
+            del self._layers
+
+    def _flatten_payload(self, parts):
+        # layers are added with args and kwargs left empty
+        if len(parts) == 0:
+            return
+        elif len(parts) == 1 and isinstance(parts[0], Future):
+            self._payload = parts[0]
+        elif any(_payload_is_remote(part) for part in parts):
+            # keep the result packed, for the next stage
+            self._payload = client.submit(
+                _merge_payloads, *parts, key=task_key(_merge_payloads, *parts))
+        else:
+            args, kwargs = _merge_payloads(*parts)
+            self._args, self._kwargs = args, kwargs
+
     def select(self, *mapping):
-        try:
-            args, kwargs = self['args'], self['kwargs']
-            if isinstance(args, Future) or \
-                    isinstance(kwargs, Future):
-                # do computation remotely
-                # self.etc should be okay (if not, change to staticmethod)
-                res = client.submit(_select_from_mapping, args,
-                                    kwargs, *mapping)
-                # can't just get elements from tuple, need to submit to cluster
-
-                def get_args(res):
-                    return res[0]
-
-                def get_kwargs(res):
-                    return res[1]
-                args = client.submit(get_args, res)
-                kwargs = client.submit(get_kwargs, res)
-            else:
-                args, kwargs = _select_from_mapping(args, kwargs, *mapping)
+        ''' Select args and kwargs, see _select_from_mapping.
+
+            mapping can also be compiled beforehand, see compile_mapping.
 
-            # from SciStreams.config import debugcache
-            # debugcache.append(args)
-            # debugcache.append(kwargs)
+            If the data is remote, the selection is only recorded. It's
+            applied by the next task that uses the data.
+        '''
+        try:
+            projection = compile_mapping(*mapping)
+            payload, previous = self._lazy_payload()
+            if previous is not None:
+                composed = compose_projections(previous, projection)
+                if composed is None:
+                    # the selects can't be composed, apply the previous one
+                    self._apply_projection()
+                    payload, previous = self._lazy_payload()
+                else:
+                    projection = composed
 
-            sdoc = StreamDoc(self)
-            sdoc['args'] = args
-            sdoc['kwargs'] = kwargs
+            sdoc = StreamDoc(attributes=self['attributes'])
+            sdoc.add(statistics=self['statistics'],
+                     unfilled=self['_unfilled'])
+            if _payload_is_remote(payload):
+                sdoc._payload, sdoc._projection = payload, projection
+            else:
+                sdoc.set_payload(_project_payload(payload, projection))
+            # a selection of a batch is still a batch
+            sdoc['_batch'] = self['_batch']
 
             return sdoc
         except Exception as e:
@@ -540,7 +907,7 @@ class StreamDoc(dict):
             new_sdoc = StreamDoc(attributes=self['attributes'])
             new_sdoc['statistics'] = statistics
             new_sdoc['_StreamDoc_Type'] = 'error'
-            if debug:
+            if config.debug:
                 raise
             else:
                 return new_sdoc
@@ -613,17 +980,29 @@ def _select_from_mapping(args, kwargs, *mapping):
         These *must* be tuples, and the list a list kwarg elems must be
             strs and arg elems must be ints to accomplish this instead
     '''
-    # print("IN STREAMDOC -> SELECT")
-    # TODO : take args instead
-    # if not isinstance(mapping, list):
-    # mapping = [mapping]
-    # streamdoc = StreamDoc(self)
-    newargs = list()
-    newkwargs = dict()
-    totargs = dict(args=newargs, kwargs=newkwargs)
-    # quick fix but could be cleaned up
-    sdoc = dict(args=args, kwargs=kwargs)
+    return _project(args, kwargs, compile_mapping(*mapping))
+
+
+# a compiled select mapping. args is a tuple of the sources of the new args
+# and kwargs a tuple of (name, source) of the new kwargs. A source is
+# ('args', index) or ('kwargs', name)
+Projection = namedtuple('Projection', ['args', 'kwargs'])
+
+# the result of a bad mapping, blank args and kwargs
+EMPTY_PROJECTION = Projection((), ())
+
+
+def compile_mapping(*mapping):
+    ''' Compile a select mapping (see _select_from_mapping) to a
+        Projection.
+
+        scs.select does this once, when the stream is built.
+    '''
+    if len(mapping) == 1 and isinstance(mapping[0], Projection):
+        return mapping[0]
 
+    newargs = list()
+    newkwargs = list()
     for mapelem in mapping:
         if isinstance(mapelem, str):
             mapelem = mapelem, mapelem
@@ -640,16 +1019,16 @@ def _select_from_mapping(args, kwargs, *mapping):
         newkey = mapelem[1]
 
         if isinstance(oldkey, int):
-            oldparentkey = 'args'
+            source = 'args', oldkey
         elif isinstance(oldkey, str):
-            oldparentkey = 'kwargs'
+            source = 'kwargs', oldkey
         else:
             raise ValueError("old key not understood : {}".format(oldkey))
 
         if newkey is None:
-            newparentkey = 'args'
+            newargs.append(source)
         elif isinstance(newkey, str):
-            newparentkey = 'kwargs'
+            newkwargs.append((newkey, source))
         elif isinstance(newkey, int):
             # this an error, but just return blank args and kwargs
             errorstr = "Integer tuple pairs not accepted."
@@ -657,42 +1036,81 @@ def _select_from_mapping(args, kwargs, *mapping):
             errorstr += " or ('foo',1) mapping."
             errorstr += "Please try (1,None) or ('foo', None) instead"
             print(errorstr)
-            return [], {}
-
-        if oldparentkey == 'kwargs' and \
-           oldkey not in sdoc[oldparentkey] \
-           or oldparentkey == 'args' and \
-           len(sdoc[oldparentkey]) < oldkey:
-            errorstr = "streamdoc.select() : Error {} not ".format(oldkey)
-            errorstr += "in the {} of ".format(oldparentkey)
-            errorstr += "the current streamdoc.\n"
-
-            errorstr += "Details : Tried to map key {}".format(oldkey)
-            errorstr += " from {} ".format(oldparentkey)
-            errorstr += " to {}\n.".format(newparentkey)
-            errorstr += "This usually occurs from selecting "
-            errorstr += "a streamdoc with missing information\n"
-            errorstr += "(But could also come from missing data)\n"
-            return [], {}
-
-        if newparentkey == 'args':
-            totargs[newparentkey].append(sdoc[oldparentkey][oldkey])
-        else:
-            totargs[newparentkey][newkey] = sdoc[oldparentkey][oldkey]
+            return EMPTY_PROJECTION
+
+    return Projection(tuple(newargs), tuple(newkwargs))
+
+
+def compose_projections(first, second):
+    ''' The Projection doing first, then second.
+
+        Returns None unless second keeps everything first selects: if a
+        source of first is missing, first gives blank args and kwargs, which
+        the composed Projection wouldn't when second drops that source.
+    '''
+    kwarg_sources = dict(first.kwargs)
+    kept = set(second.args) | set(source for name, source in second.kwargs)
+    selected = set(('args', i) for i in range(len(first.args))) | \
+        set(('kwargs', name) for name in kwarg_sources)
+    if not selected <= kept:
+        return None
+
+    def resolve(source):
+        parentkey, key = source
+        if parentkey == 'args':
+            if -len(first.args) <= key < len(first.args):
+                return first.args[key]
+        elif key in kwarg_sources:
+            return kwarg_sources[key]
+        # the selection is missing from the first, so it would give blank
+        # args and kwargs
+        raise KeyError(key)
+
+    try:
+        return Projection(tuple(resolve(source) for source in second.args),
+                          tuple((name, resolve(source))
+                                for name, source in second.kwargs))
+    except KeyError:
+        return EMPTY_PROJECTION
+
+
+def _project(args, kwargs, projection):
+    ''' Apply a Projection to args and kwargs.'''
+    sdoc = dict(args=args, kwargs=kwargs)
+    try:
+        newargs = [sdoc[parentkey][key]
+                   for parentkey, key in projection.args]
+        newkwargs = {name: sdoc[parentkey][key]
+                     for name, (parentkey, key) in projection.kwargs}
+    except (KeyError, IndexError):
+        # This usually occurs from selecting a streamdoc with missing
+        # information (But could also come from missing data)
+        return [], {}
+    return newargs, newkwargs
+
+
+def _project_payload(payload, projection):
+    ''' Apply a Projection to a packed (args, kwargs) pair.'''
+    if projection is None:
+        return payload
+    args, kwargs = payload
+    return _project(args, kwargs, projection)
+
+
+def _payload_args(payload):
+    return payload[0]
+
+
+def _payload_kwargs(payload):
+    return payload[1]
 
-    # streamdoc['args'] = totargs['args']
-    # streamdoc['kwargs'] = totargs['kwargs']
 
-    # this is to make it friendly with distributed
-    # return the things that could be futures, then make a StreamDoc from
-    # it
-    # print("tot args :{}".format(totargs['args']))
-    # print("tot kwargs :{}".format(totargs['kwargs']))
-    return totargs['args'], totargs['kwargs']
+_PAYLOAD_KEYS = ('args', 'kwargs')
 
 
 def _is_streamdoc(doc):
-    if isinstance(doc, dict) and '_StreamDoc' in doc:
+    if isinstance(doc, StreamDoc) or \
+            isinstance(doc, dict) and '_StreamDoc' in doc:
         return True
     else:
         return False
@@ -728,9 +1146,23 @@ def parse_streamdoc(name, filter=False):
             if a tuple, makes a StreamDoc with only arguments else, makes a
             StreamDoc of just one element
     '''
-    def streamdoc_dec(f, remote=True):
+    def streamdoc_dec(f, remote=True, fused=None):
+        ''' fused : bool, optional
+                if True (and remote), run the whole stage as one task (see
+                ``_fused_stage``). Defaults to the ``fused`` config option.
+        '''
+        if fused is None:
+            fused = config.fused
+
         @wraps(f)
         def f_new(x, x2=None, **kwargs_additional):
+            if x2 is None and _is_streamdoc(x):
+                kwargs_additional = batch_kwargs(f, x, kwargs_additional)
+            if remote and fused:
+                return _fused_stage(f, x, x2=x2,
+                                    kwargs_additional=kwargs_additional,
+                                    filter=filter)
+
             def update_kwargs(old_kwargs, in_kwargs, empty=False):
                 if not empty:
                     new_kwargs = old_kwargs.copy()
@@ -738,15 +1170,12 @@ def parse_streamdoc(name, filter=False):
                     return new_kwargs
                 else:
                     return {}
-            if isinstance(x.get('kwargs', {}), Future):
-                print("passing a future of kwargs")
-            else:
-                print("NOT passing a future of kwargs")
-
-            if isinstance(x.get('args', []), Future):
-                print("passing a future of args")
-            else:
-                print("NOT passing a future of args")
+            if instrument.enabled and _is_streamdoc(x):
+                stage = getattr(f, '__name__', 'unnamed')
+                if isinstance(getattr(x, '_kwargs', None), Future):
+                    instrument.count(stage, 'kwargs_future')
+                if isinstance(getattr(x, '_args', None), Future):
+                    instrument.count(stage, 'args_future')
 
             # add a time out to f
             # TODO : replace with custom time out per stream
@@ -792,8 +1221,10 @@ def parse_streamdoc(name, filter=False):
                     # check if attributes are a future
                     if isinstance(x.attributes, Future) or \
                             isinstance(x2.attributes, Future):
+                        key = task_key(update_kwargs, x.attributes,
+                                       x2.attributes)
                         attributes = client.submit(update_kwargs, x.attributes,
-                                                   x2.attributes)
+                                                   x2.attributes, key=key)
                     else:
                         attributes = x.attributes
                         # attributes of x2 overrides x
@@ -814,7 +1245,11 @@ def parse_streamdoc(name, filter=False):
                 return empty
 
             if remote:
-                sdoc_empty = client.submit(empty_sdoc, sdoc_type, sdoc2_type)
+                # the task keys of this stage, from cheap fingerprints of
+                # the inputs (so that data is never hashed)
+                token = tokenize_cheap(name, f, x, x2, kwargs_additional)
+                sdoc_empty = client.submit(empty_sdoc, sdoc_type, sdoc2_type,
+                                           key="empty_sdoc-" + token)
             else:
                 if isinstance(sdoc_type, Future):
                     sdoc_type = sdoc_type.result()
@@ -830,7 +1265,8 @@ def parse_streamdoc(name, filter=False):
             if remote:
                 kwargs_future = client.submit(update_kwargs, kwargs,
                                               kwargs_additional,
-                                              empty=sdoc_empty)
+                                              empty=sdoc_empty,
+                                              key="update_kwargs-" + token)
                 # print("Sent to cluster")
             else:
                 # we don't want to run on cluster
@@ -865,17 +1301,18 @@ def parse_streamdoc(name, filter=False):
             # before client.submit
             # the args and kwargs themselves may also be Futures
 
-            def future_wrapper(f):
+            def future_wrapper(f, key=None):
                 @wraps(f)
                 # assumed that args, kwargs come in this order always
                 def f_new(args, kwargs):
-                    return client.submit(f, args, kwargs)
+                    return client.submit(f, args, kwargs, key=key)
                 return f_new
 
             fnew = wraps(f)(partial(unwrap, f))
             # re-define f again...
             if remote:
-                fnew = future_wrapper(fnew)
+                fnew = future_wrapper(fnew, key="{}-{}".format(
+                    getattr(f, '__name__', 'unnamed'), token))
                 # print("submitting to cluster")
             else:
                 # leave as is
@@ -942,7 +1379,7 @@ def parse_streamdoc(name, filter=False):
             except Exception:
                 result = {}
                 _cleanexit(f, statistics)
-                if debug:
+                if config.debug:
                     raise
 
             t2 = time.time()
@@ -959,12 +1396,7 @@ def parse_streamdoc(name, filter=False):
             # {}".format(attributes['function_list']))
             attributes['function_list'].append(getattr(f, '__name__',
                                                'unnamed'))
-            print("runtime : {}".format(t2-t1))
-            print("func list : {}".format(attributes['function_list']))
-            if config.last_run_time is None:
-                config.last_run_time = t1
-            print("delay since last run: {}".format(t2 - config.last_run_time))
-            config.last_run_time = t2
+            _record_run(getattr(f, '__name__', 'unnamed'), statistics)
             # print("Running function {}".format(f.__name__))
             # instantiate new stream doc
             streamdoc = StreamDoc(attributes=attributes, sdoc_type=sdoc_type)
@@ -999,8 +1431,10 @@ def parse_streamdoc(name, filter=False):
             # TODO : filter is not being used, should use or delete later?
             if not filter:
                 if remote:
-                    kwargs = client.submit(get_kwargs, result)
-                    args = client.submit(get_args, result)
+                    kwargs = client.submit(get_kwargs, result,
+                                           key="get_kwargs-" + token)
+                    args = client.submit(get_args, result,
+                                         key="get_args-" + token)
                     # print("Computation key : {}".format(result.key))
                     # print("Computation status : {}".format(result.status))
                     # print("Computation : {}".format(f.__name__))
@@ -1008,6 +1442,9 @@ def parse_streamdoc(name, filter=False):
                     kwargs = get_kwargs(result)
                     args = get_args(result)
                 streamdoc.add(kwargs=kwargs, args=args)
+                # stages that accept batches keep them batches
+                if x2 is None and _is_streamdoc(x) and is_batch_stage(f):
+                    streamdoc['_batch'] = x.get('_batch')
             else:
                 # for filter, we pass old streamdoc but change it's state
                 # if filter predicate is True (state can also be Future)
@@ -1021,7 +1458,8 @@ def parse_streamdoc(name, filter=False):
                         return 'empty'
 
                 if remote:
-                    result = client.submit(parse_predicate, sdoc_type, result)
+                    result = client.submit(parse_predicate, sdoc_type, result,
+                                           key="parse_predicate-" + token)
                 else:
                     result = parse_predicate(sdoc_type, result)
 
@@ -1029,6 +1467,10 @@ def parse_streamdoc(name, filter=False):
 
             return streamdoc
 
+        # so that graph passes (see SciStreams.core.fusion) can recognize
+        # the stage
+        f_new._streamdoc_stage = dict(func=f, name=name, remote=remote,
+                                      filter=filter)
         return f_new
 
     return streamdoc_dec
@@ -1042,6 +1484,172 @@ parse_streamdoc_filter = parse_streamdoc("filter", filter=True)
 psdf = parse_streamdoc_filter
 
 
+def _split_result(res):
+    ''' Split a function result into (args, kwargs).'''
+    if isinstance(res, dict):
+        return [], res
+    else:
+        return [res], {}
+
+
+def _stage_task(f, sdoc_type, sdoc2_type, payload, payload2=None,
+                kwargs_additional={}, filter=False, projection=None):
+    ''' The part of a fused stage that runs on the worker.
+
+        Unpacks the (args, kwargs) payload(s), applies the pending select
+        (projection) of the first, merges in the additional kwargs, runs f
+        and splits its result into (args, kwargs). For filters, returns the
+        new StreamDoc type instead.
+    '''
+    payload = _project_payload(payload, projection)
+    if (sdoc_type == 'full' and sdoc2_type is None) or \
+            (sdoc_type == 'full' and sdoc2_type == 'full'):
+        empty = False
+    else:
+        empty = True
+
+    if payload2 is None:
+        args, kwargs = payload
+        kwargs = dict(kwargs)
+    else:
+        # accumulate, the function takes the previous and new results
+        try:
+            args = _get_return(*payload), _get_return(*payload2)
+        except Exception:
+            args = None, None
+        kwargs = dict()
+    kwargs.update(kwargs_additional)
+
+    if empty:
+        result = []
+    else:
+        result = f(*args, **kwargs)
+
+    if filter:
+        if result is True and sdoc_type == 'full':
+            return 'full'
+        else:
+            return 'empty'
+
+    return _split_result(result)
+
+
+def _fused_stage(f, x, x2=None, kwargs_additional={}, filter=False):
+    ''' Fused version of the parse_streamdoc stage.
+
+        Instead of submitting the empty check, the kwargs update, the function
+        and the args/kwargs accessors as separate tasks, submit one
+        ``_stage_task`` and keep its (args, kwargs) result packed in the new
+        StreamDoc. A following fused stage consumes the packed result
+        directly, anything else unpacks it when needed.
+    '''
+    prev_stats = dict(cumulative_time=0.)
+    sdoc2_type, payload2, projection = None, None, None
+    if x2 is None:
+        if _is_streamdoc(x):
+            prev_stats['cumulative_time'] = \
+                x['statistics']['cumulative_time']
+            sdoc_type = x['_StreamDoc_Type']
+            # a pending select is applied in the task
+            payload, projection = x._lazy_payload()
+            attributes = x.attributes
+        else:
+            sdoc_type = 'full'
+            payload = (x,), dict()
+            attributes = dict()
+    else:
+        if not (_is_streamdoc(x) and _is_streamdoc(x2)):
+            raise ValueError("Two normal arguments not accepted")
+        prev_stats['cumulative_time'] = \
+            x['statistics']['cumulative_time']
+        prev_stats['cumulative_time'] += \
+            x2['statistics']['cumulative_time']
+        sdoc_type = x['_StreamDoc_Type']
+        sdoc2_type = x2['_StreamDoc_Type']
+        payload, payload2 = x.payload, x2.payload
+        if isinstance(x.attributes, Future) or \
+                isinstance(x2.attributes, Future):
+            attributes = client.submit(_merge_dicts, x.attributes,
+                                       x2.attributes,
+                                       key=task_key(_merge_dicts,
+                                                    x.attributes,
+                                                    x2.attributes))
+        else:
+            # attributes of x2 overrides x
+            attributes = _merge_dicts(x.attributes, x2.attributes)
+
+    statistics = dict(prev_stats)
+    t1 = time.time()
+    try:
+        task = wraps(f)(partial(_stage_task, f))
+        key = task_key(f, sdoc_type, sdoc2_type, x, x2, kwargs_additional,
+                       filter)
+        result = client.submit(task, sdoc_type, sdoc2_type, payload,
+                               payload2=payload2,
+                               kwargs_additional=kwargs_additional,
+                               filter=filter, projection=projection,
+                               key=key)
+        statistics['status'] = "Success"
+    except Exception:
+        result = 'empty' if filter else ([], {})
+        _cleanexit(f, statistics)
+        if config.debug:
+            raise
+    t2 = time.time()
+    statistics['runtime'] = t2 - t1
+    statistics['runstart'] = t1
+    statistics['cumulative_time'] += statistics['runtime']
+    _record_run(getattr(f, '__name__', 'unnamed'), statistics)
+
+    if filter:
+        streamdoc = StreamDoc(x)
+        streamdoc['_StreamDoc_Type'] = result
+        return streamdoc
+
+    if not isinstance(attributes, Future):
+        attributes = dict(attributes)
+        function_list = list(attributes.get('function_list', []))
+        function_list.append(getattr(f, '__name__', 'unnamed'))
+        attributes['function_list'] = function_list
+
+    streamdoc = StreamDoc(attributes=attributes, sdoc_type=sdoc_type)
+    streamdoc['statistics'] = statistics
+    streamdoc.set_payload(result)
+    # stages that accept batches keep them batches
+    if x2 is None and _is_streamdoc(x) and is_batch_stage(f):
+        streamdoc['_batch'] = x.get('_batch')
+    return streamdoc
+
+
+def _record_run(stage, statistics):
+    ''' Fill in the delay since the last stage ran and report the
+        statistics of this run to the instrumentation.'''
+    t1 = statistics['runstart']
+    t2 = t1 + statistics['runtime']
+    if config.last_run_time is None:
+        config.last_run_time = t1
+    statistics['delay_since_last_run'] = t2 - config.last_run_time
+    config.last_run_time = t2
+    instrument.record(stage, statistics)
+
+
+def _merge_dicts(*dicts):
+    ''' Merge dicts, later ones override earlier ones.'''
+    new_dict = dict()
+    for update_dict in dicts:
+        new_dict.update(update_dict)
+    return new_dict
+
+
+def _merge_payloads(*payloads):
+    ''' Merge (args, kwargs) pairs. args are appended, kwargs overridden.'''
+    args, kwargs = list(), dict()
+    for payload_args, payload_kwargs in payloads:
+        args.extend(payload_args)
+        kwargs.update(payload_kwargs)
+    return args, kwargs
+
+
 def _cleanexit(f, statistics):
     ''' convenience routine
         to log errors from exception for
@@ -1075,4 +1683,21 @@ def _cleanexit(f, statistics):
 # for the StreamDoc object
 @normalize_token.register(StreamDoc)
 def tokenize_sdoc(sdoc):
-    return normalize_token((sdoc['args'], sdoc['kwargs']))
+    return fingerprint(sdoc)
+
+
+@fingerprint.register(StreamDoc)
+def fingerprint_sdoc(sdoc):
+    ''' The fingerprint of the data of a StreamDoc.
+
+        If the data can't be fingerprinted cheaply (it's local and large),
+        the uid is used. For a StreamDoc made from an event, this is the event
+        uid.
+    '''
+    payload, projection = sdoc._lazy_payload()
+    token = fingerprint(payload)
+    if token is not None and projection is not None:
+        token = token, fingerprint(projection)
+    if token is None:
+        token = 'uid', sdoc['uid']
+    return 'StreamDoc', token
@@ -0,0 +1,229 @@
+'''
+    Asynchronous execution of local (remote=False) stages.
+
+    A local stage normally calls ``.result()`` on any Future it is given,
+    which blocks the whole streamz emit chain (and the ingest loop in
+    start_run) until the data arrives. The nodes here wait for their inputs
+    on a tornado event loop instead and run the function on a thread pool,
+    so that slow local stages overlap instead of running one after the
+    other. They follow the streamz async protocol: ``update`` is a coroutine
+    and returns a Future of what the downstream nodes returned, which
+    streamz (and run_in_loop) wait on.
+
+    Results are still emitted in the order the inputs came in, so zips
+    downstream line up.
+
+    Enable with ``asynchronous: True`` in scistreams.yml (for all local
+    stages) or by passing ``asynchronous=True`` to scs.map/scs.sink.
+
+    Examples
+    --------
+    >>> s = Stream()
+    >>> sout = scs.map(plot_image, s, remote=False, asynchronous=True)
+    >>> future = run_in_loop(s.emit, sdoc)
+    >>> future.result()
+'''
+from concurrent.futures import Future as ConcurrentFuture, \
+    ThreadPoolExecutor
+import threading
+
+import streamz
+from tornado import gen
+from tornado.concurrent import Future as TornadoFuture
+from tornado.ioloop import IOLoop
+from distributed import Future
+
+from SciStreams import config
+from SciStreams.core.StreamDoc import StreamDoc, _is_streamdoc
+
+
+_executor = None
+_loop = None
+_lock = threading.Lock()
+# sinks are only referenced from upstream, keep them alive
+_global_sinks = set()
+
+
+def get_executor():
+    ''' The thread pool local stages run on (see async_workers).'''
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=config.async_workers)
+    return _executor
+
+
+def get_loop():
+    ''' The event loop of the asynchronous stages.
+
+        It is started in a daemon thread the first time it is asked for.
+    '''
+    global _loop
+    with _lock:
+        if _loop is None:
+            started = threading.Event()
+            holder = list()
+
+            def run():
+                loop = IOLoop()
+                holder.append(loop)
+                loop.add_callback(started.set)
+                loop.start()
+
+            thread = threading.Thread(target=run, name="SciStreams-loop",
+                                      daemon=True)
+            thread.start()
+            started.wait()
+            _loop = holder[0]
+    return _loop
+
+
+def wait_for(future):
+    ''' A tornado Future for a distributed (or concurrent) Future.
+
+        Must be called from the event loop. The result is set on the loop
+        when the future is done, nothing blocks waiting on it.
+    '''
+    loop = IOLoop.current()
+    result = TornadoFuture()
+
+    def copy(done):
+        try:
+            result.set_result(done.result())
+        except Exception as e:
+            result.set_exception(e)
+
+    future.add_done_callback(lambda done: loop.add_callback(copy, done))
+    return result
+
+
+@gen.coroutine
+def resolve(x):
+    ''' The value of x, waiting for it if it's a Future.'''
+    if isinstance(x, (Future, ConcurrentFuture)):
+        x = yield wait_for(x)
+    return x
+
+
+@gen.coroutine
+def gather_streamdoc(x):
+    ''' A copy of the StreamDoc x with all its Futures resolved.
+
+        Anything that is not a StreamDoc is just resolved.
+    '''
+    if not _is_streamdoc(x):
+        x = yield resolve(x)
+        return x
+
+    payload = x.payload
+    if isinstance(payload, (Future, ConcurrentFuture)):
+        payload = yield resolve(payload)
+    args, kwargs = payload
+    args, kwargs, attributes, sdoc_type = \
+        yield [resolve(args), resolve(kwargs), resolve(x.attributes),
+               resolve(x['_StreamDoc_Type'])]
+
+    sdoc = StreamDoc(attributes=attributes, sdoc_type=sdoc_type)
+    sdoc.add(args=args, kwargs=kwargs, statistics=x['statistics'],
+             unfilled=x['_unfilled'])
+    sdoc['_batch'] = x['_batch']
+    sdoc['uid'] = x['uid']
+    return sdoc
+
+
+@gen.coroutine
+def wait_all(result):
+    ''' Wait on what a streamz emit (or update) returned.
+
+        This is either None, a Future or a (nested) list of them.
+    '''
+    if isinstance(result, list):
+        yield [wait_all(res) for res in result]
+    elif result is not None and gen.is_future(result):
+        yield result
+
+
+class map_async(streamz.Stream):
+    ''' A streamz map that waits for its input on the event loop.
+
+        Parameters
+        ----------
+        upstream : Stream
+            the stream to map
+
+        func : callable
+            the function, given the input with all its Futures resolved
+
+        threads : bool, optional
+            run func on the thread pool (see get_executor). Set to False
+            for functions that are not thread safe, they are then run on
+            the event loop (still without blocking on the inputs)
+
+        args, kwargs :
+            passed on to func
+    '''
+    def __init__(self, upstream, func, *args, threads=True,
+                 stream_name=None, **kwargs):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.threads = threads
+        # the previous emit, to keep the results in order
+        self._last = None
+        streamz.Stream.__init__(self, upstream, stream_name=stream_name)
+
+    @gen.coroutine
+    def update(self, x, who=None, metadata=None):
+        previous, done = self._last, TornadoFuture()
+        self._last = done
+        try:
+            x = yield gather_streamdoc(x)
+            if self.threads:
+                result = yield get_executor().submit(self.func, x,
+                                                     *self.args,
+                                                     **self.kwargs)
+            else:
+                result = self.func(x, *self.args, **self.kwargs)
+            if previous is not None:
+                yield previous
+            emitted = self._emit(result, metadata=metadata)
+        finally:
+            # the next input can be emitted now, while downstream works
+            done.set_result(None)
+        yield wait_all(emitted)
+        return emitted
+
+
+class sink_async(map_async):
+    ''' A map_async with nothing downstream.'''
+    def __init__(self, upstream, func, *args, **kwargs):
+        map_async.__init__(self, upstream, func, *args, **kwargs)
+        _global_sinks.add(self)
+
+
+def run_in_loop(f, *args, **kwargs):
+    ''' Run f on the event loop (see get_loop), from any other thread.
+
+        f is typically a streamz emit. Returns a concurrent Future that is
+        done once f and the Futures it returned are done, with the error of
+        the first that failed if any.
+    '''
+    future = ConcurrentFuture()
+    stream = getattr(f, '__self__', None)
+    if isinstance(stream, streamz.Stream) and \
+            getattr(f, '__func__', None) is streamz.Stream.emit:
+        # without a loop, emit drops what the downstream nodes returned
+        f = stream._emit
+
+    @gen.coroutine
+    def run():
+        try:
+            result = f(*args, **kwargs)
+            yield wait_all(result)
+        except Exception as e:
+            future.set_exception(e)
+        else:
+            future.set_result(result)
+
+    get_loop().add_callback(run)
+    return future
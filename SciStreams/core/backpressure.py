@@ -0,0 +1,140 @@
+'''
+    Backpressure: cap the number of results in flight.
+
+    A ``Backpressure`` counts the items (StreamDocs, Futures etc) that still
+    have Futures computing. Tracking an item when the cap is reached blocks
+    the caller (the producer, usually the ingest loop in start_run) until
+    one of the items in flight is done. Slots are freed from the completion
+    callbacks of the Futures, so the producer is released as soon as there
+    is room, instead of polling the scheduler.
+
+    Attach one to a stage with ``scs.limit`` (or ``max_in_flight`` in
+    ``scs.map``), or share one between stages to cap a whole graph. The
+    remote SciStreamCallbacks report their results to
+    ``sink_backpressure``.
+
+    Examples
+    --------
+    >>> sout = scs.map(circavg, sin, max_in_flight=100)
+    >>> # or for many stages
+    >>> bp = Backpressure(1000, name="graph")
+    >>> sout1 = scs.limit(scs.map(circavg, sin), backpressure=bp)
+    >>> sout2 = scs.limit(scs.map(qphiavg, sin), backpressure=bp)
+'''
+from concurrent.futures import Future as ConcurrentFuture
+import threading
+
+import streamz
+from distributed import Future
+
+from SciStreams.core.StreamDoc import _is_streamdoc
+
+
+def futures_of(x):
+    ''' The Futures in x (a Future, StreamDoc or list, tuple or dict of
+        them).'''
+    if isinstance(x, (Future, ConcurrentFuture)):
+        return [x]
+    if _is_streamdoc(x):
+        payload, projection = x._lazy_payload()
+        return futures_of([payload, x.attributes, x['_StreamDoc_Type']])
+    if isinstance(x, dict):
+        x = list(x.values())
+    if isinstance(x, (list, tuple)):
+        return [future for elem in x for future in futures_of(elem)]
+    return []
+
+
+class Backpressure:
+    ''' Cap the number of items in flight.
+
+        Parameters
+        ----------
+        max_in_flight : int or None
+            the cap, None for no cap (just counting)
+
+        name : str, optional
+            for the messages
+    '''
+    def __init__(self, max_in_flight, name=None):
+        self.max_in_flight = max_in_flight
+        self.name = name
+        self._in_flight = 0
+        self._condition = threading.Condition()
+
+    @property
+    def in_flight(self):
+        return self._in_flight
+
+    def _full(self):
+        return self.max_in_flight is not None and \
+            self._in_flight >= self.max_in_flight
+
+    def wait(self, timeout=None):
+        ''' Block until there is room for one more item.
+
+            Returns False if it timed out.
+        '''
+        with self._condition:
+            return self._condition.wait_for(lambda: not self._full(),
+                                            timeout=timeout)
+
+    def track(self, x):
+        ''' Hold a slot until the Futures in x are done.
+
+            Blocks while the cap is reached. x is returned. Items without
+            Futures don't take a slot.
+        '''
+        futures = futures_of(x)
+        if len(futures) == 0:
+            return x
+        with self._condition:
+            self._condition.wait_for(lambda: not self._full())
+            self._in_flight += 1
+
+        # the slot is released when the last Future is done
+        remaining = [len(futures)]
+        lock = threading.Lock()
+
+        def done(future):
+            with lock:
+                remaining[0] -= 1
+                last = remaining[0] == 0
+            if last:
+                self._release()
+
+        for future in futures:
+            future.add_done_callback(done)
+        return x
+
+    def _release(self):
+        with self._condition:
+            self._in_flight -= 1
+            self._condition.notify()
+
+    def __repr__(self):
+        return "Backpressure({}, in flight : {}/{})".format(
+            self.name, self._in_flight, self.max_in_flight)
+
+
+# what the remote SciStreamCallbacks (the sinks) report to
+sink_backpressure = Backpressure(None, name="sinks")
+
+
+class limit(streamz.Stream):
+    ''' Pass items on, blocking while backpressure is at its cap.
+
+        Parameters
+        ----------
+        upstream : Stream
+
+        backpressure : Backpressure
+            shared between stages to cap them together
+    '''
+    def __init__(self, upstream, backpressure, stream_name=None):
+        self.backpressure = backpressure
+        streamz.Stream.__init__(self, upstream, stream_name=stream_name)
+
+    def update(self, x, who=None, metadata=None):
+        self.backpressure.track(x)
+        return self._emit(x, metadata=metadata)
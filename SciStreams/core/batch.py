@@ -0,0 +1,116 @@
+'''
+    Batches of events, for vectorized stages.
+
+    ``StreamDoc.squash`` stacks the args and kwargs of N StreamDocs into one
+    batch and ``StreamDoc.unsquash`` splits it back into one StreamDoc per
+    event. The functions here do the work on the data (on the cluster if it
+    is remote).
+
+    A stage function that can run on a whole batch at once declares it with
+    ``accepts_batches``. On a batch StreamDoc, it is then given the stacked
+    arrays (the first axis is the event) and ``batch=True``, and must return
+    its results stacked the same way. The shape of the data doesn't tell (a
+    single image can be 3d), so it must branch on batch, for example:
+
+    >>> @accepts_batches
+    ... def crop(image, crop=None, batch=False):
+    ...     x0, x1, y0, y1 = crop
+    ...     return dict(image=image[..., y0:y1, x0:x1])
+'''
+from functools import reduce
+
+import numpy as np
+
+
+def accepts_batches(f):
+    ''' Mark f as able to run on a batch of events.'''
+    f._accepts_batches = True
+    return f
+
+
+def is_batch_stage(f):
+    ''' True if f was marked with ``accepts_batches``.'''
+    return getattr(f, '_accepts_batches', False)
+
+
+def batch_kwargs(f, sdoc, kwargs):
+    ''' The kwargs of f run on the StreamDoc sdoc: with batch=True if sdoc
+        is a batch and f accepts batches.'''
+    if is_batch_stage(f) and sdoc.get('_batch') is not None:
+        kwargs = dict(kwargs, batch=True)
+    return kwargs
+
+
+def stack(vals):
+    ''' Stack a list of values along a new first axis.
+
+        Arrays of the same shape are copied into one preallocated array of
+        their common dtype. If they are all the same array (the mask or
+        q_map of a series for example), it is broadcast instead of copied
+        (and is read only). Anything else is kept as a list.
+    '''
+    first = vals[0]
+    if isinstance(first, np.ndarray):
+        if all(val is first for val in vals):
+            # subok, a KeyedArray (a mask) keeps its key
+            return np.broadcast_to(first, (len(vals),) + first.shape,
+                                   subok=True)
+        if all(isinstance(val, np.ndarray) and val.shape == first.shape
+               for val in vals):
+            dtype = reduce(np.promote_types, (val.dtype for val in vals))
+            stacked = np.empty((len(vals),) + first.shape, dtype=dtype)
+            for i, val in enumerate(vals):
+                stacked[i] = val
+            return stacked
+    return list(vals)
+
+
+def squash_payloads(*payloads):
+    ''' Stack (args, kwargs) pairs into one (args, kwargs) pair.'''
+    allargs = [args for args, kwargs in payloads]
+    allkwargs = [kwargs for args, kwargs in payloads]
+    nargs, keys = len(allargs[0]), set(allkwargs[0])
+    for args, kwargs in payloads:
+        if len(args) != nargs or set(kwargs) != keys:
+            errormsg = "Error, can only squash StreamDocs with the same args"
+            errormsg += " and kwargs"
+            raise ValueError(errormsg)
+
+    args = [stack([elem[i] for elem in allargs]) for i in range(nargs)]
+    kwargs = {key: stack([elem[key] for elem in allkwargs])
+              for key in allkwargs[0]}
+    return args, kwargs
+
+
+def unsquash_payload(payload, i):
+    ''' Get the (args, kwargs) of the ith event of a batch.
+
+        Arrays are returned as views (no copy).
+    '''
+    args, kwargs = payload
+    return [val[i] for val in args], \
+        {key: val[i] for key, val in kwargs.items()}
+
+
+def _changed(old, new):
+    if old is new:
+        return False
+    try:
+        return not bool(old == new)
+    except Exception:
+        # arrays etc
+        return True
+
+
+def event_attributes(base, current, event):
+    ''' The attributes of one event of a batch.
+
+        These are the attributes of the event, updated with what the batch
+        stages changed (the difference between the attributes of the batch
+        when it was squashed, base, and now, current).
+    '''
+    attributes = dict(event)
+    for key, val in current.items():
+        if key not in base or _changed(base[key], val):
+            attributes[key] = val
+    return attributes
@@ -0,0 +1,274 @@
+'''
+    A byte-budgeted LRU cache for derived arrays.
+
+    The cache is split into namespaces (for example 'mask' for the masks
+    read from disk and 'binning' for the circular average binnings). Each
+    namespace has its own byte budget and evicts its least recently used
+    entries when it goes over it. The budget is the ``cache_bytes`` option
+    of scistreams.yml, either a number (for every namespace) or a dict of
+    namespace to number (with 'default' for the others).
+
+    The cache is per process, so a dask worker has its own, used by the
+    tasks it runs. Arrays that are expensive to make can also be kept on
+    disk, as .npy files loaded memory mapped (see disk_cache), so that they
+    outlive the process.
+
+    Examples
+    --------
+    >>> from SciStreams.core.cache import cache, memoize
+    >>> binning = cache['binning'].get(key)
+    >>> if binning is None:
+    ...     binning = make_binning()
+    ...     cache['binning'].put(key, binning)
+    >>> # or for functions of cheap arguments (see core/fingerprint.py)
+    >>> @memoize('mask')
+    ... def load_mask(filename):
+    ...     ...
+    >>> cache.stats()['mask']
+    {'hits': 10, 'misses': 1, 'evictions': 0, 'entries': 1, 'bytes': 1000}
+    >>> disk_cache("/tmp/maps").put(key, q_map)
+    >>> disk_cache("/tmp/maps").get(key)
+    memmap([...])
+'''
+from collections import OrderedDict
+from functools import wraps
+import hashlib
+import os
+import sys
+import threading
+
+import numpy as np
+
+from SciStreams import config
+from SciStreams.core.fingerprint import fingerprint
+from SciStreams.core.instrumentation import instrument
+
+
+def nbytes(obj):
+    ''' An estimate of the memory held by obj.
+
+        Arrays are counted by their data, containers and objects (for
+        example a Calibration) by what they hold.
+    '''
+    return _nbytes(obj, set())
+
+
+def _nbytes(obj, seen):
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    if isinstance(obj, np.ndarray):
+        # views share their data with the base
+        if obj.base is not None:
+            return _nbytes(obj.base, seen) + sys.getsizeof(obj)
+        return obj.nbytes
+    if isinstance(obj, dict):
+        return sum(_nbytes(val, seen) for val in obj.values()) + \
+            sys.getsizeof(obj)
+    if isinstance(obj, (list, tuple, set)):
+        return sum(_nbytes(val, seen) for val in obj) + sys.getsizeof(obj)
+    if hasattr(obj, '__dict__'):
+        return _nbytes(vars(obj), seen)
+    return sys.getsizeof(obj)
+
+
+class LRUCache:
+    ''' One namespace of the cache.
+
+        Parameters
+        ----------
+        max_bytes : number
+            the budget, least recently used entries are evicted to stay
+            under it
+    '''
+    def __init__(self, max_bytes, name=None):
+        self.max_bytes = max_bytes
+        self.name = name
+        self._data = OrderedDict()
+        self._sizes = dict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value, size=None):
+        ''' Cache value under key.
+
+            size is the number of bytes it holds (estimated if not given).
+            Values larger than the whole budget are not cached.
+        '''
+        if size is None:
+            size = nbytes(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            self._data[key] = value
+            self._sizes[key] = size
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes:
+                oldest = next(iter(self._data))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def _remove(self, key):
+        del self._data[key]
+        self.total_bytes -= self._sizes.pop(key)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._sizes.clear()
+            self.total_bytes = 0
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses,
+                    evictions=self.evictions, entries=len(self._data),
+                    bytes=self.total_bytes)
+
+    def __repr__(self):
+        return "LRUCache({}, {}/{} bytes)".format(self.name,
+                                                  self.total_bytes,
+                                                  self.max_bytes)
+
+
+class Cache:
+    ''' The namespaces of the cache, made on first use.'''
+    def __init__(self):
+        self._namespaces = dict()
+        self._lock = threading.Lock()
+
+    def budget(self, name):
+        ''' The byte budget of the namespace name (see cache_bytes).'''
+        cache_bytes = config.cache_bytes
+        if isinstance(cache_bytes, dict):
+            cache_bytes = cache_bytes.get(name, cache_bytes['default'])
+        return cache_bytes
+
+    def __getitem__(self, name):
+        with self._lock:
+            namespace = self._namespaces.get(name)
+            if namespace is None:
+                namespace = LRUCache(self.budget(name), name=name)
+                self._namespaces[name] = namespace
+        return namespace
+
+    def stats(self):
+        ''' The hits, misses, evictions, entries and bytes per namespace.'''
+        return {name: namespace.stats()
+                for name, namespace in self._namespaces.items()}
+
+    def clear(self):
+        for namespace in self._namespaces.values():
+            namespace.clear()
+
+
+# the cache of this process
+cache = Cache()
+
+
+class DiskCache:
+    ''' Arrays kept as .npy files in a directory.
+
+        The files are named by a hash of the key, so the keys should have a
+        stable repr (numbers, strings and tuples of them). They're loaded
+        memory mapped (read only), so only the pages used are read.
+
+        Parameters
+        ----------
+        directory : str
+            made if it doesn't exist
+    '''
+    def __init__(self, directory):
+        self.directory = directory
+
+    def filename(self, key):
+        sha = hashlib.sha1(repr(key).encode()).hexdigest()
+        return os.path.join(self.directory, sha + ".npy")
+
+    def get(self, key, default=None):
+        try:
+            return np.load(self.filename(key), mmap_mode='r')
+        except FileNotFoundError:
+            return default
+        except (OSError, ValueError) as e:
+            instrument.count('disk_cache', 'read_error')
+            instrument.log('disk_cache', "read error", key=repr(key),
+                           error=repr(e))
+            return default
+
+    def put(self, key, arr):
+        filename = self.filename(key)
+        # write then rename, so that other processes never read half a file
+        tmpname = "{}.{}.tmp".format(filename, os.getpid())
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(tmpname, "wb") as f:
+                np.save(f, arr)
+            os.replace(tmpname, filename)
+        except OSError as e:
+            instrument.count('disk_cache', 'write_error')
+            instrument.log('disk_cache', "write error", key=repr(key),
+                           error=repr(e))
+
+    def __repr__(self):
+        return "DiskCache({})".format(self.directory)
+
+
+_disk_caches = dict()
+
+
+def disk_cache(directory):
+    ''' The DiskCache of directory (one per directory and process).'''
+    with cache._lock:
+        store = _disk_caches.get(directory)
+        if store is None:
+            store = DiskCache(directory)
+            _disk_caches[directory] = store
+    return store
+
+
+def memoize(namespace):
+    ''' Cache the results of a function in namespace.
+
+        The key is the fingerprint of the arguments (see
+        core/fingerprint.py). Calls with arguments that have none are not
+        cached. The results are shared, so they must not be modified.
+    '''
+    def dec(f):
+        @wraps(f)
+        def f_new(*args, **kwargs):
+            token = fingerprint((args, kwargs))
+            if token is None:
+                return f(*args, **kwargs)
+            key = (getattr(f, '__qualname__', None),) + token
+            lru = cache[namespace]
+            result = lru.get(key, _MISSING)
+            if result is _MISSING:
+                result = f(*args, **kwargs)
+                lru.put(key, result)
+            return result
+        return f_new
+    return dec
+
+
+_MISSING = object()
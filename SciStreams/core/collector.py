@@ -0,0 +1,101 @@
+'''
+    Collect Futures as they complete.
+
+    A ``FutureCollector`` calls a function on each Future it is given once
+    that Future is done, in the order they complete. Distributed Futures are
+    waited on with one ``distributed.as_completed`` per client, consumed by
+    a thread. Local Futures (see core/local_client.py) use their done
+    callbacks. Nothing polls.
+
+    The collector counts the completions, ``throughput`` is the number of
+    Futures completed per second over the last ``window`` seconds.
+
+    Examples
+    --------
+    >>> collector = FutureCollector(print)
+    >>> collector.add(client.submit(inc, 1))
+    >>> collector.throughput()
+    12.5
+'''
+from collections import deque
+import threading
+import time
+
+from distributed import as_completed
+
+from SciStreams.core.local_client import LocalFuture
+
+
+class FutureCollector:
+    ''' Call on_done(future) for each Future added, once it's done.
+
+        Parameters
+        ----------
+        on_done : callable
+            called from the collecting thread (or the thread completing a
+            local Future), so it should be quick
+
+        window : number, optional
+            the seconds the throughput is measured over
+    '''
+    def __init__(self, on_done, window=60.):
+        self.on_done = on_done
+        self.window = window
+        self.completed = 0
+        # the completion times, over the window
+        self._times = deque()
+        # the as_completed of each client
+        self._streams = dict()
+        self._condition = threading.Condition()
+
+    def add(self, future):
+        client = getattr(future, 'client', None)
+        if isinstance(future, LocalFuture) or \
+                getattr(client, 'loop', None) is None:
+            future.add_done_callback(self._collect)
+            return
+        with self._condition:
+            stream = self._streams.get(client)
+            if stream is None:
+                stream = as_completed(loop=client.loop)
+                self._streams[client] = stream
+                thread = threading.Thread(target=self._run, args=(stream,),
+                                          name="SciStreams-collector",
+                                          daemon=True)
+                thread.start()
+            stream.add(future)
+            self._condition.notify_all()
+
+    def _run(self, stream):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: not stream.is_empty())
+            # stops when all the Futures added so far are collected
+            for future in stream:
+                self._collect(future)
+                del future
+
+    def _collect(self, future):
+        now = time.time()
+        with self._condition:
+            self.completed += 1
+            self._times.append(now)
+            self._trim(now)
+        try:
+            self.on_done(future)
+        except Exception as e:
+            print("Error collecting {} : {}".format(future.key, e))
+
+    def _trim(self, now):
+        while len(self._times) > 0 and self._times[0] < now - self.window:
+            self._times.popleft()
+
+    def throughput(self):
+        ''' The Futures completed per second, over the window.'''
+        with self._condition:
+            self._trim(time.time())
+            return len(self._times)/self.window
+
+    def __repr__(self):
+        return "FutureCollector(completed : {}, {:.2f}/s)".format(
+            self.completed, self.throughput())
@@ -0,0 +1,235 @@
+'''
+    Cheap fingerprints for dask task keys.
+
+    With pure submissions, dask tokenizes every argument to make the task
+    key, which hashes full detector images (and q-maps). The functions here
+    build keys from cheap identities instead:
+        - the datum_id (or any other small value) of unfilled data
+        - the key of a Future
+        - the uid of a StreamDoc (the event uid for data from an event)
+        - the geometry of a calibration (registered in data/Calibration.py)
+        - the key of a KeyedArray (the masks, see keyed)
+
+    Anything without a cheap identity gets a new uuid, so it is never
+    hashed, and a task that uses it gets a unique key (like pure=False).
+
+    Examples
+    --------
+    >>> key = task_key("circavg", sdoc, bins=100)
+    >>> client.submit(f, sdoc, bins=100, key=key)
+'''
+from functools import singledispatch, partial
+import hashlib
+import numbers
+import types
+from uuid import uuid4
+
+from dask.base import normalize_token
+from distributed import Future
+import numpy as np
+
+
+# arrays up to this number of bytes are cheap enough to fingerprint by value
+MAX_ARRAY_BYTES = 1024
+
+
+@singledispatch
+def fingerprint(obj):
+    ''' Return a cheap, hashable identity of obj, or None if there is none.
+
+        Register new types with ``@fingerprint.register(cls)``.
+    '''
+    return None
+
+
+@fingerprint.register(type(None))
+@fingerprint.register(bool)
+@fingerprint.register(numbers.Number)
+@fingerprint.register(str)
+def _fingerprint_value(obj):
+    return obj
+
+
+@fingerprint.register(bytes)
+def _fingerprint_bytes(obj):
+    if len(obj) > MAX_ARRAY_BYTES:
+        return None
+    return obj
+
+
+@fingerprint.register(Future)
+def _fingerprint_future(obj):
+    return 'Future', obj.key
+
+
+@fingerprint.register(tuple)
+@fingerprint.register(list)
+def _fingerprint_sequence(obj):
+    res = list()
+    for elem in obj:
+        token = fingerprint(elem)
+        if token is None:
+            return None
+        res.append(token)
+    return type(obj).__name__, tuple(res)
+
+
+@fingerprint.register(dict)
+def _fingerprint_dict(obj):
+    res = list()
+    for key, val in obj.items():
+        # typed, so that {1: x} and {'1': x} differ
+        key_token = fingerprint(key)
+        token = fingerprint(val)
+        if key_token is None or token is None:
+            return None
+        res.append(((type(key).__name__, key_token), token))
+    # the keys can be of different types, sort them by their repr
+    return 'dict', tuple(sorted(res, key=lambda item: repr(item[0])))
+
+
+@fingerprint.register(np.ndarray)
+def _fingerprint_array(obj):
+    # small arrays only, the point is to never hash an image
+    if obj.nbytes > MAX_ARRAY_BYTES or obj.dtype.hasobject:
+        return None
+    return 'ndarray', obj.dtype.str, obj.shape, obj.tobytes()
+
+
+class KeyedArray(np.ndarray):
+    ''' An array identified by a key (what it was made from), see keyed.
+
+        Views of the same data and shape (broadcast or not, like the frames
+        of a batch made by stack) keep the key. Anything else computed from
+        it is a plain array.
+    '''
+    key = None
+
+    def __array_finalize__(self, obj):
+        if isinstance(obj, KeyedArray) and obj.key is not None and \
+                _same_data(self, obj):
+            self.key = obj.key
+
+    def __array_wrap__(self, arr, *args, **kwargs):
+        result = np.ndarray.__array_wrap__(self, arr, *args, **kwargs)
+        if isinstance(result, KeyedArray):
+            result = result.view(np.ndarray)
+        return result
+
+    def __reduce__(self):
+        # pickle the key with the data, for the workers
+        reconstruct, args, state = np.ndarray.__reduce__(self)
+        return reconstruct, args, (state, self.key)
+
+    def __setstate__(self, state):
+        state, self.key = state
+        np.ndarray.__setstate__(self, state)
+
+
+def _same_data(view, arr):
+    ''' True if view has the data of arr, maybe broadcast along new leading
+        axes (or arr along the ones of view).'''
+    if view.__array_interface__['data'][0] != \
+            arr.__array_interface__['data'][0]:
+        return False
+    small, large = sorted((view, arr), key=np.ndim)
+    n = large.ndim - small.ndim
+    return large.shape[n:] == small.shape and \
+        large.strides[n:] == small.strides and \
+        all(stride == 0 for stride in large.strides[:n])
+
+
+def keyed(arr, key):
+    ''' arr as a KeyedArray identified by key (a fingerprintable value), so
+        that it's fingerprinted (and tokenized by dask) from key instead of
+        its data.'''
+    arr = np.asarray(arr).view(KeyedArray)
+    arr.key = key
+    return arr
+
+
+@fingerprint.register(KeyedArray)
+def _fingerprint_keyed_array(obj):
+    if obj.key is None:
+        return _fingerprint_array(obj)
+    # a transpose can keep the key, but not the strides
+    return 'KeyedArray', obj.key, obj.shape, obj.strides
+
+
+@normalize_token.register(KeyedArray)
+def _tokenize_keyed_array(obj):
+    token = _fingerprint_keyed_array(obj)
+    if token is None:
+        return normalize_token(obj.view(np.ndarray))
+    return normalize_token(token)
+
+
+@fingerprint.register(np.generic)
+def _fingerprint_scalar(obj):
+    return obj.item()
+
+
+@fingerprint.register(partial)
+def _fingerprint_partial(obj):
+    tokens = (fingerprint(obj.func), fingerprint(obj.args),
+              fingerprint(obj.keywords))
+    if None in tokens:
+        return None
+    return ('partial',) + tokens
+
+
+@fingerprint.register(types.FunctionType)
+@fingerprint.register(types.BuiltinFunctionType)
+def _fingerprint_function(obj):
+    # closures can carry anything, don't trust them
+    if getattr(obj, '__closure__', None) is not None:
+        return None
+    code = getattr(obj, '__code__', None)
+    if code is None:
+        # builtins
+        return 'function', getattr(obj, '__module__', None), \
+            getattr(obj, '__qualname__', repr(obj))
+    # the line number distinguishes lambdas
+    return 'function', obj.__module__, obj.__qualname__, \
+        code.co_filename, code.co_firstlineno
+
+
+def _fingerprint_or_uuid(obj):
+    token = fingerprint(obj)
+    if token is None:
+        token = 'uuid', str(uuid4())
+    return token
+
+
+def tokenize_cheap(*args, **kwargs):
+    ''' Like dask's tokenize, but from fingerprints.
+
+        Arguments without a fingerprint make the token unique.
+    '''
+    tokens = [_fingerprint_or_uuid(arg) for arg in args]
+    tokens.extend((key, _fingerprint_or_uuid(val))
+                  for key, val in sorted(kwargs.items()))
+    return hashlib.md5(repr(tokens).encode()).hexdigest()
+
+
+def task_key(name, *args, **kwargs):
+    ''' A dask key for the task name run on args and kwargs.
+
+        Parameters
+        ----------
+        name : str or callable
+            the name of the task (a function is named after its __name__)
+
+        args, kwargs :
+            the inputs to the task (or anything that identifies them)
+
+        Returns
+        -------
+        key : str
+            "name-token"
+    '''
+    if callable(name):
+        # the function itself is part of the identity, not just its name
+        args = (name,) + args
+        name = getattr(name, '__name__', 'unnamed')
+    return "{}-{}".format(name, tokenize_cheap(*args, **kwargs))
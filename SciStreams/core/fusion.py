@@ -0,0 +1,243 @@
+'''
+    Graph passes that fuse linear chains of StreamDoc stages.
+
+    A chain like the ThumbStream (blur -> crop -> resize -> select) normally
+    creates a StreamDoc and a set of Futures per stage. ``fuse_chains`` walks
+    a built streamz graph, finds such chains and replaces each of them by one
+    node that runs the whole chain as a single task on the cluster.
+'''
+from functools import partial
+import time
+
+import streamz
+from distributed import Future
+
+import SciStreams.core.StreamDoc as StreamDoc_core
+from SciStreams.core.StreamDoc import StreamDoc, _is_streamdoc, \
+    compile_mapping, _project_payload, _stage_task, _cleanexit, _record_run
+from SciStreams.core.fingerprint import task_key
+from SciStreams.core.batch import is_batch_stage
+from SciStreams.config import client
+from SciStreams import config
+
+
+def fuse_chains(*sources):
+    ''' Fuse the linear chains of StreamDoc stages downstream of sources.
+
+        A chain is a sequence of ``scs.map`` (remote), ``scs.select`` and
+        ``scs.add_attributes`` nodes, each (except the last) with exactly one
+        downstream, and each (except the first) with exactly one upstream.
+        The last node of the chain is kept (so anything connected to it is
+        left untouched) and made to run the whole chain.
+
+        Parameters
+        ----------
+        sources : Stream instances
+            the nodes to start searching from
+
+        Returns
+        -------
+        fused : list of lists of str
+            the names of the stages of each chain that was fused
+    '''
+    fused = list()
+    for chain in find_chains(*sources):
+        steps = [_stage_from_node(node) for node in chain]
+        _rewire_chain(chain, compile_chain(steps))
+        fused.append([_step_name(step) for step in steps])
+    return fused
+
+
+def find_chains(*sources):
+    ''' Find the chains that ``fuse_chains`` would fuse.
+
+        Returns a list of lists of nodes (ordered upstream to downstream).
+    '''
+    chains = list()
+    seen = set()
+    queue = list(sources)
+    while queue:
+        node = queue.pop()
+        if id(node) in seen:
+            continue
+        seen.add(id(node))
+        queue.extend(node.downstreams)
+
+        if _stage_from_node(node) is None or _in_chain(node):
+            continue
+        # node is the head of a chain
+        chain = [node]
+        while len(chain[-1].downstreams) == 1:
+            nextnode, = chain[-1].downstreams
+            if _stage_from_node(nextnode) is None or \
+                    len(nextnode.upstreams) != 1:
+                break
+            chain.append(nextnode)
+
+        steps = [_stage_from_node(elem) for elem in chain]
+        if len(chain) > 1 and any(step[0] == 'map' for step in steps):
+            chains.append(chain)
+    return chains
+
+
+def compile_chain(steps):
+    ''' Compile a list of steps into one function on StreamDocs.
+
+        steps are tuples of:
+            ('map', f, kwargs) : a (remote) StreamDoc map of f
+            ('select', projection) : a StreamDoc select (see
+                compile_mapping)
+            ('attributes', attributes) : a StreamDoc add_attributes
+    '''
+    steps = list(steps)
+    task_steps = [step for step in steps if step[0] != 'attributes']
+
+    def fused_chain(x):
+        return _fused_chain(steps, task_steps, x)
+
+    fused_chain.__name__ = _chain_name(steps)
+    return fused_chain
+
+
+def _chain_task(steps, sdoc_type, payload):
+    ''' The part of a fused chain that runs on the worker.
+
+        Runs each step on the (args, kwargs) payload in turn and returns the
+        final (args, kwargs).
+    '''
+    for step in steps:
+        if step[0] == 'select':
+            payload = _project_payload(payload, step[1])
+        else:
+            _, f, kwargs_additional = step
+            payload = _stage_task(f, sdoc_type, None, payload,
+                                  kwargs_additional=kwargs_additional)
+    return payload
+
+
+def _batch_steps(steps):
+    ''' steps run on a batch: its stages are given batch=True, up to the
+        first one that doesn't accept batches (the result isn't a batch
+        anymore).'''
+    new_steps = list()
+    batch = True
+    for step in steps:
+        if step[0] == 'map' and batch:
+            batch = is_batch_stage(step[1])
+            if batch:
+                step = 'map', step[1], dict(step[2], batch=True)
+        new_steps.append(step)
+    return new_steps
+
+
+def _fused_chain(steps, task_steps, x):
+    if _is_streamdoc(x):
+        if x.get('_batch') is not None:
+            task_steps = _batch_steps(task_steps)
+        sdoc_type = x['_StreamDoc_Type']
+        payload, projection = x._lazy_payload()
+        if projection is not None:
+            # apply the pending select in the chain task
+            task_steps = [('select', projection)] + task_steps
+        attributes = x.attributes
+        cumulative_time = x['statistics']['cumulative_time']
+    else:
+        sdoc_type = 'full'
+        payload = (x,), dict()
+        attributes = dict()
+        cumulative_time = 0.
+
+    if not isinstance(attributes, Future):
+        attributes = dict(attributes)
+        function_list = list(attributes.get('function_list', []))
+        for step in steps:
+            if step[0] == 'map':
+                function_list.append(getattr(step[1], '__name__', 'unnamed'))
+        attributes['function_list'] = function_list
+
+    streamdoc = StreamDoc(attributes=attributes, sdoc_type=sdoc_type)
+    for step in steps:
+        if step[0] == 'attributes':
+            streamdoc.add(attributes=step[1])
+
+    statistics = dict(cumulative_time=cumulative_time)
+    t1 = time.time()
+    try:
+        task = partial(_chain_task, task_steps)
+        key = task_key(_chain_name(steps), task_steps, sdoc_type, x)
+        result = client.submit(task, sdoc_type, payload, key=key)
+        statistics['status'] = "Success"
+    except Exception:
+        result = [], {}
+        _cleanexit(_chain_task, statistics)
+        if config.debug:
+            raise
+    t2 = time.time()
+    statistics['runtime'] = t2 - t1
+    statistics['runstart'] = t1
+    statistics['cumulative_time'] += statistics['runtime']
+    _record_run(_chain_name(steps), statistics)
+
+    streamdoc['statistics'] = statistics
+    streamdoc.set_payload(result)
+    # a batch stays a batch if all the stages accept batches
+    if _is_streamdoc(x) and all(is_batch_stage(step[1])
+                                for step in steps if step[0] == 'map'):
+        streamdoc['_batch'] = x.get('_batch')
+    return streamdoc
+
+
+def _stage_from_node(node):
+    ''' Return the step for a node, None if it can't be fused.'''
+    if not isinstance(node, streamz.core.map):
+        return None
+    func = node.func
+    info = getattr(func, '_streamdoc_stage', None)
+    if info is not None:
+        if info['name'] != 'map' or info['filter'] or not info['remote'] \
+                or len(node.args) > 0:
+            return None
+        return 'map', info['func'], dict(node.kwargs)
+    elif func is StreamDoc_core.select:
+        return 'select', compile_mapping(*node.args)
+    elif func is StreamDoc_core.add_attributes and len(node.args) == 0:
+        return 'attributes', dict(node.kwargs.get('attributes', {}))
+    return None
+
+
+def _in_chain(node):
+    ''' True if node continues a chain from its upstream.'''
+    if len(node.upstreams) != 1:
+        return False
+    upstream = node.upstreams[0]
+    return _stage_from_node(upstream) is not None and \
+        len(upstream.downstreams) == 1
+
+
+def _chain_name(steps):
+    return "fused_" + "_".join(_step_name(step) for step in steps)
+
+
+def _step_name(step):
+    if step[0] == 'map':
+        return getattr(step[1], '__name__', 'unnamed')
+    elif step[0] == 'select':
+        return 'select'
+    else:
+        return 'add_attributes'
+
+
+def _rewire_chain(chain, func):
+    ''' Make the last node of chain run func, directly from the upstream of
+        the first node.'''
+    head, tail = chain[0], chain[-1]
+    tail.func = func
+    tail.args = ()
+    tail.kwargs = dict()
+    if head is tail:
+        return
+    chain[-2].disconnect(tail)
+    # the head can have more than one upstream (a union for example)
+    for upstream in list(head.upstreams):
+        upstream.disconnect(head)
+        upstream.connect(tail)
@@ -0,0 +1,157 @@
+'''
+    Per-stage instrumentation: counters, timing histograms and an event log.
+
+    Everything is keyed by a stage name (usually the function name). The
+    module level ``instrument`` is what the library reports to. It is
+    disabled by default, in which case every call returns right away, so it
+    can be left in the hot path. Enable it with ``instrumentation: True`` in
+    scistreams.yml or by calling ``instrument.enable()``.
+
+    Note that the data is per process, so stages that run on dask workers
+    are recorded on the workers.
+
+    Examples
+    --------
+    >>> from SciStreams.core.instrumentation import instrument
+    >>> instrument.enable()
+    >>> # ... run the pipeline ...
+    >>> instrument.stage_stats('circavg_from_calibration')['counters']
+    {'calls': 10, 'Success': 10}
+'''
+from bisect import bisect_right
+from collections import defaultdict, deque
+import time
+
+
+# log2 spaced bin edges from ~1 us to ~1 hour (in seconds)
+_TIMING_BINS = [2.**i for i in range(-20, 13)]
+
+
+class Histogram:
+    ''' A histogram of durations (in seconds) with fixed log2 bins.'''
+    def __init__(self, bins=_TIMING_BINS):
+        self.bins = bins
+        self.counts = [0]*(len(bins) + 1)
+        self.total = 0.
+        self.num = 0
+        self.min = None
+        self.max = None
+
+    def add(self, val):
+        self.counts[bisect_right(self.bins, val)] += 1
+        self.total += val
+        self.num += 1
+        if self.min is None or val < self.min:
+            self.min = val
+        if self.max is None or val > self.max:
+            self.max = val
+
+    @property
+    def mean(self):
+        if self.num == 0:
+            return None
+        return self.total/self.num
+
+    def as_dict(self):
+        ''' Return the non-empty bins as {upper edge : count}.
+
+            The overflow bin has an upper edge of inf.
+        '''
+        edges = self.bins + [float('inf')]
+        counts = {edge: cnt for edge, cnt in zip(edges, self.counts) if cnt}
+        return dict(counts=counts, num=self.num, total=self.total,
+                    mean=self.mean, min=self.min, max=self.max)
+
+
+class Instrumentation:
+    ''' Collects counters, timings and events per stage.
+
+        Parameters
+        ----------
+        enabled : bool, optional
+            whether or not to record anything
+
+        maxevents : int, optional
+            the number of events kept in the event log (oldest are dropped)
+    '''
+    def __init__(self, enabled=False, maxevents=10000):
+        self.enabled = enabled
+        self.maxevents = maxevents
+        self.reset()
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        self.counters = defaultdict(lambda: defaultdict(int))
+        self.timings = defaultdict(dict)
+        self.eventlog = deque(maxlen=self.maxevents)
+
+    def count(self, stage, key, num=1):
+        ''' Increment counter key of stage.'''
+        if not self.enabled:
+            return
+        self.counters[stage][key] += num
+
+    def timing(self, stage, key, seconds):
+        ''' Add a duration to the histogram key of stage.'''
+        if not self.enabled:
+            return
+        hist = self.timings[stage].get(key)
+        if hist is None:
+            hist = self.timings[stage][key] = Histogram()
+        hist.add(seconds)
+
+    def log(self, stage, message, **info):
+        ''' Add an entry to the event log.'''
+        if not self.enabled:
+            return
+        self.eventlog.append(dict(time=time.time(), stage=stage,
+                                  message=message, info=info))
+
+    def record(self, stage, statistics):
+        ''' Record a stage run from its StreamDoc statistics dict.
+
+            Counts the call and its status, adds 'runtime' and
+            'delay_since_last_run' to the timing histograms, and logs failures.
+        '''
+        if not self.enabled:
+            return
+        counters = self.counters[stage]
+        counters['calls'] += 1
+        status = statistics.get('status', None)
+        if status is not None:
+            counters[status] += 1
+        for key in ('runtime', 'delay_since_last_run'):
+            if key in statistics:
+                self.timing(stage, key, statistics[key])
+        if status == "Failure":
+            self.log(stage, "failure",
+                     error_message=statistics.get('error_message', None))
+
+    def stage_stats(self, stage):
+        ''' Get the counters and timings of one stage as a dict.'''
+        timings = {key: hist.as_dict()
+                   for key, hist in self.timings.get(stage, {}).items()}
+        return dict(counters=dict(self.counters.get(stage, {})),
+                    timings=timings)
+
+    def stages(self):
+        ''' The names of all stages that recorded something.'''
+        return sorted(set(self.counters) | set(self.timings))
+
+    def summary(self):
+        ''' Get the stats of all stages, keyed by stage name.'''
+        return {stage: self.stage_stats(stage) for stage in self.stages()}
+
+    def events(self, stage=None):
+        ''' Get the logged events, optionally only for one stage.'''
+        if stage is None:
+            return list(self.eventlog)
+        return [event for event in self.eventlog if event['stage'] == stage]
+
+
+instrument = Instrumentation()
@@ -0,0 +1,239 @@
+'''
+    A local client, running tasks on a thread or process pool.
+
+    When no server is configured, the tasks were run inline by a dummy client
+    (config.LocalClient), on one core. ``PoolClient`` runs them on a
+    ``concurrent.futures`` pool instead, and returns ``LocalFuture``s. These
+    implement the part of the distributed Future API the library uses
+    (``result``, ``done``, ``status``, ``release``, ``add_done_callback``
+    and ``key``) and are instances of distributed.Future, so the rest of
+    the library treats them as remote results.
+
+    Like with distributed:
+        - Futures given as arguments (also in lists, tuples and dicts) are
+          replaced by their results. The task only starts once they're done
+          (so no pool worker is blocked waiting on another task).
+        - Submitting a key that's already running (or computed and still
+          referenced) returns the same Future.
+
+    Enable with ``local_executor: threads`` (or ``processes``) in
+    scistreams.yml, with ``local_workers`` workers. Processes are only worth
+    it for stages that hold the GIL, the data is copied to and from them.
+
+    Examples
+    --------
+    >>> client = PoolClient('threads', 4)
+    >>> future = client.submit(inc, 1)
+    >>> future2 = client.submit(inc, future)
+    >>> client.gather([future, future2])
+    [2, 3]
+'''
+from concurrent.futures import Future as ConcurrentFuture, \
+    ThreadPoolExecutor, ProcessPoolExecutor
+import threading
+from uuid import uuid4
+from weakref import WeakValueDictionary
+
+import cloudpickle
+from distributed import Future
+
+
+class LocalFuture(Future):
+    ''' The result of a task submitted to a PoolClient.
+
+        Only what the library uses of distributed.Future is implemented.
+    '''
+    def __init__(self, key, client=None):
+        # not distributed.Future.__init__, there's no scheduler to tell
+        self.key = key
+        self._client = client
+        self._future = ConcurrentFuture()
+
+    @property
+    def client(self):
+        return self._client
+
+    @property
+    def status(self):
+        if not self._future.done():
+            return 'pending'
+        if self._future.cancelled():
+            return 'cancelled'
+        if self._future.exception() is not None:
+            return 'error'
+        return 'finished'
+
+    def done(self):
+        return self._future.done()
+
+    def result(self, timeout=None):
+        return self._future.result(timeout=timeout)
+
+    def exception(self, timeout=None):
+        return self._future.exception(timeout=timeout)
+
+    def traceback(self, timeout=None):
+        exception = self._future.exception(timeout=timeout)
+        if exception is not None:
+            return exception.__traceback__
+
+    def add_done_callback(self, fn):
+        ''' Call fn(future) when done (now if it already is).'''
+        # the concurrent Future keeps its callbacks, don't keep what they
+        # reference (the dependent tasks) alive with it
+        holder = [fn]
+
+        def callback(future):
+            holder.pop()(self)
+        self._future.add_done_callback(callback)
+
+    def cancel(self):
+        return self._future.cancel()
+
+    def cancelled(self):
+        return self._future.cancelled()
+
+    def release(self):
+        ''' Forget the key, the result is dropped once no longer referenced.
+        '''
+        if self._client is not None:
+            self._client._release(self)
+
+    def _set_from(self, future):
+        ''' Copy the outcome of a concurrent Future.'''
+        try:
+            self._future.set_result(future.result())
+        except Exception as e:
+            self._future.set_exception(e)
+
+    def __del__(self):
+        pass
+
+    def __reduce__(self):
+        raise TypeError("A LocalFuture can't leave its process")
+
+    def __repr__(self):
+        return "<LocalFuture: status: {}, key: {}>".format(self.status,
+                                                          self.key)
+
+
+def _futures_in(x):
+    ''' The LocalFutures in x, looking into lists, tuples and dicts.'''
+    if isinstance(x, LocalFuture):
+        return [x]
+    if isinstance(x, dict):
+        x = list(x.values())
+    if isinstance(x, (list, tuple, set)):
+        return [future for elem in x for future in _futures_in(elem)]
+    return []
+
+
+def _resolve(x):
+    ''' x with its LocalFutures replaced by their results.'''
+    if isinstance(x, LocalFuture):
+        return x.result()
+    if isinstance(x, dict):
+        return {key: _resolve(val) for key, val in x.items()}
+    if isinstance(x, tuple) and hasattr(x, '_fields'):
+        # a namedtuple
+        return type(x)(*(_resolve(elem) for elem in x))
+    if isinstance(x, (list, tuple, set)):
+        return type(x)(_resolve(elem) for elem in x)
+    return x
+
+
+def _run_pickled(task):
+    # functions are often closures, so they're sent with cloudpickle
+    func, args, kwargs = cloudpickle.loads(task)
+    return func(*args, **kwargs)
+
+
+class PoolClient:
+    ''' A client running its tasks on a local pool.
+
+        Parameters
+        ----------
+        executor : 'threads' or 'processes'
+            the kind of pool
+
+        workers : int, optional
+            the number of workers, defaults to the number of cores
+    '''
+    def __init__(self, executor='threads', workers=None):
+        if executor == 'threads':
+            self._executor = ThreadPoolExecutor(max_workers=workers)
+        elif executor == 'processes':
+            self._executor = ProcessPoolExecutor(max_workers=workers)
+        else:
+            raise ValueError("executor must be 'threads' or 'processes', "
+                             "got {}".format(executor))
+        self.processes = executor == 'processes'
+        # the Futures by key, while they're referenced
+        self._futures = WeakValueDictionary()
+        self._lock = threading.Lock()
+
+    def submit(self, func, *args, key=None, pure=None, **kwargs):
+        ''' Run func(*args, **kwargs) on the pool, returns a LocalFuture.
+
+            key and pure are as for distributed. Without a key, every
+            submission is a new task.
+        '''
+        if key is None:
+            key = "{}-{}".format(getattr(func, '__name__', 'task'),
+                                 uuid4().hex)
+        with self._lock:
+            future = self._futures.get(key)
+            if future is not None:
+                return future
+            future = LocalFuture(key, client=self)
+            self._futures[key] = future
+
+        # start once the Futures in the arguments are done
+        dependencies = _futures_in((args, kwargs))
+        remaining = [len(dependencies)]
+        lock = threading.Lock()
+
+        def dependency_done(dependency):
+            with lock:
+                remaining[0] -= 1
+                ready = remaining[0] == 0
+            if ready:
+                self._start(future, func, args, kwargs)
+
+        if len(dependencies) == 0:
+            self._start(future, func, args, kwargs)
+        for dependency in dependencies:
+            dependency.add_done_callback(dependency_done)
+        return future
+
+    def _start(self, future, func, args, kwargs):
+        try:
+            # raises if a dependency failed
+            args, kwargs = _resolve(args), _resolve(kwargs)
+            if self.processes:
+                task = cloudpickle.dumps((func, args, kwargs))
+                result = self._executor.submit(_run_pickled, task)
+            else:
+                result = self._executor.submit(func, *args, **kwargs)
+        except Exception as e:
+            future._future.set_exception(e)
+            return
+        result.add_done_callback(future._set_from)
+
+    def gather(self, futures):
+        ''' The results of futures (a Future, or lists, tuples and dicts of
+            them). Anything else is returned as is.'''
+        return _resolve(futures)
+
+    def _release(self, future):
+        with self._lock:
+            if self._futures.get(future.key) is future:
+                del self._futures[future.key]
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+    def __repr__(self):
+        return "<PoolClient: {} {}>".format(
+            'processes' if self.processes else 'threads',
+            self._executor._max_workers)
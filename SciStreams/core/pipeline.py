@@ -0,0 +1,255 @@
+'''
+    Declarative pipelines.
+
+    A pipeline spec (a dict, or a YAML file, see load_pipeline) names the
+    stages of a graph, what each stage is made by (a factory) and which
+    stages feed it, and the sinks at its ends:
+
+        stages:
+          circavg:
+            factory: CircularAverageStream
+            inputs: [image, calibration, mask]
+          peakfind:
+            factory: PeakFindingStream
+            inputs: [circavg]
+        sinks:
+          sq:
+            factory: plot
+            input: circavg
+            kwargs: {lines: [[sqx, sqy]], scale: loglog}
+          peaks:
+            factory: hdf5
+            input: peakfind
+            enabled: false
+
+    ``Pipeline.build`` only makes the stages that an enabled sink needs. A
+    disabled analysis (or one with no sink) isn't in the graph at all, so it
+    costs nothing per event.
+
+    The factories are looked up by name in the factories given to the
+    Pipeline. A stage factory is called as ``factory(inputs, **kwargs)``,
+    with the list of the input streams, and returns the output stream (or a
+    tuple of them, named by the stage's ``outputs``, see the "name:output"
+    references). ``streams`` and ``mapping`` make stage factories from the
+    factories of XS_Streams (that return sin, sout) and from functions of
+    StreamDocs. A sink factory is called as ``factory(stream, **kwargs)``.
+
+    The stage inputs are the names of other stages, or of the source (the
+    stream given to build, "input" by default). A stage with more than one
+    input gets them zipped and merged (into one StreamDoc). A select, merge,
+    add_attributes and to_attributes stage are built in.
+
+    Examples
+    --------
+    >>> pipeline = Pipeline(load_pipeline("pipeline.yml"),
+    ...                     factories=dict(CircularAverageStream=streams(
+    ...                         CircularAverageStream), ...),
+    ...                     sinks=dict(plot=plot_sink))
+    >>> sin = sc.Stream()
+    >>> nodes = pipeline.build(sin)
+    >>> nodes['circavg']
+    <map: ...>
+'''
+import streamz
+
+import SciStreams.core.scistreams as scs
+
+
+def load_pipeline(filename):
+    ''' The pipeline spec in the YAML file filename.'''
+    import yaml
+
+    with open(filename) as f:
+        spec = yaml.safe_load(f)
+    if spec is None:
+        spec = dict()
+    return spec
+
+
+def combine(inputs):
+    ''' One stream of the inputs: the stream itself if there's one, or their
+        zipped StreamDocs merged.'''
+    if len(inputs) == 0:
+        raise ValueError("A stage needs at least one input")
+    if len(inputs) == 1:
+        return inputs[0]
+    return scs.merge(streamz.zip(*inputs))
+
+
+def streams(factory):
+    ''' The stage factory of a stream factory returning (sin, sout, ...).
+
+        The (combined) inputs are connected to sin, the outputs are
+        (sout, ...).
+    '''
+    def make_stage(inputs, **kwargs):
+        sin, *outputs = factory(**kwargs)
+        combine(inputs).connect(sin)
+        if len(outputs) == 1:
+            return outputs[0]
+        return tuple(outputs)
+    make_stage.__name__ = getattr(factory, '__name__', 'streams')
+    return make_stage
+
+
+def mapping(func, **defaults):
+    ''' The stage factory mapping func on the StreamDocs of the (combined)
+        inputs (see scs.map).
+
+        defaults are keyword arguments of scs.map (like remote), which the
+        stage's kwargs override.
+    '''
+    def make_stage(inputs, **kwargs):
+        kwargs = dict(defaults, **kwargs)
+        return scs.map(func, combine(inputs), **kwargs)
+    make_stage.__name__ = getattr(func, '__name__', 'mapping')
+    return make_stage
+
+
+def as_tuples(mapping):
+    ''' mapping with its lists made tuples (YAML has no tuples).'''
+    return tuple(tuple(m) if isinstance(m, list) else m for m in mapping)
+
+
+def _select(inputs, mapping=()):
+    return scs.select(combine(inputs), *as_tuples(mapping))
+
+
+def _merge(inputs):
+    return scs.merge(streamz.zip(*inputs))
+
+
+def _add_attributes(inputs, **attributes):
+    return scs.add_attributes(combine(inputs), **attributes)
+
+
+def _to_attributes(inputs):
+    return scs.to_attributes(combine(inputs))
+
+
+BUILTIN_FACTORIES = dict(select=_select, merge=_merge,
+                         add_attributes=_add_attributes,
+                         to_attributes=_to_attributes)
+
+
+def _parse_ref(ref):
+    ''' The (stage, output) of an input reference "stage" or
+        "stage:output".'''
+    name, _, output = ref.partition(":")
+    return name, output or None
+
+
+class Pipeline:
+    ''' A graph of stages and sinks, built from a spec (see the module
+        docstring).
+
+        Parameters
+        ----------
+        spec : dict
+            with 'stages' and 'sinks' (see load_pipeline)
+
+        factories : dict, optional
+            the stage factories by name (on top of the built in ones)
+
+        sinks : dict, optional
+            the sink factories by name
+
+        source : str, optional
+            the name the stages refer to the source stream by
+    '''
+    def __init__(self, spec, factories=None, sinks=None, source='input'):
+        self.spec = spec
+        self.stages = dict(spec.get('stages', None) or dict())
+        self.sinks = dict(spec.get('sinks', None) or dict())
+        self.factories = dict(BUILTIN_FACTORIES)
+        if factories is not None:
+            self.factories.update(factories)
+        self.sink_factories = dict(sinks or dict())
+        self.source = source
+
+    def enabled_sinks(self, enabled=None):
+        ''' The names of the sinks to build.
+
+            enabled (a list of names) overrides the spec.
+        '''
+        if enabled is not None:
+            for name in enabled:
+                if name not in self.sinks:
+                    raise KeyError("Unknown sink {}".format(name))
+            return list(enabled)
+        return [name for name, sink in self.sinks.items()
+                if sink.get('enabled', True)]
+
+    def needed(self, enabled=None):
+        ''' The stages the enabled sinks need, in the order they're built
+            (every stage after its inputs).'''
+        order = list()
+        visiting = set()
+
+        def visit(name, parent):
+            if name == self.source or name in order:
+                return
+            if name not in self.stages:
+                raise KeyError("{} refers to unknown stage {}".format(parent,
+                                                                    name))
+            if name in visiting:
+                raise ValueError("Cycle in the pipeline at stage "
+                                 "{}".format(name))
+            visiting.add(name)
+            for ref in self.stages[name].get('inputs', []):
+                visit(_parse_ref(ref)[0], name)
+            visiting.discard(name)
+            order.append(name)
+
+        for name in self.enabled_sinks(enabled):
+            visit(_parse_ref(self.sinks[name]['input'])[0], name)
+        return order
+
+    def build(self, source, enabled=None):
+        ''' Build the stages and sinks needed by the enabled sinks,
+            downstream of source.
+
+            Returns
+            -------
+            nodes : dict
+                the output stream of each stage built, by name (and
+                "name:output" for the named outputs)
+        '''
+        nodes = {self.source: source}
+        for name in self.needed(enabled):
+            nodes.update(self._build_stage(name, nodes))
+        for name in self.enabled_sinks(enabled):
+            sink = self.sinks[name]
+            factory = self._factory(self.sink_factories, sink, name)
+            factory(nodes[sink['input']], **sink.get('kwargs', {}))
+        return nodes
+
+    def _build_stage(self, name, nodes):
+        stage = self.stages[name]
+        factory = self._factory(self.factories, stage, name)
+        inputs = [nodes[ref] for ref in stage.get('inputs', [])]
+        result = factory(inputs, **stage.get('kwargs', {}))
+        output_names = stage.get('outputs', None)
+        if output_names is None:
+            return {name: result}
+        if not isinstance(result, tuple) or \
+                len(result) != len(output_names):
+            raise ValueError("Stage {} has outputs {}, its factory gave "
+                             "{}".format(name, output_names, result))
+        built = {"{}:{}".format(name, output): node
+                 for output, node in zip(output_names, result)}
+        # the first output is the stage itself
+        built[name] = result[0]
+        return built
+
+    @staticmethod
+    def _factory(factories, spec, name):
+        try:
+            return factories[spec['factory']]
+        except KeyError:
+            raise KeyError("No factory {} (for {})".format(
+                spec.get('factory', None), name))
+
+    def __repr__(self):
+        return "Pipeline({} stages, sinks : {})".format(
+            len(self.stages), self.enabled_sinks())
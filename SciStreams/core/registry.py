@@ -0,0 +1,243 @@
+'''
+    A registry of the remote results (Futures) the library keeps.
+
+    A result on the cluster is kept in memory for as long as a Future of it
+    is referenced. The registry holds these references on behalf of an
+    owner: the run (start uid), the stage and the sink that made them. It
+    lets go of them:
+        - when they're done, for results that are only computed for their
+          side effects (the sinks)
+        - for held results (kept so that later tasks with the same key
+          reuse them, like the calibrations), when the owning run stops,
+          after ``futures_ttl`` seconds, or when more than
+          ``max_held_futures`` are held (the oldest go first). These are
+          checked on every ``track`` and ``stats``
+
+    so that the memory used on the cluster stays flat over long runs.
+    ``stats`` reports what is held, including the bytes, and the number of
+    results completed per second.
+
+    The completions are collected by a FutureCollector (see
+    core/collector.py). The results that failed go to ``errors``, as
+    ``FailedResult``s.
+
+    Examples
+    --------
+    >>> futures_registry.track(future, run=start_uid, stage="circavg",
+    ...                        sink="store_results")
+    >>> futures_registry.track(calibration, run=start_uid,
+    ...                        stage="calibration", hold=True)
+    >>> futures_registry.release_run(start_uid)
+    >>> futures_registry.stats()
+    {'pending': 10, 'held': 1, 'total': 1000, 'errors': 0,
+     'throughput': 12.5, 'bytes': 29500000,
+     'stages': {'circavg': 10, 'calibration': 1}}
+    >>> futures_registry.errors.popleft()
+    FailedResult(key='eval_func-...', owner=Owner(run='...',
+                 stage='circavg', sink='store_results'),
+                 exception=ValueError(...), traceback='...', time=...)
+'''
+from collections import OrderedDict, deque, namedtuple, Counter
+import threading
+import time
+import traceback
+
+from distributed import Future
+
+from SciStreams import config
+from SciStreams.core.backpressure import futures_of
+from SciStreams.core.cache import nbytes
+from SciStreams.core.collector import FutureCollector
+from SciStreams.core.instrumentation import instrument
+from SciStreams.core.local_client import LocalFuture
+
+
+Owner = namedtuple('Owner', ['run', 'stage', 'sink'])
+FailedResult = namedtuple('FailedResult', ['key', 'owner', 'exception',
+                                           'traceback', 'time'])
+
+
+class FutureRegistry:
+    ''' Keep Futures on behalf of their owner, and release them.
+
+        Parameters
+        ----------
+        ttl : number, optional
+            seconds a held Future is kept. Defaults to futures_ttl
+
+        max_held : int, optional
+            the number of held Futures kept. Defaults to max_held_futures
+
+        name : str, optional
+            for the messages
+    '''
+    def __init__(self, ttl=None, max_held=None, name=None):
+        self._ttl = ttl
+        self._max_held = max_held
+        self.name = name
+        # the Futures computing, by id, with their owner
+        self._pending = dict()
+        # the held Futures, by key, oldest first
+        self._held = OrderedDict()
+        # the FailedResults of the Futures that failed, latest last
+        self.errors = deque(maxlen=1000)
+        self.total = 0
+        self._condition = threading.Condition()
+        self._collector = FutureCollector(self._done)
+
+    @property
+    def ttl(self):
+        return config.futures_ttl if self._ttl is None else self._ttl
+
+    @property
+    def max_held(self):
+        if self._max_held is None:
+            return config.max_held_futures
+        return self._max_held
+
+    def track(self, x, run=None, stage=None, sink=None, hold=False):
+        ''' Keep the Futures in x (a Future, StreamDoc, or list, tuple or
+            dict of them) for their owner.
+
+            Unless hold is True, they're released when they're done.
+            x is returned.
+        '''
+        owner = Owner(run, stage, sink)
+        futures = [future for future in futures_of(x)
+                   if isinstance(future, Future)]
+        now = time.time()
+        with self._condition:
+            for future in futures:
+                self.total += 1
+                if hold:
+                    self._held.pop(future.key, None)
+                    self._held[future.key] = future, owner, now
+                else:
+                    self._pending[id(future)] = future, owner
+        self.expire()
+        if not hold:
+            for future in futures:
+                self._collector.add(future)
+        return x
+
+    def _done(self, future):
+        # the reference is dropped right away, which releases the result
+        with self._condition:
+            _, owner = self._pending.pop(id(future), (None, None))
+        stage = owner.stage if owner is not None else None
+        if future.status == 'error':
+            failed = _failed_result(future, owner)
+            # the error itself is kept in errors
+            instrument.count(stage, 'error')
+            instrument.log(stage, "error", key=future.key,
+                           exception=repr(failed.exception))
+            self.errors.append(failed)
+        else:
+            instrument.count(stage, 'completed')
+        with self._condition:
+            self._condition.notify_all()
+
+    def throughput(self):
+        ''' The results completed per second (over the last minute).'''
+        return self._collector.throughput()
+
+    def expire(self):
+        ''' Release the held Futures that are too old, or too many.'''
+        ttl, max_held = self.ttl, self.max_held
+        oldest = time.time() - ttl if ttl is not None else None
+        with self._condition:
+            while len(self._held) > 0:
+                future, owner, t = next(iter(self._held.values()))
+                if (max_held is None or len(self._held) <= max_held) and \
+                        (oldest is None or t >= oldest):
+                    break
+                self._held.popitem(last=False)
+
+    def release_run(self, run):
+        ''' Release the held Futures of the run (when it stops).
+
+            The ones still computing are released when they're done.
+        '''
+        with self._condition:
+            keys = [key for key, (future, owner, t) in self._held.items()
+                    if owner.run == run]
+            for key in keys:
+                del self._held[key]
+
+    def release(self, x):
+        ''' Stop holding the Futures in x.'''
+        with self._condition:
+            for future in futures_of(x):
+                self._held.pop(getattr(future, 'key', None), None)
+
+    def wait(self, timeout=None):
+        ''' Block until all the tracked Futures are done.
+
+            Returns False if it timed out.
+        '''
+        with self._condition:
+            return self._condition.wait_for(lambda: len(self._pending) == 0,
+                                            timeout=timeout)
+
+    def __len__(self):
+        ''' The number of Futures computing.'''
+        return len(self._pending)
+
+    def nbytes(self):
+        ''' The bytes of the held results (that are done).'''
+        with self._condition:
+            futures = [future for future, owner, t in self._held.values()
+                       if future.done()]
+        return _nbytes_of(futures)
+
+    def stats(self):
+        self.expire()
+        with self._condition:
+            stages = Counter(owner.stage
+                             for future, owner in self._pending.values())
+            stages.update(owner.stage
+                          for future, owner, t in self._held.values())
+            stats = dict(pending=len(self._pending), held=len(self._held),
+                         total=self.total, errors=len(self.errors),
+                         throughput=self.throughput(), stages=dict(stages))
+        stats['bytes'] = self.nbytes()
+        return stats
+
+    def __repr__(self):
+        return "FutureRegistry({}, pending : {}, held : {})".format(
+            self.name, len(self._pending), len(self._held))
+
+
+def _failed_result(future, owner):
+    tb = future.traceback()
+    if tb is not None:
+        tb = "".join(traceback.format_tb(tb))
+    return FailedResult(future.key, owner, future.exception(), tb,
+                        time.time())
+
+
+def _nbytes_of(futures):
+    ''' The bytes of the results of futures.
+
+        Local results are measured, distributed ones are asked to the
+        scheduler.
+    '''
+    total = 0
+    remote = dict()
+    for future in futures:
+        if isinstance(future, LocalFuture):
+            if future.status == 'finished':
+                total += nbytes(future.result())
+        else:
+            remote.setdefault(future.client, list()).append(future.key)
+    for client, keys in remote.items():
+        try:
+            total += sum(client.nbytes(keys=keys, summary=False).values())
+        except Exception:
+            # not known to (or not supported by) this scheduler
+            pass
+    return total
+
+
+# the results kept by the library
+futures_registry = FutureRegistry(name="results")
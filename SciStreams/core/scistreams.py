@@ -3,13 +3,16 @@ from functools import wraps
 import streamz
 from SciStreams.core.StreamDoc import psdm, psda
 import SciStreams.core.StreamDoc as StreamDoc_core
+from SciStreams.core.fingerprint import task_key
 from SciStreams.config import client
+from SciStreams import config
 
 
 def future_wrapper(f):
     @wraps(f)
     def f_new(*args, **kwargs):
-        return client.submit(f, *args, **kwargs)
+        return client.submit(f, *args, key=task_key(f, *args, **kwargs),
+                             **kwargs)
     return f_new
 
 
@@ -35,33 +38,77 @@ def squash(child):
     return streamz.map(child, StreamDoc_core.squash)
 
 
+def unsquash(child):
+    ''' Split batch StreamDocs (see squash) back into one per event.'''
+    return streamz.map(child, StreamDoc_core.unsquash).concat()
+
+
+def _is_async(remote, asynchronous):
+    # only local stages block on their inputs
+    if asynchronous is None:
+        asynchronous = config.asynchronous
+    return asynchronous and not remote
+
+
 def map(func, child, args=(), input_info=None,
-        output_info=None, remote=True, **kwargs):
+        output_info=None, remote=True, fused=None, asynchronous=None,
+        max_in_flight=None, **kwargs):
     # mapping wrapper for StreamDoc's
     # TODO : use input_info and output_info
     # this makes a future at the f(*args, **kwargs) level *not* the StreamDoc
     # level
-    return child.map(psdm(func, remote=remote), *args, **kwargs)
+    # max_in_flight : cap the number of results still computing (see
+    # limit)
+    if _is_async(remote, asynchronous):
+        from SciStreams.core.asynchronous import map_async
+        sout = map_async(child, psdm(func, remote=False), *args, **kwargs)
+    else:
+        sout = child.map(psdm(func, remote=remote, fused=fused), *args,
+                         **kwargs)
+    if max_in_flight is not None:
+        sout = limit(sout, max_in_flight)
+    return sout
 
 
 def sink(func, child, args=(), input_info=None,
-         output_info=None, remote=True, **kwargs):
+         output_info=None, remote=True, fused=None, asynchronous=None,
+         **kwargs):
     # mapping wrapper for StreamDoc's
     # TODO : use input_info and output_info
-    return child.sink(psdm(func, remote=remote), *args, **kwargs)
+    if _is_async(remote, asynchronous):
+        from SciStreams.core.asynchronous import sink_async
+        return sink_async(child, psdm(func, remote=False), *args, **kwargs)
+    return child.sink(psdm(func, remote=remote, fused=fused), *args,
+                      **kwargs)
 
 
 def accumulate(func, child, args=(), input_info=None,
-               output_info=None, remote=True,
+               output_info=None, remote=True, fused=None,
                **kwargs):
     # mapping wrapper for StreamDoc's
     # TODO : use input_info and output_info
-    return child.accumulate(psda(func, remote=remote), *args, **kwargs)
+    return child.accumulate(psda(func, remote=remote, fused=fused), *args,
+                            **kwargs)
+
+
+def limit(child, max_in_flight=None, backpressure=None):
+    ''' Block the stream while too many of its results are still computing.
+
+        Give either max_in_flight or a Backpressure (to share the cap with
+        other stages), see core/backpressure.py.
+    '''
+    from SciStreams.core.backpressure import Backpressure, limit
+    if backpressure is None:
+        backpressure = Backpressure(max_in_flight,
+                                    name=getattr(child, 'name', None))
+    return limit(child, backpressure)
 
 
 # wrapper functions into a stream
 def select(child, *mapping):
-    return streamz.map(child, StreamDoc_core.select, *mapping)
+    # parse the mapping once, not for every StreamDoc
+    projection = StreamDoc_core.compile_mapping(*mapping)
+    return streamz.map(child, StreamDoc_core.select, projection)
 
 
 def merge(child):
@@ -87,8 +134,9 @@ def to_attributes(child):
     return streamz.map(child, StreamDoc_core.to_attributes)
 
 
-def to_event_stream(child):
-    s2 = child.map(StreamDoc_core.to_event_stream, tolist=True).concat()
+def to_event_stream(child, bundle=False):
+    s2 = child.map(StreamDoc_core.to_event_stream, tolist=True,
+                   bundle=bundle).concat()
     return s2
 
 
@@ -1,8 +1,14 @@
+from concurrent.futures import ThreadPoolExecutor
+import copy
+import time
 import numpy as np
 # Calibration
 # import Calibration for the calibration object
 from dask.base import normalize_token
-from ..processing.numerical import roundbydigits
+from ..core.instrumentation import instrument
+from ..core.fingerprint import fingerprint
+from ..core.cache import cache, disk_cache
+from .. import config
 
 
 class CalibrationBase(object):
@@ -13,14 +19,35 @@ class CalibrationBase(object):
 
     This class may also store other information about the experimental setup
     (such as beam size and beam divergence).
+
+    The maps are computed when first used, one at a time, with the precision
+    dtype (np.float32 halves their memory). They're cached by geometry (see
+    geometry) in the 'calibration' namespace of the cache, and in the
+    calibration_cache_dir directory if it is set, so calibrations of the same
+    geometry share them.
+
+    With a master_margin, the maps that the beam center only translates
+    (r_map, and q_map for an untilted detector) are sliced from a master map
+    twice the size of the image, shared by all the beam centers within
+    master_margin pixels of the image. A beam center scan then computes one
+    map instead of one per frame. Integer beam centers are exact. For
+    sub-pixel beam centers, r_map is computed exactly (which is cheaper than
+    interpolating it), while q_map is interpolated (bilinearly) from the
+    master map, which is off by up to the q of about 0.15 pixel next to the
+    beam center, and by much less further out. The interpolated maps are
+    approximate, so their calibrations are fingerprinted apart from exact
+    ones (see interpolation).
     '''
 
     def __init__(self, wavelength_A=None, distance_m=None, pixel_size_um=None,
-                 width=None, height=None, x0=None, y0=None):
+                 width=None, height=None, x0=None, y0=None, dtype=np.float64,
+                 master_margin=None):
 
         self.wavelength_A = wavelength_A
         self.distance_m = distance_m
         self.pixel_size_um = pixel_size_um
+        self.dtype = np.dtype(dtype)
+        self.master_margin = master_margin
         msg = "calibration:\n"
         msg += "got wavelength : {}".format(wavelength_A)
         msg += "got distance : {}".format(distance_m)
@@ -170,6 +197,9 @@ class CalibrationBase(object):
         self.qy_map_data = None
         self.qz_map_data = None
         self.qr_map_data = None
+        self.qn_map_data = None
+        self.FPol_map_data = None
+        self.FSA_map_data = None
 
     @property
     def r_map(self):
@@ -179,15 +209,136 @@ class CalibrationBase(object):
         if self.r_map_data is not None:
             return self.r_map_data
 
-        x = np.arange(self.width) - self.x0
-        y = np.arange(self.height) - self.y0
-        X, Y = np.meshgrid(x, y)
-        R = np.sqrt(X**2 + Y**2)
-
-        self.r_map_data = R
+        data = self._translated_map('r')
+        if data is None:
+            data = self._cached_map('r', self._calc_r_map)
+        self.r_map_data = data
 
         return self.r_map_data
 
+    def _calc_r_map(self):
+        # broadcast the coordinates instead of keeping meshgrids of them
+        x = np.arange(self.width, dtype=self.dtype) - self.x0
+        y = np.arange(self.height, dtype=self.dtype) - self.y0
+        R = np.hypot(x[np.newaxis, :], y[:, np.newaxis])
+        return R.astype(self.dtype, copy=False)
+
+    def geometry(self):
+        '''The rounded geometry the maps are computed from, which keys
+        them.'''
+        return (self.wavelength_A, self.distance_m, self.pixel_size_um,
+                self.width, self.height, _round(self.x0), _round(self.y0),
+                self.dtype.str)
+
+    def _cached_map(self, name, calc):
+        '''The map name for this geometry, from the cache, or else made with
+        calc() and cached (the maps are shared, so they're read only).'''
+        key = (type(self).__name__, name) + self.geometry()
+        lru = cache['calibration']
+        data = lru.get(key)
+        if data is not None:
+            return data
+
+        cache_dir = config.calibration_cache_dir
+        store = disk_cache(cache_dir) if cache_dir is not None else None
+        if store is not None:
+            data = store.get(key)
+        if data is None:
+            data = calc()
+            data.flags.writeable = False
+            if store is not None:
+                store.put(key, data)
+        lru.put(key, data)
+        return data
+
+    def _compute_map(self, name):
+        if name == 'r':
+            return self._calc_r_map()
+        raise ValueError("Unknown map {}".format(name))
+
+    # the maps of generate_map (see Calibration), besides r
+    _MAPS = dict()
+
+    def _is_translated(self, name):
+        '''Whether the beam center only translates the map name.'''
+        return name == 'r'
+
+    def _master_offset(self):
+        '''The integer part of the beam center, if the maps can be sliced
+        from a master map (see the class docstring), or else None.'''
+        margin = self.master_margin
+        if margin is None:
+            return None
+        (w, h) = (self.width, self.height)
+        ix, iy = int(np.floor(self.x0)), int(np.floor(self.y0))
+        if not (-margin <= ix < w + margin and -margin <= iy < h + margin):
+            return None
+        return ix, iy
+
+    def _is_interpolated(self, name):
+        '''Whether the map name is interpolated from a master map.'''
+        offset = self._master_offset()
+        if offset is None or not self._is_translated(name):
+            return False
+        # r is cheaper to compute exactly than to interpolate
+        return name != 'r' and (self.x0, self.y0) != offset
+
+    def interpolation(self):
+        '''What the fingerprints add for the maps interpolated from a
+        master map (see the class docstring): () if there are none, else
+        the master_margin, so that the approximate maps don't share the
+        task keys of exact ones.'''
+        names = ['r'] + list(self._MAPS)
+        if any(self._is_interpolated(name) for name in names):
+            return (('master_margin', self.master_margin),)
+        return ()
+
+    def _translated_map(self, name):
+        '''The map name sliced from the master map (see the class
+        docstring), or None if it can't be (or if it's computed
+        exactly).'''
+        offset = self._master_offset()
+        if offset is None or not self._is_translated(name):
+            return None
+        ix, iy = offset
+        a, b = self.x0 - ix, self.y0 - iy
+        if name == 'r' and (a != 0 or b != 0):
+            return None
+
+        (w, h) = (self.width, self.height)
+        margin = self.master_margin
+        master = self._master_map(name)
+        # the master is centered on the offset (0, 0) from the beam center
+        cx, cy = w + margin, h + margin
+
+        # the rows and columns at the offsets (i - iy - 1 ... i - iy) and
+        # (j - ix - 1 ... j - ix) from the beam center
+        data = master[cy - iy - 1:cy - iy + h, cx - ix - 1:cx - ix + w]
+
+        # interpolate the fractional part of the beam center, one axis at a
+        # time (on integer ones, the map is a view of the master)
+        if a == 0:
+            data = data[:, 1:]
+        else:
+            data = (1 - a)*data[:, 1:] + a*data[:, :-1]
+        if b == 0:
+            data = data[1:]
+        else:
+            data = (1 - b)*data[1:] + b*data[:-1]
+        return data.astype(self.dtype, copy=False)
+
+    def _master_map(self, name):
+        '''The master map of name (cached like the other maps).'''
+        margin = self.master_margin
+        (w, h) = (self.width, self.height)
+        master = copy.copy(self)
+        master.clear_maps()
+        master.master_margin = None
+        master.set_image_size(2*(w + margin) + 1, 2*(h + margin) + 1)
+        master.set_beam_position(w + margin, h + margin)
+        return master._cached_map(name,
+                                  lambda: master._compute_map(name))
+
     def q_map(self):
         msg = "Error : subclass this class and implement this"
         raise NotImplementedError(msg)
@@ -215,35 +366,33 @@ class CalibrationBase(object):
 
 @normalize_token.register(CalibrationBase)
 def tokenize_calibration_base(self):
-    # function to allow for intelligent caching
-    # all all computations of data and submethods
-    # need to specify pure=True flag
-    args = [self.wavelength_A, self.distance_m]
-    args.append(self.pixel_size_um)
-    if self.width is not None:
-        args.append(self.width)
-    if self.height is not None:
-        args.append(self.height)
-
-    # round these by 3 digits
-    if self.x0 is not None:
-        args.append(roundbydigits(self.x0, 3))
-    if self.y0 is not None:
-        args.append(roundbydigits(self.y0, 3))
-    if self.angle_map_data is not None:
-        args.append(roundbydigits(self.angle_map_data, 3))
-    if self.q_map_data is not None:
-        args.append(roundbydigits(self.q_map_data, 3))
-    if self.qr_map_data is not None:
-        args.append(roundbydigits(self.qr_map_data, 3))
-    if self.qx_map_data is not None:
-        args.append(roundbydigits(self.qx_map_data, 3))
-    if self.qy_map_data is not None:
-        args.append(roundbydigits(self.qy_map_data, 3))
-    if self.qz_map_data is not None:
-        args.append(roundbydigits(self.qz_map_data, 3))
-
-    return normalize_token(args)
+    ''' The token of the calibration, for dask.
+
+        A calibration is identified by its geometry alone (see geometry), the
+        maps are derived from it. This keeps tokenizing a calibration cheap,
+        whatever maps it holds.
+    '''
+    return normalize_token(fingerprint_calibration_base(self))
+
+
+@fingerprint.register(CalibrationBase)
+def fingerprint_calibration_base(self):
+    ''' The geometry of the calibration, used for task keys.
+
+        The maps are computed from the geometry, so they're left out (they
+        are never hashed), but whether some are interpolated isn't (see
+        interpolation).
+    '''
+    return ('CalibrationBase',) + CalibrationBase.geometry(self) + \
+        self.interpolation()
+
+
+def _round(x, decimals=3):
+    ''' x rounded to decimals (a beam center or angle), as a float so that
+        the keys have a stable repr.'''
+    if x is None:
+        return None
+    return round(float(x), decimals)
 
 
 class Calibration(CalibrationBase):
@@ -286,7 +435,8 @@ class Calibration(CalibrationBase):
     """
     def __init__(self, wavelength_A=None, distance_m=None, pixel_size_um=None,
                  x0=None, y0=None, width=None, height=None, det_orient=0.,
-                 det_tilt=0., det_phi=0., incident_angle=0., sample_normal=0.):
+                 det_tilt=0., det_phi=0., incident_angle=0., sample_normal=0.,
+                 dtype=np.float64, master_margin=None):
 
         self.det_orient = det_orient
         self.det_tilt = det_tilt
@@ -300,7 +450,8 @@ class Calibration(CalibrationBase):
                                           distance_m=distance_m,
                                           pixel_size_um=pixel_size_um,
                                           height=height, width=width, x0=x0,
-                                          y0=y0)
+                                          y0=y0, dtype=dtype,
+                                          master_margin=master_margin)
 
     # Experimental parameters
     def set_angles(self, det_orient=0, det_tilt=0, det_phi=0,
@@ -320,110 +471,181 @@ class Calibration(CalibrationBase):
     # Maps
     ########################################
 
+    # the attribute each map is kept in
+    _MAPS = dict(q='q_map_data', angle='angle_map_data', qx='qx_map_data',
+                 qy='qy_map_data', qz='qz_map_data', qr='qr_map_data',
+                 qn='qn_map_data', FPol='FPol_map_data', FSA='FSA_map_data')
+
+    def _get_map(self, name):
+        data = getattr(self, self._MAPS[name])
+        if data is None:
+            data = self.generate_map(name)
+        return data
+
     @property
     def q_map(self):
         '''Returns a 2D map of the q-value associated with each pixel position
         in the detector image.'''
-
-        if self.q_map_data is None:
-            self.generate_maps()
-
-        return self.q_map_data
+        return self._get_map('q')
 
     @property
     def angle_map(self):
         '''Returns a map of the angle for each pixel (w.r.t. origin).
         0 degrees is vertical, +90 degrees is right, -90 degrees is left.'''
-
-        if self.angle_map_data is not None:
-            self.generate_maps()
-
-        return self.angle_map_data
+        return self._get_map('angle')
 
     @property
     def qx_map(self):
-        if self.qx_map_data is None:
-            self.generate_maps()
-
-        return self.qx_map_data
+        return self._get_map('qx')
 
     @property
     def qy_map(self):
-        if self.qy_map_data is None:
-            self.generate_maps()
-
-        return self.qy_map_data
+        return self._get_map('qy')
 
     @property
     def qz_map(self):
-        if self.qz_map_data is None:
-            self.generate_maps()
-
-        return self.qz_map_data
+        return self._get_map('qz')
 
     @property
     def qr_map(self):
-        if self.qr_map_data is None:
-            self.generate_maps()
+        return self._get_map('qr')
+
+    @property
+    def qn_map(self):
+        return self._get_map('qn')
 
-        return self.qr_map_data
+    @property
+    def FPol_map(self):
+        '''The polarization correction factor of each pixel.'''
+        return self._get_map('FPol')
+
+    @property
+    def FSA_map(self):
+        '''The solid angle correction factor of each pixel.'''
+        return self._get_map('FSA')
 
     # r_map already defined in parent object
 
-    def generate_maps(self):
+    def generate_maps(self, *names):
         """
-        calculate all coordinates (pixel position as well as various derived
-        values) all coordinates are stored in 2D arrays, as is the data itself
-        in Data2D
+        calculate the maps names (all of them if none are given, see _MAPS).
+
+        Each map is otherwise computed when first used.
+        """
+        if len(names) == 0:
+            names = list(self._MAPS)
+        for name in names:
+            if name == 'r':
+                self.r_map
+            else:
+                self._get_map(name)
+        instrument.count('generate_maps', 'calls')
+
+    def generate_map(self, name):
         """
-        print("Generating qmaps (expensive computation)")
+        calculate the map name (see _MAPS), keep it and return it.
+
+        The pixel coordinates are broadcast over the image, and only the
+        values name needs are computed.
+        """
+        if name not in self._MAPS:
+            raise ValueError("Unknown map {}, choose from "
+                             "{}".format(name, list(self._MAPS)))
+        data = self._translated_map(name)
+        if data is None:
+            data = self._cached_map(name, lambda: self._calc_map(name))
+        setattr(self, self._MAPS[name], data)
+        return data
+
+    def _compute_map(self, name):
+        if name in self._MAPS:
+            return self._calc_map(name)
+        return super(Calibration, self)._compute_map(name)
+
+    def _is_translated(self, name):
+        # untilted, the detector is only rotated about the beam, which
+        # leaves q (a function of the distance to the beam center) as is
+        if name == 'q' and self.det_tilt == 0:
+            return True
+        return super(Calibration, self)._is_translated(name)
+
+    def _calc_map(self, name):
+        t1 = time.time()
         self.calc_rot_matrix()
 
         (w, h) = (self.width, self.height)
-        # y is columnds, x is rows
-        self.Y, self.X = np.meshgrid(np.arange(h), np.arange(w), indexing='ij')
-        X = self.X.ravel()
-        Y = self.Y.ravel()
-
-        (Q, Phi, Qx, Qy, Qz, Qr, Qn, FPol, FSA) = \
-            self.calc_from_XY(X, Y, calc_cor_factors=True)
-
-        self.q_map_data = Q.reshape((h, w))
-
-        self.qx_map_data = Qx.reshape((h, w))
-        self.qy_map_data = Qy.reshape((h, w))
-        self.qz_map_data = Qz.reshape((h, w))
-
-        self.qr_map_data = Qr.reshape((h, w))
-        self.qz_map_data = Qn.reshape((h, w))
-        self.angle_map_data = np.degrees(Phi.reshape((h, w)))
-        self.FPol_map_data = FPol.reshape((h, w))
-        self.FSA_map_data = FSA.reshape((h, w))
+        data = np.empty((h, w), dtype=self.dtype)
+        # y is columns, x is rows
+        X = np.arange(w)[np.newaxis, :]
+
+        def calc_block(rows):
+            Y = np.arange(rows.start, rows.stop)[:, np.newaxis]
+            data[rows] = self.calc_map_from_XY(name, X, Y)
+
+        # blocks of rows, so the temporaries are of the size of a block
+        self._run_blocks(calc_block, h, max(1, self.block_pixels//max(w, 1)))
+        instrument.count('generate_maps', name)
+        instrument.timing('generate_maps', 'runtime', time.time() - t1)
+        return data
+
+    def geometry(self):
+        '''The rounded geometry, including the detector orientation.'''
+        return super(Calibration, self).geometry() + \
+            (_round(self.det_orient), _round(self.det_tilt),
+             _round(self.det_phi), _round(self.incident_angle),
+             _round(self.sample_normal))
+
+    # the pixels computed at once, which bounds the memory of the
+    # temporaries of the calculations
+    block_pixels = 2**18
+
+    def _run_blocks(self, calc_block, n, step):
+        """
+        run calc_block(block) for the slices of range(n) of size step, on the
+        calibration_threads threads (numpy releases the GIL)
+        """
+        blocks = [slice(i, min(i + step, n)) for i in range(0, n, step)]
+        threads = config.calibration_threads
+        if threads is None or threads <= 1 or len(blocks) <= 1:
+            for block in blocks:
+                calc_block(block)
+            return
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            # raises the first error
+            list(executor.map(calc_block, blocks))
 
     # q calculation
     def calc_from_XY(self, X, Y, calc_cor_factors=False):
         """
         calculate Q values from pixel positions X and Y
-        X and Y are 1D arrays
+        X and Y are arrays (or numbers) that broadcast together, the results
+        have their broadcast shape
         returns reciprocal/angular coordinates, optionally returns
         always calculates Qr and Qn, therefore incident_angle needs to be set
         Note that Phi is saved in radians; but the angles in ExpPara are in
         degrees
+        The pixels are computed in blocks of block_pixels, into the returned
+        arrays
         """
-        if self.rot_matrix is None:
-            raise ValueError('the rotation matrix is not yet set.')
-
-        # the position vectors for each pixel, origin at the postion of beam
-        # impact R.shape should be (3, w*h), but R.T is more convinient for
-        # matrix calculation RT.T[i] is a vector
-        # x0, y0 is considerence the origin, which is also beam center
-        RT = np.vstack((X - self.x0, -(Y - self.y0), 0.*X))
-
-        # get distance from sample in number of pixels (detector coordinates)
-        dr = self.get_ratioDw()*self.width
-        # position vectors in lab coordinates, sample at the origin
-        [X1, Y1, Z1] = np.dot(self.rot_matrix, RT)
-        Z1 -= dr
+        X, Y = np.broadcast_arrays(X, Y)
+        shape = X.shape
+        X = X.ravel()
+        Y = Y.ravel()
+        num_outputs = 9 if calc_cor_factors is True else 7
+        outputs = tuple(np.empty(X.shape) for i in range(num_outputs))
+
+        def calc_block(block):
+            results = self._calc_from_XY(X[block], Y[block],
+                                         calc_cor_factors=calc_cor_factors)
+            for output, result in zip(outputs, results):
+                output[block] = result
+
+        self._run_blocks(calc_block, len(X), self.block_pixels)
+        # [()] makes numbers of the results for numbers
+        return tuple(output.reshape(shape)[()] for output in outputs)
+
+    def _calc_from_XY(self, X, Y, calc_cor_factors=False):
+        X1, Y1, Z1 = self._lab_coordinates(X, Y)
 
         # angles
         r3sq = X1*X1+Y1*Y1+Z1*Z1
@@ -451,6 +673,76 @@ class Calibration(CalibrationBase):
         else:
             return (Q, Phi, Qx, Qy, Qz, Qr, Qn)
 
+    def calc_map_from_XY(self, name, X, Y):
+        """
+        calculate the map name (see _MAPS) at the pixel positions X and Y
+        only computing what it needs (see calc_from_XY)
+        X and Y are arrays that broadcast together
+        """
+        if name not in self._MAPS:
+            raise ValueError("Unknown map {}, choose from "
+                             "{}".format(name, list(self._MAPS)))
+
+        X1, Y1, Z1 = self._lab_coordinates(X, Y)
+
+        r3sq = X1*X1+Y1*Y1+Z1*Z1
+        if name == 'FPol':
+            return (Y1*Y1+Z1*Z1)/r3sq
+        r3 = np.sqrt(r3sq)
+        if name == 'FSA':
+            return np.power(np.fabs(Z1)/r3, 3)
+
+        Phi = np.arctan2(Y1, X1) + np.radians(self.sample_normal)
+        if name == 'angle':
+            return np.degrees(Phi)
+
+        r2 = np.sqrt(X1*X1+Y1*Y1)
+        Theta = 0.5*np.arcsin(r2/r3)
+        Q = 2.0*self.get_k()*np.sin(Theta)
+        if name == 'q':
+            return Q
+
+        # lab coordinates
+        Qz = Q*np.sin(Theta)
+        if name == 'qz':
+            return Qz
+        Qy = Q*np.cos(Theta)*np.sin(Phi)
+        if name == 'qy':
+            return Qy
+        Qx = Q*np.cos(Theta)*np.cos(Phi)
+        if name == 'qx':
+            return Qx
+
+        # convert to sample coordinates
+        alpha = np.radians(self.incident_angle)
+        Qn = Qy*np.cos(alpha) + Qz*np.sin(alpha)
+        if name == 'qn':
+            return Qn
+        # qr
+        return np.sqrt(Q*Q-Qn*Qn)*np.sign(Qx)
+
+    def _lab_coordinates(self, X, Y):
+        """
+        the position vectors (X1, Y1, Z1) of the pixels X, Y in lab
+        coordinates, sample at the origin
+        """
+        if self.rot_matrix is None:
+            raise ValueError('the rotation matrix is not yet set.')
+
+        # the position vectors for each pixel, origin at the postion of beam
+        # impact. x0, y0 is considered the origin, which is also beam center
+        # (the detector z is 0, so the last column of the rotation drops)
+        dX = X - self.x0
+        dY = -(Y - self.y0)
+        rot = self.rot_matrix
+
+        # get distance from sample in number of pixels (detector coordinates)
+        dr = self.get_ratioDw()*self.width
+        X1 = rot[0, 0]*dX + rot[0, 1]*dY
+        Y1 = rot[1, 0]*dX + rot[1, 1]*dY
+        Z1 = rot[2, 0]*dX + rot[2, 1]*dY - dr
+        return X1, Y1, Z1
+
     # Rotation calculation
     def RotationMatrix(self, axis, angle):
         if axis == 'x' or axis == 'X':
@@ -492,29 +784,13 @@ class Calibration(CalibrationBase):
 
 @normalize_token.register(Calibration)
 def tokenize_calibration(self):
-    '''
-        This function will first inherit the tokenization from Calibration
-        then run it for the RQConv case.
-        It then runs it for the new arguments and appends to the args list.
+    ''' The token of the calibration, from its geometry including the
+        detector orientation (see tokenize_calibration_base).'''
+    return normalize_token(fingerprint_calibration(self))
 
-        It will return something like:
-            'list, [1,1,1], 'list', [1,3,4] etc
-            it looks messy but at least it is hashable
-    '''
-    # inherit dispatch from Calibration object
-    # calib_norm = normalize_token.dispatch(Calibration)
-    # args = calib_norm(self)
-    args = tokenize_calibration_base(self)
-    # finally now tokenize the rest
-    newargs = list()
-    # round
-    newargs.append(roundbydigits(self.det_orient, 3))
-    newargs.append(roundbydigits(self.det_tilt, 3))
-    newargs.append(roundbydigits(self.det_phi, 3))
-    newargs.append(roundbydigits(self.incident_angle, 3))
-    newargs.append(roundbydigits(self.sample_normal, 3))
-    newargs.append(roundbydigits(self.rot_matrix, 3))
-    newargs = normalize_token(newargs)
-    args = (args, newargs)
-
-    return args
+
+@fingerprint.register(Calibration)
+def fingerprint_calibration(self):
+    ''' The geometry of the calibration, including the detector
+        orientation (and whether maps are interpolated).'''
+    return ('Calibration',) + self.geometry() + self.interpolation()
@@ -0,0 +1,162 @@
+from SciStreams.data.Calibration import Calibration
+from SciStreams.core.fingerprint import fingerprint
+import numpy as np
+from numpy.testing import assert_array_almost_equal, assert_allclose
+
+
+def test_calibration_maps():
+    ''' The maps are computed when first used, one at a time, with the
+        precision asked for.'''
+    calib = Calibration(wavelength_A=1., distance_m=5., pixel_size_um=172,
+                        det_tilt=5., dtype=np.float32)
+    calib.set_image_size(30, 20)
+    calib.set_beam_position(12.3, 8.7)
+
+    q_map = calib.q_map
+    assert q_map.shape == (20, 30)
+    assert q_map.dtype == np.float32
+    assert calib.r_map.dtype == np.float32
+    # the other maps aren't computed, and no index grids are kept
+    assert calib.qx_map_data is None
+    assert not hasattr(calib, 'X')
+
+    # the same as computing them from the pixel positions
+    Y, X = np.meshgrid(np.arange(20), np.arange(30), indexing='ij')
+    Q, Phi, Qx, Qy, Qz, Qr, Qn = calib.calc_from_XY(X, Y)
+    assert_array_almost_equal(q_map, Q)
+    assert_array_almost_equal(calib.qx_map, Qx)
+    assert_array_almost_equal(calib.angle_map, np.degrees(Phi), decimal=4)
+
+    # of any shape
+    Q = calib.calc_from_XY(np.arange(30), 7)[0]
+    assert_array_almost_equal(Q, q_map[7])
+    Q = calib.calc_from_XY(4, 7)[0]
+    assert np.ndim(Q) == 0
+    assert_array_almost_equal(Q, q_map[7, 4])
+
+
+def test_calibration_cache(tmpdir):
+    ''' Calibrations of the same geometry share their maps, which are also
+        kept on disk if calibration_cache_dir is set.'''
+    from SciStreams import config
+    from SciStreams.core.cache import cache
+
+    def make_calibration():
+        calib = Calibration(wavelength_A=1., distance_m=5.,
+                            pixel_size_um=172, det_tilt=5.)
+        calib.set_image_size(30, 20)
+        calib.set_beam_position(12.3, 8.7)
+        return calib
+
+    cache_dir = config.calibration_cache_dir
+    config.calibration_cache_dir = str(tmpdir)
+    try:
+        cache['calibration'].clear()
+        q_map = make_calibration().q_map
+        assert make_calibration().q_map is q_map
+        # shared, so read only
+        assert not q_map.flags.writeable
+        assert len(tmpdir.listdir()) == 1
+
+        # a new process starts from the disk
+        cache['calibration'].clear()
+        calib = make_calibration()
+        assert isinstance(calib.q_map, np.memmap)
+        assert_array_almost_equal(calib.q_map, q_map)
+
+        # another geometry doesn't
+        calib.set_beam_position(12.4, 8.7)
+        calib.clear_maps()
+        assert not isinstance(calib.q_map, np.memmap)
+    finally:
+        config.calibration_cache_dir = cache_dir
+        cache['calibration'].clear()
+
+
+def test_calibration_token():
+    ''' The token of a calibration depends on its geometry, not its maps.'''
+    from dask.base import tokenize
+
+    calib = Calibration(wavelength_A=1., distance_m=5., pixel_size_um=172)
+    calib.set_image_size(30, 20)
+    calib.set_beam_position(12.3, 8.7)
+    token = tokenize(calib)
+
+    calib.q_map
+    assert tokenize(calib) == token
+
+    calib.set_beam_position(12.4, 8.7)
+    assert tokenize(calib) != token
+
+
+def test_calibration_master_maps():
+    ''' With a master_margin, the maps the beam center only translates are
+        slices of a master map.'''
+    def make_calibration(x0, y0, master_margin=None):
+        calib = Calibration(wavelength_A=1., distance_m=5.,
+                            pixel_size_um=172, det_orient=10.,
+                            master_margin=master_margin)
+        calib.set_image_size(30, 20)
+        calib.set_beam_position(x0, y0)
+        return calib
+
+    for x0, y0 in [(12, 8), (-3, 21)]:
+        calib = make_calibration(x0, y0, master_margin=5)
+        expected = make_calibration(x0, y0)
+        assert_allclose(calib.q_map, expected.q_map, rtol=1e-12)
+        assert_allclose(calib.r_map, expected.r_map, rtol=1e-12)
+
+    # q is interpolated for sub-pixel beam centers, r is exact
+    for x0, y0 in [(12.3, 8.7), (12.5, 8.5), (-3.5, 21.2)]:
+        calib = make_calibration(x0, y0, master_margin=5)
+        expected = make_calibration(x0, y0)
+        assert_allclose(calib.r_map, expected.r_map, rtol=1e-12)
+        # in pixels (q is about proportional to r this close to the beam)
+        q_per_pixel = expected.q_map.max()/expected.r_map.max()
+        q_error = np.abs(calib.q_map - expected.q_map)/q_per_pixel
+        assert q_error.max() < .15
+        # away from the beam center
+        assert q_error[expected.r_map > 5].max() < .03
+        # so they don't share the task keys of exact maps
+        assert fingerprint(calib) != fingerprint(expected)
+
+    # exact maps do
+    assert fingerprint(make_calibration(12, 8, master_margin=5)) == \
+        fingerprint(make_calibration(12, 8))
+
+    calib = make_calibration(12, 8, master_margin=5)
+    other = make_calibration(13, 9, master_margin=5)
+    # views of the same master
+    assert calib.q_map.base is other.q_map.base
+
+
+def test_calibration_blocks():
+    ''' The maps are computed in blocks of pixels, on threads if asked for,
+        with the same result.'''
+    from SciStreams import config
+    from SciStreams.core.cache import cache
+
+    calib = Calibration(wavelength_A=1., distance_m=5., pixel_size_um=172,
+                        det_tilt=15.)
+    calib.set_image_size(30, 20)
+    calib.set_beam_position(12.3, 8.7)
+    calib.calc_rot_matrix()
+
+    Y, X = np.meshgrid(np.arange(20), np.arange(30), indexing='ij')
+    expected = calib.calc_from_XY(X.ravel(), Y.ravel(), calc_cor_factors=True)
+
+    threads = config.calibration_threads
+    config.calibration_threads = 2
+    try:
+        # blocks of 2 rows
+        calib.block_pixels = 64
+        result = calib.calc_from_XY(X.ravel(), Y.ravel(),
+                                    calc_cor_factors=True)
+        for arr, expected_arr in zip(result, expected):
+            assert_array_almost_equal(arr, expected_arr)
+
+        cache['calibration'].clear()
+        assert_array_almost_equal(calib.q_map, expected[0].reshape(20, 30))
+    finally:
+        config.calibration_threads = threads
+        cache['calibration'].clear()
@@ -1,8 +1,13 @@
+import os.path
+
 from .detectors2D import detectors2D
 import numpy as np
 from PIL import Image
 
-from SciStreams.config import masks_config
+from SciStreams import config
+from SciStreams.core.instrumentation import instrument
+from SciStreams.core.cache import cache
+from SciStreams.core.fingerprint import keyed
 
 # TODO : need to fix again...
 def generate_mask(**md):
@@ -24,7 +29,6 @@ def generate_mask(**md):
 
     # ensure detector_name exists, else give no mask
     if detector_name in mask_generators:
-        print("calling function {}".format(mask_generators[detector_name]))
         mask_gen = mask_generators[detector_name]
 
         mask = mask_gen(**md)
@@ -32,7 +36,9 @@ def generate_mask(**md):
         mask = None
 
     if mask is not None:
-        print("A mask has been found and generated.")
+        instrument.count('generate_mask', 'mask_generated')
+    else:
+        instrument.count('generate_mask', 'no_mask')
     return dict(mask=mask)
 
 import h5py
@@ -77,16 +83,36 @@ def load_beamcenter(fname):
     f.close()
     return [beamy0, beamx0]
 
+def _load_cached(loader, fname):
+    ''' loader(fname), read once per version of the file.
+
+        The result is kept in the 'mask' cache (see core/cache.py) and
+        shared, so it must not be modified.
+    '''
+    key = loader.__name__, fname, os.path.getmtime(fname)
+    masks = cache['mask']
+    result = masks.get(key)
+    if result is None:
+        result = loader(fname)
+        masks.put(key, result)
+    return result
+
+
 def generate_mask_pilatus2M(**md):
     ''' generate mask from startdocument information
 
         This will read from local config files for the mask
         filenames if they exist.
+
+        The mask is made once for the files and the beam center, and shared
+        (so it's read only). It's a KeyedArray identified by them (see
+        core/fingerprint.py), so the steps that cache what they compute from
+        the mask (like the circavg binning) don't hash it.
     '''
     #print("loading a mask. md: {}".format(md))
     detector_key = 'pilatus2M_image'
 
-    mask_config = masks_config.get(detector_key, {})
+    mask_config = config.masks_config.get(detector_key, {})
 
     # get filenames from config
     master_dir = mask_config.get('mask_dir', ".")
@@ -100,21 +126,6 @@ def generate_mask_pilatus2M(**md):
 
     #print('mask shape : {}'.format(mask_shape))
 
-    if blemish_fname is not None:
-        blemish = load_blemish(blemish_fname)
-    else:
-        blemish = None
-
-    if mask_fname is not None:
-        mask = load_mask(mask_fname)
-        beam_center = load_beamcenter(mask_fname)
-        #print("Got beam center from mask: {}".format(beam_center))
-        #print("filename {}".format(mask_fname))
-    else:
-        #print("No mask found, ignoring")
-        mask = None
-        beam_center = None
-
     # now interpolate the beam center from the actual beam center
     beamcenterx = md.get('beamx0', None)
     beamcentery = md.get('beamy0', None)
@@ -131,10 +142,51 @@ def generate_mask_pilatus2M(**md):
         beam_center_experiment = None
         print("No beam center found")
 
+    key = ('generate_mask_pilatus2M', _file_version(blemish_fname),
+           _file_version(mask_fname), tuple(int(n) for n in mask_shape),
+           None if beam_center_experiment is None
+           else tuple(beam_center_experiment))
+    mask_expt = cache['mask'].get(key)
+    if mask_expt is None:
+        mask_expt = _make_mask_pilatus2M(blemish_fname, mask_fname,
+                                         mask_shape, beam_center_experiment)
+        mask_expt = keyed(mask_expt, key)
+        mask_expt.flags.writeable = False
+        cache['mask'].put(key, mask_expt)
+
+    return mask_expt
+
+
+def _file_version(fname):
+    ''' The (name, modification time) of the file fname, None if there is
+        none.'''
+    if fname is None or not os.path.exists(fname):
+        return None
+    return fname, os.path.getmtime(fname)
+
+
+def _make_mask_pilatus2M(blemish_fname, mask_fname, mask_shape,
+                         beam_center_experiment):
+    if blemish_fname is not None:
+        blemish = _load_cached(load_blemish, blemish_fname)
+    else:
+        blemish = None
+
+    if mask_fname is not None:
+        mask = _load_cached(load_mask, mask_fname)
+        beam_center = _load_cached(load_beamcenter, mask_fname)
+        #print("Got beam center from mask: {}".format(beam_center))
+        #print("filename {}".format(mask_fname))
+    else:
+        #print("No mask found, ignoring")
+        mask = None
+        beam_center = None
+
     mask_expt = None
     if mask is not None and beam_center_experiment is not None:
         #print("got a mask!")
-        mask_expt = make_subimage(mask, beam_center, mask_shape, beam_center_experiment)
+        mask_expt = make_subimage(mask, beam_center, mask_shape,
+                                  beam_center_experiment)
         #print("Made sub image")
     else:
         if mask is None:
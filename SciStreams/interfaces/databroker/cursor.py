@@ -0,0 +1,150 @@
+'''
+    Incremental ingest from a databroker.
+
+    An ``IngestCursor`` is the position of the last run sent to the
+    pipeline: the (time, uid) of its start document. Runs are ordered by
+    (time, uid), so a run is new if it comes after the cursor, whatever
+    query window it was found in. The cursor is saved to a file (see the
+    ingest_cursor option) as each run is done, and a restart resumes from
+    it.
+
+    ``AdaptivePoll`` sets the time to wait between queries. It goes down
+    to min_interval when new runs come in, and doubles up to max_interval
+    while there is nothing new.
+
+    Examples
+    --------
+    >>> cursor = IngestCursor("ingest_cursor.json")
+    >>> poll = AdaptivePoll(1, 60)
+    >>> while True:
+    ...     hdrs = new_headers(db, cursor)
+    ...     for hdr in hdrs:
+    ...         process(hdr)
+    ...         cursor.advance(hdr)
+    ...     time.sleep(poll.next(len(hdrs)))
+'''
+import json
+import os
+import time
+
+
+_TIME_FORMATS = ["%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d %H",
+                 "%Y-%m-%d"]
+
+
+def parse_time(strtime):
+    ''' The timestamp of a local time string, like "2017-11-05 14:00".
+
+        Raises a ValueError if strtime isn't in one of the _TIME_FORMATS.
+    '''
+    for strform in _TIME_FORMATS:
+        try:
+            return time.mktime(time.strptime(strtime, strform))
+        except ValueError:
+            pass
+    raise ValueError("Error, time {} not understood\nFormats accepted : "
+                     "{}".format(strtime, _TIME_FORMATS))
+
+
+def header_key(hdr):
+    ''' The (time, uid) of a header, which orders the runs.'''
+    return hdr.start['time'], hdr.start['uid']
+
+
+class IngestCursor:
+    ''' The (time, uid) of the last run ingested.
+
+        Parameters
+        ----------
+        filename : str, optional
+            where the cursor is saved. If None, it's not
+    '''
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.position = None
+        if filename is not None and os.path.exists(filename):
+            with open(filename) as f:
+                position = json.load(f)
+            self.position = position['time'], position['uid']
+
+    @property
+    def time(self):
+        if self.position is None:
+            return None
+        return self.position[0]
+
+    def reset(self, start_time=None):
+        ''' Move the cursor to just before start_time (a timestamp).
+
+            With no start_time, the cursor is cleared: every run found is
+            new.
+        '''
+        if start_time is None:
+            self.position = None
+        else:
+            # '' sorts before any uid
+            self.position = start_time, ''
+        self.save()
+
+    def is_new(self, hdr):
+        return self.position is None or header_key(hdr) > self.position
+
+    def advance(self, hdr):
+        ''' Move the cursor to hdr, once it has been ingested.'''
+        key = header_key(hdr)
+        if self.position is None or key > self.position:
+            self.position = key
+            self.save()
+
+    def save(self):
+        if self.filename is None:
+            return
+        if self.position is None:
+            # a restart shouldn't resume from an older position
+            if os.path.exists(self.filename):
+                os.remove(self.filename)
+            return
+        # write then rename, so that a crash doesn't leave half a file
+        tmpname = self.filename + ".tmp"
+        with open(tmpname, "w") as f:
+            json.dump(dict(time=self.position[0], uid=self.position[1]), f)
+        os.replace(tmpname, self.filename)
+
+    def __repr__(self):
+        return "IngestCursor({}, {})".format(self.filename, self.position)
+
+
+def new_headers(db, cursor, **kwargs):
+    ''' The headers of db after the cursor, oldest first.
+
+        kwargs are passed on to the query (a stop_time for example). The
+        start_time is the cursor's.
+    '''
+    if cursor.time is not None:
+        # whole seconds, the runs at the boundary are filtered out below
+        kwargs['start_time'] = time.strftime("%Y-%m-%d %H:%M:%S",
+                                             time.localtime(cursor.time))
+    hdrs = [hdr for hdr in db(**kwargs) if cursor.is_new(hdr)]
+    return sorted(hdrs, key=header_key)
+
+
+class AdaptivePoll:
+    ''' The time to wait before the next query.
+
+        Parameters
+        ----------
+        min_interval, max_interval : number
+            the bounds, in seconds
+    '''
+    def __init__(self, min_interval, max_interval):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.interval = min_interval
+
+    def next(self, num_new):
+        ''' The seconds to wait, given the number of new runs found.'''
+        if num_new > 0:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.interval*2, self.max_interval)
+        return self.interval
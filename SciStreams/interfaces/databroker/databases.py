@@ -3,6 +3,8 @@
     Eventually this should be in some connection file.
 
 '''
+from collections.abc import Mapping
+
 from .database_initializers import init_db
 
 # this contains dbinfo, which may be read from a scianalysis.yml file
@@ -63,5 +65,26 @@ def initialize(dbname=None):
     return databases
 
 
+class LazyDatabases(Mapping):
+    ''' The databases, initialized the first time one is asked for (so that
+        importing this connects to nothing).'''
+    def __init__(self):
+        self._databases = None
+
+    def _get(self):
+        if self._databases is None:
+            self._databases = initialize()
+        return self._databases
+
+    def __getitem__(self, key):
+        return self._get()[key]
+
+    def __iter__(self):
+        return iter(self._get())
+
+    def __len__(self):
+        return len(self._get())
+
+
 # TODO : move initialization elsewhere
-databases = initialize()
+databases = LazyDatabases()
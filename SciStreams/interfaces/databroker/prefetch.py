@@ -0,0 +1,77 @@
+'''
+    Read-ahead of the documents of databroker headers.
+
+    ``prefetch_documents`` loads the documents of the next ``depth`` headers
+    on a thread pool, while the pipeline works on the current one. The
+    metadata queries and the first event loads then overlap with the
+    pipeline instead of waiting on it.
+
+    A run whose documents can't all be read (a FileNotFoundError from a
+    handler for example) ends with a stop document after the documents that
+    were read, so the pipeline still cleans up after it.
+
+    Examples
+    --------
+    >>> for hdr, documents in prefetch_documents(db(start_time=t0), depth=4):
+    ...     for name, doc in documents:
+    ...         stream_input(name, doc)
+'''
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from uuid import uuid4
+
+
+def load_documents(hdr, fill=False):
+    ''' The (name, doc) pairs of hdr as a list.
+
+        If reading fails part way, a stop document for the run is added
+        after the documents that were read.
+    '''
+    documents = list()
+    current_start = None
+    try:
+        for nds in hdr.documents(fill=fill):
+            if nds[0] == 'start':
+                current_start = nds[1]['uid']
+            elif nds[0] == 'stop':
+                # reset the start
+                current_start = None
+            documents.append(nds)
+    except Exception as exc:
+        print("Error reading the documents of a run : {}".format(exc))
+        # don't give the event, just a stop
+        documents.append(('stop', {'uid': str(uuid4()),
+                                   'run_start': current_start}))
+    return documents
+
+
+def prefetch_documents(hdrs, depth=4, fill=False):
+    ''' Yield (hdr, documents) for the headers in hdrs, in order.
+
+        The documents (see load_documents) of up to depth headers are read
+        ahead on a thread pool.
+    '''
+    hdrs = iter(hdrs)
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=max(depth, 1)) as executor:
+        try:
+            while True:
+                while len(pending) < max(depth, 1):
+                    try:
+                        hdr = next(hdrs)
+                    except StopIteration:
+                        break
+                    except Exception as exc:
+                        print("Exception in calling next of hdrs")
+                        print(exc)
+                        continue
+                    pending.append((hdr, executor.submit(load_documents, hdr,
+                                                         fill=fill)))
+                if len(pending) == 0:
+                    break
+                hdr, documents = pending.popleft()
+                yield hdr, documents.result()
+        finally:
+            # the consumer stopped early, don't read the rest
+            for hdr, documents in pending:
+                documents.cancel()
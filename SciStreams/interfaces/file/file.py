@@ -4,8 +4,6 @@ import os
 from ... import config
 from .reading import FileDesc  # noqa
 
-_ROOTDIR = config.resultsroot
-_ROOTMAP = config.resultsrootmap
 
 
 def make_dir(directory):
@@ -48,10 +46,11 @@ def _make_fname_from_attrs(attrs):
     # remove the trailing slash
     rootdir = attrs['experiment_alias_directory'].strip("/")
 
-    if _ROOTMAP is not None:
-        rootdir = rootdir.replace(_ROOTMAP[0], _ROOTMAP[1])
-    elif _ROOTDIR is not None:
-        rootdir = _ROOTDIR
+    if config.resultsrootmap is not None:
+        rootmap = config.resultsrootmap
+        rootdir = rootdir.replace(rootmap[0], rootmap[1])
+    elif config.resultsroot is not None:
+        rootdir = config.resultsroot
 
     if 'detector_name' not in attrs:
         raise ValueError("Error cannot find detector_name in attributes")
@@ -3,8 +3,6 @@ matplotlib.use("Agg")  # noqa
 import numpy as np
 import matplotlib.pyplot as plt
 
-from ... import config
-
 from uuid import uuid4
 
 from ...tools.image import findLowHigh
@@ -12,8 +10,6 @@ from ...tools.image import findLowHigh
 from ...utils.file import _make_fname_from_attrs
 
 
-_ROOTDIR = config.resultsroot
-_ROOTMAP = config.resultsrootmap
 
 global_list = set()
 # usually the number of processes is good
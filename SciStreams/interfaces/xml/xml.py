@@ -5,10 +5,6 @@ from lxml import etree
 
 from ...utils.file import _make_fname_from_attrs
 
-from ... import config
-_ROOTDIR = config.resultsroot
-_ROOTMAP = config.resultsrootmap
-
 
 def store_results_xml(sdoc, **kwargs):
     '''
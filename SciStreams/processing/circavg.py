@@ -1,14 +1,110 @@
+import copy
+
 import numpy as np
 from skbeam.core.accumulators.binned_statistic import BinnedStatistic1D
 from .partitioning import center2edge
+from ..core.batch import accepts_batches, stack
+from ..core.cache import cache
+from ..core.fingerprint import fingerprint
+
+
+@accepts_batches
+def circavg(image, q_map=None, r_map=None,  bins=None, mask=None,
+            binning_key=None, batch=False, **kwargs):
+    ''' computes the circular average.
 
+        image can also be a batch of images (with batch=True, 3d, the first
+        axis being the event). q_map, r_map and mask can then be batches
+        too. If they are the same for all images, the binning is only
+        computed once.
 
-def circavg(image, q_map=None, r_map=None,  bins=None, mask=None, **kwargs):
-    ''' computes the circular average.'''
+        binning_key identifies q_map and r_map (the fingerprint of their
+        calibration for example). If given, the binning is kept in the
+        'binning' cache (see core/cache.py) and reused for the same maps,
+        bins and mask. The mask is identified by its fingerprint (masks made
+        by generate_mask are KeyedArrays, see core/fingerprint.py), it's not
+        cached by a mask without one.
+    '''
+    if batch:
+        return _circavg_batch(image, q_map=q_map, r_map=r_map, bins=bins,
+                              mask=mask, binning_key=binning_key)
+
+    mask_token = _mask_token(mask)
     # TODO : could avoid creating a mask to save time
     if mask is None:
         mask = np.ones_like(image)
 
+    rbinstat = _cached_binstat(binning_key, image.shape, q_map=q_map,
+                               r_map=r_map, bins=bins, mask=mask,
+                               mask_token=mask_token)
+    return _circavg_apply(rbinstat, image, mask)
+
+
+def _circavg_batch(images, q_map=None, r_map=None, bins=None, mask=None,
+                   binning_key=None):
+    ndim = images.ndim
+    shared = all(_is_shared(arr, ndim) for arr in (q_map, r_map, mask))
+    if not shared:
+        binning_key = None
+    rbinstat = None
+    results = list()
+    for i, image in enumerate(images):
+        frame_mask = _frame(mask, i, ndim)
+        mask_token = _mask_token(frame_mask)
+        if frame_mask is None:
+            frame_mask = np.ones_like(image)
+        if rbinstat is None or not shared:
+            rbinstat = _cached_binstat(binning_key, image.shape,
+                                       q_map=_frame(q_map, i, ndim),
+                                       r_map=_frame(r_map, i, ndim),
+                                       bins=bins,
+                                       mask=frame_mask, mask_token=mask_token)
+        results.append(_circavg_apply(rbinstat, image, frame_mask))
+    return {key: stack([res[key] for res in results]) for key in results[0]}
+
+
+def _frame(arr, i, ndim):
+    ''' the ith element of a batch, if arr is one (has the ndim of the
+        batch of images).'''
+    if arr is None or arr.ndim < ndim:
+        return arr
+    return arr[i]
+
+
+def _is_shared(arr, ndim):
+    ''' True if arr is the same for all elements of a batch.'''
+    # a broadcast batch has a zero stride along the batch axis
+    return arr is None or arr.ndim < ndim or arr.strides[0] == 0
+
+
+def _mask_token(mask):
+    ''' The identity of mask for the binning cache, None if it has none.'''
+    if mask is None:
+        return 'no mask'
+    return fingerprint(mask)
+
+
+def _cached_binstat(binning_key, shape, q_map=None, r_map=None, bins=None,
+                    mask=None, mask_token=None):
+    ''' _circavg_binstat, from the cache if the maps have a binning_key and
+        the mask a mask_token.'''
+    bins_token = fingerprint(bins)
+    if binning_key is None or mask_token is None or \
+            (bins is not None and bins_token is None):
+        return _circavg_binstat(shape, q_map=q_map, r_map=r_map, bins=bins,
+                                mask=mask)
+    key = 'circavg', binning_key, shape, bins_token, mask_token
+    binnings = cache['binning']
+    rbinstat = binnings.get(key)
+    if rbinstat is None:
+        rbinstat = _circavg_binstat(shape, q_map=q_map, r_map=r_map,
+                                    bins=bins, mask=mask)
+        binnings.put(key, rbinstat)
+    # _circavg_apply sets the statistic, so don't share it between threads
+    return copy.copy(rbinstat)
+
+
+def _circavg_binstat(shape, q_map=None, r_map=None, bins=None, mask=None):
     # figure out bins if necessary
     if bins is None:
         # guess q pixel bins from r_map
@@ -23,7 +119,7 @@ def circavg(image, q_map=None, r_map=None,  bins=None, mask=None, **kwargs):
             # crude guess, I'll be off by a factor between 1-sqrt(2) or so
             # (we'll have that factor less bins than we should)
             # arbitrary number
-            nobins = int(np.maximum(*(image.shape))//4)
+            nobins = int(np.maximum(*shape)//4)
 
         # here we assume the rbins uniform
         bins = nobins
@@ -40,8 +136,12 @@ def circavg(image, q_map=None, r_map=None,  bins=None, mask=None, **kwargs):
     # print("qmap shape : {}".format(q_map.shape))
     # print("number bins : {}".format(bins))
     # print("mask shape : {}".format(mask.shape))
-    rbinstat = BinnedStatistic1D(q_map.reshape(-1), statistic='mean',
-                                 bins=bins, mask=mask.ravel())
+    return BinnedStatistic1D(q_map.reshape(-1), statistic='mean',
+                             bins=bins, mask=mask.ravel())
+
+
+def _circavg_apply(rbinstat, image, mask):
+    rbinstat.statistic = 'mean'
     sqy = rbinstat(image.ravel())
     sqx = rbinstat.bin_centers
     # get the error from the shot noise only
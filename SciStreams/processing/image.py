@@ -1,7 +1,10 @@
 from scipy.ndimage.filters import gaussian_filter
 
+from ..core.batch import accepts_batches
 
-def blur(image, sigma=None):
+
+@accepts_batches
+def blur(image, sigma=None, batch=False):
     ''' blur the image
 
         Uses a Gaussian blurring method.
@@ -10,35 +13,48 @@ def blur(image, sigma=None):
         ----------
         image : 2d np.ndarray
             the image to blur
+            (or a 3d batch of images, the first axis being the image number)
 
         sigma : float, optional
             the std dev of the Gaussian kernel to blur with
+
+        batch : bool, optional
+            image is a batch (see core/batch.py)
     '''
     if sigma is not None:
-        image = gaussian_filter(image, sigma)
+        if batch:
+            # don't blur across the images of a batch
+            image = gaussian_filter(image, (0, sigma, sigma))
+        else:
+            image = gaussian_filter(image, sigma)
     return dict(image=image)
 
 
-def crop(image, crop=None):
+@accepts_batches
+def crop(image, crop=None, batch=False):
     ''' Crop an image according to a selection.
 
         Parameters
         ----------
         image : 2d np.ndarray
             the image to crop
+            (or a 3d batch of images, the first axis being the image number)
         crop : 4 element list, optional
             [x0, x1, y0, y1] list where selection is
                 image[y0:y1, x0:x1]
             default is to return untouched image
+        batch : bool, optional
+            image is a batch (see core/batch.py), it's cropped the same way
 
     '''
     if crop is not None:
         x0, x1, y0, y1 = crop
-        image = image[int(y0):int(y1), int(x0):int(x1)]
+        image = image[..., int(y0):int(y1), int(x0):int(x1)]
     return dict(image=image)
 
 
-def resize(image, resize=None):
+@accepts_batches
+def resize(image, resize=None, batch=False):
     ''' Performs simple pixel binning
 
         Parameters
@@ -46,14 +62,19 @@ def resize(image, resize=None):
 
         image : 2d np.ndarray
             the image to resize
+            (or a 3d batch of images, the first axis being the image number)
         resize : int, optional
             the number to bin by
             resize=2 bins 2x2 pixels
         resize must be an integer > 1 and also smaller than the image shape
+        batch : bool, optional
+            image is a batch (see core/batch.py)
     '''
     from skimage.measure import block_reduce
     if resize is not None:
-        if image.ndim == 2:
+        if batch and image.ndim == 3:
+            image = block_reduce(image, (1, resize, resize))
+        elif not batch and image.ndim == 2:
             image = block_reduce(image, (resize, resize))
         else:
             raise ValueError("Error, image is not a 2D np.ndarray")
@@ -18,18 +18,24 @@
 '''
 
 
-from ..config import config
+from .. import config
 
-from functools import partial, wraps
+from functools import wraps
 from sidl.nn_fbbenet.infer import infer as sidl_infer  # noqa
 from sidl.nn_fbbenet.infer import normalize_img, reduce_img  # noqa
 from sidl.nn_fbbenet.infer import inference_function as sidl_inffunc  # noqa
 
-checkpoint_filename = config.get('modules', {})\
-    .get('tensorflow', {}).get('checkpoint_filename', None)
 
-infer = partial(sidl_infer, checkpoint_filename=checkpoint_filename)
-infer = wraps(sidl_infer)(infer)
-inference_function = partial(sidl_inffunc,
-                             checkpoint_filename=checkpoint_filename)
-inference_function = wraps(sidl_inffunc)(inference_function)
+def _with_checkpoint(f):
+    # the checkpoint is read from the configuration when first called
+    @wraps(f)
+    def f_new(*args, **kwargs):
+        if 'checkpoint_filename' not in kwargs:
+            kwargs['checkpoint_filename'] = config.modules\
+                .get('tensorflow', {}).get('checkpoint_filename', None)
+        return f(*args, **kwargs)
+    return f_new
+
+
+infer = _with_checkpoint(sidl_infer)
+inference_function = _with_checkpoint(sidl_inffunc)
@@ -1,5 +1,7 @@
 # test the XSAnalysis Streams, make sure they're working properly
 from SciStreams.processing.circavg import circavg
+from SciStreams.core.cache import cache
+from SciStreams.core.fingerprint import keyed
 # from SciStreams.processing.stitching import xystitch_accumulate
 # TODO : test all functions
 
@@ -31,3 +33,42 @@ def test_circavg():
     assert 'sqxerr' in res
     assert 'sqy' in res
     assert 'sqyerr' in res
+
+
+def test_circavg_batch():
+    x = np.linspace(-5, 5, 10)
+    X, Y = np.meshgrid(x, x)
+    r_map = np.sqrt(X**2 + Y**2)
+    q_map = r_map**1.1
+    images = np.random.random((3, 10, 10))
+
+    res = circavg(images, q_map=q_map, r_map=r_map, batch=True)
+    for i, image in enumerate(images):
+        res1 = circavg(image, q_map=q_map, r_map=r_map)
+        assert np.allclose(res['sqy'][i], res1['sqy'], equal_nan=True)
+
+
+def test_circavg_binning_cache():
+    ''' The binning is cached for the masks with a key, never hashed.'''
+    # too large to be fingerprinted by value
+    x = np.linspace(-5, 5, 20)
+    X, Y = np.meshgrid(x, x)
+    r_map = np.sqrt(X**2 + Y**2)
+    q_map = r_map**1.1
+    image = np.random.random((20, 20))
+    mask = np.ones_like(image)
+    mask[0] = 0
+
+    binnings = cache['binning']
+    binnings.clear()
+    res = circavg(image, q_map=q_map, r_map=r_map, mask=mask,
+                  binning_key="geometry")
+    assert len(binnings) == 0
+
+    keyed_mask = keyed(mask, "mask")
+    for i in range(2):
+        res1 = circavg(image, q_map=q_map, r_map=r_map, mask=keyed_mask,
+                       binning_key="geometry")
+        assert len(binnings) == 1
+        assert np.allclose(res['sqy'], res1['sqy'], equal_nan=True)
+    binnings.clear()
@@ -11,9 +11,6 @@ from functools import partial
 from collections import deque
 
 
-# temporary futures cache
-futures_cache = deque()
-
 import matplotlib.pyplot as plt
 # plt.ion()  # noqa
 
@@ -29,9 +26,13 @@ import matplotlib.pyplot as plt
 # from distributed import sync
 
 from SciStreams.callbacks import SciStreamCallback
+from SciStreams.callbacks.doctree import DocumentTree
 
 from SciStreams.detectors.mask_generators import generate_mask
 from SciStreams.interfaces.databroker.databases import databases
+from SciStreams.interfaces.databroker.cursor import IngestCursor, \
+    AdaptivePoll, new_headers, parse_time
+from SciStreams.interfaces.databroker.prefetch import prefetch_documents
 
 # from SciStreams.core.StreamDoc import StreamDoc
 # StreamDoc to event stream
@@ -39,6 +40,12 @@ from SciStreams.interfaces.databroker.databases import databases
 # import SciStreams.core.StreamDoc as sd
 
 from SciStreams.config import client
+from SciStreams import config
+from SciStreams.core.fusion import fuse_chains
+from SciStreams.core.pipeline import Pipeline, load_pipeline, streams, \
+    mapping, combine, as_tuples
+from SciStreams.core.fingerprint import task_key
+from SciStreams.core.backpressure import sink_backpressure
 
 # the differen streams libs
 import streamz.core as sc
@@ -77,23 +84,24 @@ from SciStreams.streams.XS_Streams import make_calibration
 
 # Limit pressure by stopping submitting jobs after a max has been reached
 MAX_PROCESSING = 10000
+# max number of documents in flight on the event loop (asynchronous mode)
+MAX_PENDING = 100
+# the number of runs whose documents are read ahead of the pipeline
+PREFETCH_HEADERS = 4
+
+
+# the sinks block once this many of their results are computing
+sink_backpressure.max_in_flight = MAX_PROCESSING
 
 
 def wait_on_client():
     ''' Wait on client to limit pressure.
-        Depends on globals client and MAX_PROCESSING.'''
-    while True:
-        if not hasattr(client, 'processing'):
-            return True
-        free = False
-        for key, val in client.processing().items():
-            if len(val) < MAX_PROCESSING:
-                free = True
-        if free:
-            break
-        else:
-            print("waiting on client (60s). Currently backed up...")
-            time.sleep(60)
+        Returns as soon as the sinks have fewer than MAX_PROCESSING results
+        computing (see core/backpressure.py).'''
+    if sink_backpressure.wait(timeout=60) is False:
+        print("waiting on client. Currently backed up : {}".format(
+            sink_backpressure))
+        sink_backpressure.wait()
     return True
 
 
@@ -107,13 +115,10 @@ sin = sc.Stream(stream_name="Input")
 # and export them to a function
 # don't till the events yet
 stream_input = SciStreamCallback(sin.emit, remote=False, dbname='cms:data',
-                                 remote_load=True, fill=False)
+                                 remote_load=True, fill=False,
+                                 asynchronous=config.asynchronous)
+
 
-# these are abbreviations just to make streams access easier
-# this stream filters out data. only outputs data that will work in rest of
-# stream
-sin_primary, sout_primary, serr_primary = PrimaryFilteringStream()
-sin.connect(sin_primary)
 class _COUNTER:
     COUNTER=0
     def inc(self, *args, **kwargs):
@@ -128,7 +133,6 @@ NUMBER_IMAGES_ALL = _COUNTER()
 QUEUEDONE = _COUNTER()
 QUEUEDONE.set(0)
 sin.sink(NUMBER_IMAGES_ALL.inc)
-sout_primary.sink(NUMBER_IMAGES.inc)
 
 
 def _fill_events1(data, non_filled, dbname=None):
@@ -157,9 +161,12 @@ def fill_events(sdoc, dbname=None, remote=True):
         # submit remotely
         #print("remotely filling to client {}".format(client))
         #print("data : {}".format(sdoc['kwargs']))
+        # unfilled data are datum_ids, so this is cheap to key
+        key = task_key(_fill_events1, data=sdoc['kwargs'],
+                       non_filled=non_filled, dbname="cms:data")
         sdoc['kwargs'] = client.submit(_fill_events1, data=sdoc['kwargs'],
                                        non_filled=non_filled,
-                                       dbname="cms:data")
+                                       dbname="cms:data", key=key)
         #futures_cache.append(sdoc['kwargs'])
         #sdoc['kwargs'] = client.submit(lambda *x, **x2 : print('foo'))
         #print("done remotely filling")
@@ -171,45 +178,9 @@ def fill_events(sdoc, dbname=None, remote=True):
     return sdoc
 
 
-# remote is True always by default
-sout_filled = sc.map(sout_primary, fill_events, dbname='cms:data', remote=True)
-
-# sink to list for debugging
-# L_primary = sout_primary.sink_to_list()
-
-
-# get the attributes, clean them up and return
-# new sout_primary
-sin_attributes, sout_attributes = AttributeNormalizingStream()
-# L_attributes = sout_attributes.sink_to_list()
-sout_primary.connect(sin_attributes)
-
-sout_filled= scs.merge(sc.zip(sout_filled,
-                         scs.to_attributes(sout_attributes)))
-
-
-sin_calib, sout_calib = CalibrationStream()
-sout_attributes.connect(sin_calib)
-# L_calib = sout_calib.sink_to_list()
-
-# sout_calib2 = sout_calib
-# sout_calib = sc.Stream()
-
-# the PrimaryFilteringStream already split the detectors
-# s_image = sc.Stream()
-s_image = scs.add_attributes(sout_filled, stream_name="image")
-# L_image = s_image.sink_to_list()
-
-
-# TODO : fix and remove this is for pilatus300 should be in mask gen
-s_mask = scs.map(generate_mask, sout_attributes)
-# L_mask = s_mask.sink_to_list()
-
-
-# #s_zipped =
-# #L_zipped= s_zipped.sink_to_list()
-s_imgmaskcalib = scs.merge(sc.zip(s_image, sout_calib, s_mask))
-# L_imgmaskcalib = s_imgmaskcalib.sink_to_list()
+def FillingStream(inputs, dbname='cms:data', remote=True):
+    ''' the stage filling the events (remote is True always by default)'''
+    return sc.map(combine(inputs), fill_events, dbname=dbname, remote=remote)
 
 
 # some small streams
@@ -233,51 +204,14 @@ def get_stitch(**kwargs):
     return dict(stitchback=kwargs.get('stitchback', False))
 
 
-s_origin = scs.map(get_origin, sout_attributes)
-
-s_exposure = scs.map(get_exposure, sout_attributes, remote=True)
-
-s_stitch = scs.map(get_stitch, sout_attributes)
-# name the stream for proper output
-
-# circular average
-sin_circavg, sout_circavg = CircularAverageStream()
-s_imgmaskcalib.connect(sin_circavg)
-# L_circavg = sout_circavg.sink_to_list()
-
-# peak finding
-sin_peakfind, sout_peakfind = PeakFindingStream()
-sout_circavg.connect(sin_peakfind)
-
-# merge with sq
-sout_sqpeaks = scs.merge(sc.zip(sout_circavg, scs.select(sout_peakfind,
-                                'inds_peak', 'peaksx', 'peaksy')))
-
-# L_sqpeaks = sout_sqpeaks.sink_to_list()
+def get_qmap(calibration):
+    return dict(q_map=calibration.q_map)
 
 
 def normexposure(image, exposure_time):
     return dict(image=image/exposure_time)
 
 
-# image stitching
-# normalize by exposure time
-s_imagenorm = scs.map(normexposure, scs.merge(sc.zip(s_exposure, s_image)))
-# use this for image stitch
-s_imgmaskoriginstitch = scs.merge(sc.zip(s_imagenorm,
-                                         s_mask,
-                                         s_origin,
-                                         s_stitch))
-#s_imgmaskoriginstitch.sink(lambda *x, **x2: print("sin: {} {}".format(x, x2)))
-
-
-sin_stitched, sout_stitched = ImageStitchingStream(return_intermediate=True)
-# NOTE : disconnected image stitching
-#s_imgmaskoriginstitch.connect(sin_stitched)
-
-# L_stitched = sout_stitched.sink_to_list()
-
-
 def get_shape(**kwargs):
     img = kwargs.get('image', None)
     origin = kwargs.get('origin', None)
@@ -294,80 +228,11 @@ def get_shape(**kwargs):
     return dict(origin=origin, shape=img.shape)
 
 
-# TODO : only spawn new process if a condition is met
-#sout_stitched_attributes = scs.map(get_shape, sout_stitched)
-#sout_stitched_attributes = scs.merge(sc.zip(sout_attributes,
-                                            #sout_stitched_attributes))
-
-#s_calib_stitched = scs.map(make_calibration, sout_stitched_attributes)
-
-
 # the masked image. sometimes useful to use
 def maskimg(image, mask):
     return dict(image=image*mask)
 
 
-s_maskedimg = scs.map(maskimg, scs.select(s_imgmaskcalib, 'image', 'mask'))
-# L_maskedimg = s_maskedimg.sink_to_list()
-
-# make qphiavg image
-#
-s_img_mask_origin = scs.merge(sc.zip(s_image, s_mask, s_origin))
-s_qmap = scs.map(lambda calibration: dict(q_map=calibration.q_map),
-                 sout_calib)
-s_img_mask_origin_qmap = scs.merge(sc.zip(s_img_mask_origin, s_qmap))
-
-sin_qphiavg, sout_qphiavg = QPHIMapStream()
-#s_img_mask_origin_qmap.connect(sin_qphiavg)
-
-# L_qphiavg = sout_qphiavg.sink_to_list()
-
-sout_sqphipeaks = scs.merge(sc.zip(sout_qphiavg, scs.select(sout_peakfind,
-                                                            'inds_peak',
-                                                            'peaksx',
-                                                            'peaksy')))
-sout_sqphipeaks = scs.select(sout_sqphipeaks, ('sqphi', 'image'), ('qs', 'y'),
-                             ('phis', 'x'), ('peaksx', 'vals'))
-
-# L_sqphipeaks = sout_sqphipeaks.sink_to_list()
-
-sin_linecuts, sout_linecuts = LineCutStream(axis=0)
-sout_sqphipeaks.connect(sin_linecuts)
-# L_linecuts = sout_linecuts.sink_to_list()
-
-
-sin_thumb, sout_thumb = ThumbStream(blur=2, crop=None, resize=10)
-#s_image.connect(sin_thumb)
-#s_image.sink(lambda x : print("masked img : {}".format(x)))
-
-sin_angularcorr, sout_angularcorr = AngularCorrelatorStream(bins=(800, 360))
-#s_img_mask_origin_qmap.connect(sin_angularcorr)
-
-
-# L_angularcorr = sout_angularcorr.sink_to_list()
-
-sout_angularcorrpeaks = scs.merge(sc.zip(sout_angularcorr,
-                                         scs.select(sout_peakfind,
-                                                    'inds_peak',
-                                                    'peaksx',
-                                                    'peaksy')))
-sout_angularcorrpeaks = scs.select(sout_angularcorrpeaks,
-                                   ('rdeltaphiavg_n', 'image'),
-                                   ('qvals', 'y'),
-                                   ('phivals', 'x'),
-                                   ('peaksx', 'vals'))
-
-sin_linecuts_angularcorr, sout_linecuts_angularcorr = \
-    LineCutStream(axis=0, name="angularcorr")
-#sout_angularcorrpeaks.connect(sin_linecuts_angularcorr)
-# L_linecuts_angularcorr = sout_linecuts_angularcorr.sink_to_list()
-
-
-sin_tag, sout_tag = ImageTaggingStream()
-s_maskedimg.connect(sin_tag)
-# L_tag = sout_tag.sink_to_list()
-
-
 # custom written Stream
 # GISAXS line cuts stream
 def collapse(image, mask, axis=0):
@@ -380,19 +245,6 @@ def collapse(image, mask, axis=0):
     return dict(linecut=result)
 
 
-sin_gisaxs = sc.Stream()
-# get the line cuts
-sout_gisaxs_x = scs.map(collapse, sin_gisaxs, axis=1)
-sout_gisaxs_x = scs.add_attributes(sout_gisaxs_x, stream_name="gisaxs-linex")
-# L_gisaxs_x = sout_gisaxs_x.sink_to_list()
-
-sout_gisaxs_y = scs.map(collapse, sin_gisaxs, axis=0)
-sout_gisaxs_y = scs.add_attributes(sout_gisaxs_y, stream_name="gisaxs-liney")
-
-sin_imgmask = scs.merge(s_image.zip(s_mask))
-sin_imgmask.connect(sin_gisaxs)
-
-
 def get_results(sdoc):
 
     # should be moved to a general .gather() stream node method
@@ -405,167 +257,234 @@ def get_results(sdoc):
         sdoc['kwargs'] = sdoc['kwargs'].result()
 
 
-# sample on how to plot to callback and file
-# (must make it an event stream again first)
-# set to True to enable plotting (opens many windows)
-liveplots = False
-# NOTE : disabled sinking
-if True:
-
-    # make event streams for some sinks
-    event_stream_err_primary = scs.to_event_stream(serr_primary)
-    event_stream_img = scs.to_event_stream(s_image)
-    event_stream_sqphi = scs.to_event_stream(sout_qphiavg)
-    event_stream_sq = scs.to_event_stream(sout_circavg)
-    event_stream_peaks = scs.to_event_stream(sout_sqpeaks)
-    event_stream_maskedimg = scs.to_event_stream(s_maskedimg)
-    #event_stream_stitched = scs.to_event_stream(sout_stitched)
-    event_stream_linecuts = scs.to_event_stream(sout_linecuts)
-    event_stream_thumb = scs.to_event_stream(sout_thumb)
-    event_stream_angularcorr = scs.to_event_stream(sout_angularcorr)
-    event_stream_linecuts_angularcorr = \
-        scs.to_event_stream(sout_linecuts_angularcorr)
-    event_stream_tag = scs.to_event_stream(sout_tag)
-    event_stream_gisaxs_x = scs.to_event_stream(sout_gisaxs_x)
-    event_stream_gisaxs_y = scs.to_event_stream(sout_gisaxs_y)
-
-    if liveplots:
-        from SciStreams.callbacks.live import LiveImage, LivePlot
-        liveplot_sq = LivePlot('sqy', x='sqx', logx=True, logy=True)
-        liveimage_img = LiveImage('image', cmap="inferno", tofile="image.png",
-                                  norm=normalizer)
-        liveimage_sqphi = LiveImage('sqphi', cmap="inferno", aspect="auto",
-                                    tofile="sqphi.png", norm=normalizer)
-        liveimage_maskedimg = LiveImage('image', cmap="inferno", aspect="auto",
-                                        tofile="masked_image.png",
-                                        norm=normalizer)
-
-        # sample on how to make an event stream again
-        # turn outputs into event streams first (for databroker
-        # compatibility in the future)
-
-        # output to plotting  callbacks
-        event_stream_img.sink(scs.star(liveimage_img))
-        event_stream_sqphi.sink(scs.star(liveimage_sqphi))
-        event_stream_sq.sink(scs.star(liveplot_sq))
-        event_stream_maskedimg.sink(scs.star(liveimage_maskedimg))
-
-    # output to storing callbacks
-
-    # whether plots should be done remote or not
-    remote_plots=True
-
-    plot_storage_img = scs.star(SciStreamCallback(store_results_mpl,
-                                                  images=['image'],
-                                                  img_norm=normalizer,
-                                                  remote=remote_plots))
-    #plot_storage_stitch = scs.star(SciStreamCallback(store_results_mpl,
-                                                     #images=['image'],
-                                                     #img_norm=normalizer,
-                                                     #remote=remote_plots))
-    xlbl = "$q,(\AA^{-1})$"
-    ylbl = "I(q)"
-    plot_storage_sq = scs.star(SciStreamCallback(store_results_mpl,
-                                                 lines=[('sqx', 'sqy')],
-                                                 scale='loglog', xlabel=xlbl,
-                                                 ylabel=ylbl,
-                                                 remote=remote_plots))
-    plot_storage_sqphi = scs.star(SciStreamCallback(store_results_mpl,
-                                                    images=['sqphi'],
-                                                    img_norm=normalizer,
-                                                    aspect='auto',
-                                                    xlabel="$\phi\,$(radians)",
-                                                    ylabel="$q\,$(pixel)",
-                                                    remote=remote_plots))
-    plot_storage_peaks = scs.star(SciStreamCallback(store_results_mpl,
-                                                    lines=[dict(x='sqx',
-                                                                y='sqy'),
-                                                           dict(x='peaksx',
-                                                                y='peaksy',
-                                                                marker='o',
-                                                                color='r',
-                                                                linewidth=0)],
-                                                    xlabel=xlbl, ylabel=ylbl,
-                                                    scale='loglog',
-                                                    remote=remote_plots))
-    plot_storage_linecuts = \
-        scs.star(SciStreamCallback(store_results_mpl,
-                                   linecuts=[('linecuts_domain',  # x
-                                              'linecuts',  # y
-                                              'linecuts_vals')],
-                                   remote=remote_plots))  # val
-    plot_storage_thumb = scs.star(SciStreamCallback(store_results_mpl,
-                                                    images=['thumb'],
-                                                    img_norm=normalizer,
-                                                    remote=remote_plots))
-    plot_storage_angularcorr = \
-        scs.star(SciStreamCallback(store_results_mpl,
-                                   images=['rdeltaphiavg_n'],
-                                   img_norm=normalizer, vmin=0, vmax=1,
-                                   xlabel="$\phi\,(radians)$",
-                                   ylabel="q\,(pixel)",
-                                   aspect='auto',
-                                   remote=remote_plots))
-
-    plot_storage_linecuts_angularcorr = \
-        scs.star(SciStreamCallback(store_results_mpl,
-                                   linecuts=[('linecuts_domain',  # x
-                                              'linecuts',  # y
-                                              'linecuts_vals')],
-                                   xlabel="$\Delta\phi$\,(radians)$",
-                                   ylabel="$c(\Delta\phi)$",
-                                   remote=remote_plots))  # value
-
-    plot_storage_gisaxs = scs.star(SciStreamCallback(store_results_mpl,
-                                                     lines=['linecut'],
-                                                     remote=remote_plots))
-
-    sc.sink(event_stream_img, plot_storage_img)
-    #sc.sink(event_stream_img, print)
-    #sc.sink(event_stream_img, lambda x : print(x[1][2].result()))
-    #sc.sink(event_stream_img,
-            #scs.star(SciStreamCallback(store_results_hdf5)))
-    #sc.sink(event_stream_img,
-    #scs.star(SciStreamCallback(store_results_hdf5)))
-    #sc.sink(event_stream_stitched, plot_storage_stitch)
-
-    #sc.sink(event_stream_stitched,
-            #scs.star(SciStreamCallback(store_results_hdf5)))
-    sc.sink(event_stream_sq, plot_storage_sq)
-    #sc.sink(event_stream_sq,
-            #scs.star(SciStreamCallback(store_results_hdf5)))
-    sc.sink(event_stream_sqphi, plot_storage_sqphi)
-    #sc.sink(event_stream_sqphi,
-            #scs.star(SciStreamCallback(store_results_hdf5)))
-    sc.sink(event_stream_peaks, plot_storage_peaks)
-    sc.sink(event_stream_peaks,
-            scs.star(SciStreamCallback(store_results_hdf5)))
-    sc.sink(event_stream_linecuts, plot_storage_linecuts)
-    #sc.sink(event_stream_thumb, plot_storage_thumb)
-    #sc.sink(event_stream_angularcorr, plot_storage_angularcorr)
-    #sc.sink(event_stream_linecuts_angularcorr,
-            #plot_storage_linecuts_angularcorr)
-    #sc.sink(event_stream_gisaxs_x, plot_storage_gisaxs)
-    #sc.sink(event_stream_gisaxs_y, plot_storage_gisaxs)
-
-    # save the peaks info
-    #sc.sink(event_stream_peaks,
-            #scs.star(SciStreamCallback(store_results_hdf5)))
-
-    #sc.sink(event_stream_img,
-            #scs.star(SciStreamCallback(store_results_hdf5)))
-
-    #sc.sink(event_stream_tag,
-    #       scs.star(SciStreamCallback(store_results_xml)))
-    #sc.sink(event_stream_tag, print)
-
-    sc.sink(event_stream_err_primary,
-            scs.star(SciStreamCallback(store_results_xml,
-                                       stream_name="error")))
-    #sc.sink(event_stream_tag,
-            #scs.star(SciStreamCallback(store_results_hdf5)))
-    # scs.map(print, event_stream_img)
-
+# the stage factories the pipeline specs can name (see core/pipeline.py)
+STAGE_FACTORIES = dict(
+    PrimaryFilteringStream=streams(PrimaryFilteringStream),
+    AttributeNormalizingStream=streams(AttributeNormalizingStream),
+    CalibrationStream=streams(CalibrationStream),
+    CircularAverageStream=streams(CircularAverageStream),
+    PeakFindingStream=streams(PeakFindingStream),
+    QPHIMapStream=streams(QPHIMapStream),
+    ImageStitchingStream=streams(ImageStitchingStream),
+    LineCutStream=streams(LineCutStream),
+    ThumbStream=streams(ThumbStream),
+    AngularCorrelatorStream=streams(AngularCorrelatorStream),
+    ImageTaggingStream=streams(ImageTaggingStream),
+    FillingStream=FillingStream,
+    generate_mask=mapping(generate_mask),
+    get_origin=mapping(get_origin),
+    get_exposure=mapping(get_exposure, remote=True),
+    get_stitch=mapping(get_stitch),
+    get_qmap=mapping(get_qmap),
+    get_shape=mapping(get_shape),
+    normexposure=mapping(normexposure),
+    maskimg=mapping(maskimg),
+    collapse=mapping(collapse),
+)
+
+
+def storing_sink(store_results, **defaults):
+    ''' The sink factory of the storing callback of store_results.'''
+    def make_sink(stream, **kwargs):
+        kwargs = dict(defaults, **kwargs)
+        # YAML has no tuples
+        for key in ('lines', 'linecuts'):
+            if key in kwargs:
+                kwargs[key] = list(as_tuples(kwargs[key]))
+        if 'images' in kwargs:
+            kwargs.setdefault('img_norm', normalizer)
+        # the storing callbacks take the documents of each result as one
+        # bundle (one task)
+        event_stream = scs.to_event_stream(stream, bundle=True)
+        return sc.sink(event_stream,
+                       scs.star(SciStreamCallback(store_results, **kwargs)))
+    return make_sink
+
+
+def live_sink(stream, callback='LiveImage', **kwargs):
+    ''' Plot to a live callback (opens a window per sink).'''
+    from SciStreams.callbacks import live
+    if callback == 'LiveImage':
+        kwargs.setdefault('norm', normalizer)
+    callback = getattr(live, callback)(**kwargs)
+    # the live plotting callbacks need the separate documents (gathered
+    # here, see to_event_stream)
+    event_stream = scs.to_event_stream(stream, bundle=False)
+    return sc.sink(event_stream, scs.star(callback))
+
+
+# whether plots should be done remote or not
+remote_plots = True
+
+SINK_FACTORIES = dict(plot=storing_sink(store_results_mpl,
+                                        remote=remote_plots),
+                      hdf5=storing_sink(store_results_hdf5),
+                      xml=storing_sink(store_results_xml),
+                      live=live_sink)
+
+
+xlbl = "$q,(\AA^{-1})$"
+ylbl = "I(q)"
+# the XS pipeline. Only the stages some enabled sink needs are built (set a
+# sink's enabled to True to add its analysis). The pipeline option (a YAML
+# file of the same layout) replaces it
+DEFAULT_PIPELINE = {
+    'stages': {
+        # this stream filters out data. only outputs data that will work in
+        # rest of stream
+        'primary': dict(factory='PrimaryFilteringStream', inputs=['input'],
+                        outputs=['out', 'err']),
+        'filled': dict(factory='FillingStream', inputs=['primary']),
+        # get the attributes, clean them up
+        'attributes': dict(factory='AttributeNormalizingStream',
+                           inputs=['primary']),
+        'attributes_only': dict(factory='to_attributes',
+                                inputs=['attributes']),
+        'image': dict(factory='add_attributes',
+                      inputs=['filled', 'attributes_only'],
+                      kwargs=dict(stream_name="image")),
+        'calibration': dict(factory='CalibrationStream',
+                            inputs=['attributes']),
+        # TODO : fix and remove this is for pilatus300 should be in mask gen
+        'mask': dict(factory='generate_mask', inputs=['attributes']),
+        'imgmaskcalib': dict(factory='merge',
+                             inputs=['image', 'calibration', 'mask']),
+        'origin': dict(factory='get_origin', inputs=['attributes']),
+        'exposure': dict(factory='get_exposure', inputs=['attributes']),
+        'stitch': dict(factory='get_stitch', inputs=['attributes']),
+        'circavg': dict(factory='CircularAverageStream',
+                        inputs=['imgmaskcalib']),
+        'peakfind': dict(factory='PeakFindingStream', inputs=['circavg']),
+        'peaks': dict(factory='select', inputs=['peakfind'],
+                      kwargs=dict(mapping=['inds_peak', 'peaksx',
+                                           'peaksy'])),
+        # merge with sq
+        'sqpeaks': dict(factory='merge', inputs=['circavg', 'peaks']),
+        # image stitching, normalize by exposure time
+        'imagenorm': dict(factory='normexposure',
+                          inputs=['exposure', 'image']),
+        'stitched': dict(factory='ImageStitchingStream',
+                         inputs=['imagenorm', 'mask', 'origin', 'stitch'],
+                         kwargs=dict(return_intermediate=True)),
+        'maskedimg': dict(factory='maskimg', inputs=['image', 'mask']),
+        # make qphiavg image
+        'qmap': dict(factory='get_qmap', inputs=['calibration']),
+        'qphiavg': dict(factory='QPHIMapStream',
+                        inputs=['image', 'mask', 'origin', 'qmap']),
+        'sqphipeaks': dict(factory='select', inputs=['qphiavg', 'peaks'],
+                           kwargs=dict(mapping=[('sqphi', 'image'),
+                                                ('qs', 'y'), ('phis', 'x'),
+                                                ('peaksx', 'vals')])),
+        'linecuts': dict(factory='LineCutStream', inputs=['sqphipeaks'],
+                         kwargs=dict(axis=0)),
+        'thumb': dict(factory='ThumbStream', inputs=['image'],
+                      kwargs=dict(blur=2, crop=None, resize=10)),
+        'angularcorr': dict(factory='AngularCorrelatorStream',
+                            inputs=['image', 'mask', 'origin', 'qmap'],
+                            kwargs=dict(bins=(800, 360))),
+        'angularcorrpeaks': dict(factory='select',
+                                 inputs=['angularcorr', 'peaks'],
+                                 kwargs=dict(mapping=[
+                                     ('rdeltaphiavg_n', 'image'),
+                                     ('qvals', 'y'), ('phivals', 'x'),
+                                     ('peaksx', 'vals')])),
+        'linecuts_angularcorr': dict(factory='LineCutStream',
+                                     inputs=['angularcorrpeaks'],
+                                     kwargs=dict(axis=0,
+                                                 name="angularcorr")),
+        'tag': dict(factory='ImageTaggingStream', inputs=['maskedimg']),
+        # get the line cuts
+        'linex': dict(factory='collapse', inputs=['image', 'mask'],
+                      kwargs=dict(axis=1)),
+        'gisaxs_x': dict(factory='add_attributes', inputs=['linex'],
+                         kwargs=dict(stream_name="gisaxs-linex")),
+        'liney': dict(factory='collapse', inputs=['image', 'mask'],
+                      kwargs=dict(axis=0)),
+        'gisaxs_y': dict(factory='add_attributes', inputs=['liney'],
+                         kwargs=dict(stream_name="gisaxs-liney")),
+    },
+    'sinks': {
+        'image': dict(factory='plot', input='image',
+                      kwargs=dict(images=['image'])),
+        'image_hdf5': dict(factory='hdf5', input='image', enabled=False),
+        'sq': dict(factory='plot', input='circavg',
+                   kwargs=dict(lines=[('sqx', 'sqy')], scale='loglog',
+                               xlabel=xlbl, ylabel=ylbl)),
+        'sq_hdf5': dict(factory='hdf5', input='circavg', enabled=False),
+        'peaks': dict(factory='plot', input='sqpeaks',
+                      kwargs=dict(lines=[dict(x='sqx', y='sqy'),
+                                         dict(x='peaksx', y='peaksy',
+                                              marker='o', color='r',
+                                              linewidth=0)],
+                                  xlabel=xlbl, ylabel=ylbl,
+                                  scale='loglog')),
+        # save the peaks info
+        'peaks_hdf5': dict(factory='hdf5', input='sqpeaks'),
+        'stitched': dict(factory='plot', input='stitched',
+                         kwargs=dict(images=['image']), enabled=False),
+        'sqphi': dict(factory='plot', input='qphiavg', enabled=False,
+                      kwargs=dict(images=['sqphi'], aspect='auto',
+                                  xlabel="$\phi\,$(radians)",
+                                  ylabel="$q\,$(pixel)")),
+        'linecuts': dict(factory='plot', input='linecuts', enabled=False,
+                         kwargs=dict(linecuts=[('linecuts_domain',  # x
+                                                'linecuts',  # y
+                                                'linecuts_vals')])),  # val
+        'thumb': dict(factory='plot', input='thumb', enabled=False,
+                      kwargs=dict(images=['thumb'])),
+        'angularcorr': dict(factory='plot', input='angularcorr',
+                            enabled=False,
+                            kwargs=dict(images=['rdeltaphiavg_n'], vmin=0,
+                                        vmax=1,
+                                        xlabel="$\phi\,(radians)$",
+                                        ylabel="q\,(pixel)",
+                                        aspect='auto')),
+        'linecuts_angularcorr': dict(factory='plot',
+                                     input='linecuts_angularcorr',
+                                     enabled=False,
+                                     kwargs=dict(
+                                         linecuts=[('linecuts_domain',  # x
+                                                    'linecuts',  # y
+                                                    'linecuts_vals')],
+                                         xlabel="$\Delta\phi$\,(radians)$",
+                                         ylabel="$c(\Delta\phi)$")),
+        'gisaxs_x': dict(factory='plot', input='gisaxs_x', enabled=False,
+                         kwargs=dict(lines=['linecut'])),
+        'gisaxs_y': dict(factory='plot', input='gisaxs_y', enabled=False,
+                         kwargs=dict(lines=['linecut'])),
+        'tag': dict(factory='xml', input='tag', enabled=False),
+        'errors': dict(factory='xml', input='primary:err',
+                       kwargs=dict(stream_name="error")),
+        # sample on how to plot to a live callback (opens many windows)
+        'live_image': dict(factory='live', input='image', enabled=False,
+                           kwargs=dict(callback='LiveImage', field='image',
+                                       cmap="inferno", tofile="image.png")),
+        'live_sq': dict(factory='live', input='circavg', enabled=False,
+                        kwargs=dict(callback='LivePlot', y='sqy', x='sqx',
+                                    logx=True, logy=True)),
+    },
+}
+
+
+if config.pipeline is not None:
+    print("Loading the pipeline from {}".format(config.pipeline))
+    pipeline = Pipeline(load_pipeline(config.pipeline),
+                        factories=STAGE_FACTORIES, sinks=SINK_FACTORIES)
+else:
+    pipeline = Pipeline(DEFAULT_PIPELINE, factories=STAGE_FACTORIES,
+                        sinks=SINK_FACTORIES)
+print("Building the pipeline, sinks : {}".format(pipeline.enabled_sinks()))
+# the output stream of each stage built, by name
+nodes = pipeline.build(sin)
+if 'primary' in nodes:
+    nodes['primary'].sink(NUMBER_IMAGES.inc)
+
+
+# fuse linear chains of stages into single tasks (the graph must be complete
+# at this point)
+if config.fused:
+    for chain in fuse_chains(sin):
+        print("Fused stages : {}".format(" -> ".join(chain)))
 
 
 class BufferStream:
@@ -578,8 +497,8 @@ class BufferStream:
         This unfortunately can't be distributed.
     '''
     def __init__(self, dbname=None):
-        self.start_docs = dict()
-        self.descriptor_docs = dict()
+        # uid : parent uid of the starts and descriptors
+        self.documents = DocumentTree()
         self.dbname = dbname
 
         if dbname is not None:
@@ -595,15 +514,15 @@ class BufferStream:
         if name == 'start':
             parent_uid, self_uid = None, doc['uid']
             # add the start that came through
-            self.start_docs[self_uid] = parent_uid
+            self.documents.add(parent_uid, self_uid, None)
         elif name == 'descriptor':
             parent_uid, self_uid = doc['run_start'], doc['uid']
             # now add descriptor
-            self.descriptor_docs[self_uid] = parent_uid
+            self.documents.add(parent_uid, self_uid, None)
         elif name == 'event':
             parent_uid, self_uid = doc['descriptor'], doc['uid']
             # fill events if not filled
-            descriptor = self.descriptor_docs[doc['descriptor']]
+            descriptor = self.documents[doc['descriptor']]
             # print("before filled events : {}".format(doc))
             #doc = fill_events(doc, dbname=dbname)#db=self.db)
             # print("filled events : {}".format(doc))
@@ -619,62 +538,11 @@ class BufferStream:
         return name, (parent_uid, self_uid, doc)
 
     def clear_all(self):
-        self.start_docs = dict()
-        self.descriptors = dict()
+        self.documents.clear()
 
     def clear_start(self, start_uid):
-        # clear the start
-        self.start_docs.pop(start_uid)
-
-        # now clear the descriptors
-        # first find them
-        desc_uids = list()
-        for desc_uid, parent_uid in self.descriptor_docs.items():
-            if parent_uid == start_uid:
-                desc_uids.append(desc_uid)
-        # now pop them
-        for desc_uid in desc_uids:
-            self.descriptor_docs.pop(desc_uid)
-
-
-def future_collector(queue1, queuedone, errorqueue, delay=.1):
-    ''' Collect futures. Just call result()'''
-    print("Started the future collector")
-    while True:
-        #print("Checking done status")
-        if queuedone() == 1  and len(queue1) == 0:
-            print("Done, exiting...")
-            break
-        #print("Checking for a future...")
-        if len(queue1) > 0:
-            # pop first element
-            next_item = queue1.popleft()
-            #print(next_item)
-            if next_item.done() is False:
-                # add to end
-                if next_item.status == 'pending':
-                    #print("{} not done, popping back".format(next_item))
-                    queue1.append(next_item)
-                    time.sleep(delay)
-                elif next_item.status == 'error':
-                    print("There was an error with this computation.")
-                    print("Putting to error queue: {}".format(next_item))
-                    next_item.cancel()
-                    error_queue.append(next_item.key)
-                    del next_item
-                else:
-                    print("Unknown status: {}".format(next_item.status))
-                    print("Putting to error queue: {}".format(next_item))
-                    next_item.cancel()
-                    error_queue.append(next_item.key)
-                    del next_item
-            else:
-                # release the result first just in case
-                # TODO : put in some deque to save for later
-                next_item.release()
-        else:
-            time.sleep(delay)
-    print("Finished")
+        # clear the start and its descriptors
+        self.documents.release(start_uid)
 
 
 def queue_monitor(queue1, queuedone, output_file):
@@ -710,11 +578,15 @@ def val_monitor(val1, queuedone, output_file):
     print("####\nQueue done!!!")
 
 def start_run(start_time=None, stop_time=None, uids=None, loop_forever=True,
-              poll_interval=60, maxrun=None, queue_monitor_filename="out.txt"):
+              poll_interval=60, maxrun=None, queue_monitor_filename="out.txt",
+              asynchronous=None, min_poll_interval=1):
     ''' Start running the streaming pipeline.
 
-        start_time : str
-            the start time for the run
+        start_time : str or float, optional
+            the start time for the run. Defaults to resuming from the ingest
+            cursor (see interfaces/databroker/cursor.py), or to 24 hours ago
+            if there is none. Strings that parse_time doesn't understand are
+            passed on to the databroker query
 
         stop_time : str, optional
             the stop time of the initial search
@@ -727,84 +599,88 @@ def start_run(start_time=None, stop_time=None, uids=None, loop_forever=True,
 
         poll_interval : int, optional
             poll interval (if loop is True)
-            This is the interval to wait between checking for new data
+            This is the longest interval to wait between checking for new
+            data. The interval goes down to min_poll_interval while new data
+            comes in, and doubles up to this while there is none
 
         maxrun : int, optional
             DO NOT USE (for debugging only)
             specify max number of documents to run
             ensures that pipeline stops after finite time
+
+        asynchronous : bool, optional
+            if True, the documents are sent to the stream on the event loop
+            (see core/asynchronous.py) and this loop goes on reading
+            documents while the stream works, with at most MAX_PENDING in
+            flight. Defaults to the asynchronous config option
     '''
     # patchy way to get stream for now, need to fix later
     from SciStreams.interfaces.databroker.databases import databases
 
-    #start the future collector
+    # the results of the sinks are released by the registry when they're done
     from threading import Thread
-    from SciStreams.config import futures_cache_sinks, futures_total
+    from SciStreams.core.registry import futures_registry
     queuedone = _COUNTER()
-    errorqueue = deque()
-
-    thread = Thread(target=future_collector, args=(futures_cache_sinks,queuedone, errorqueue))
-    thread.start()
 
     # also make a file of the totals
     total_filename = queue_monitor_filename + ".total.txt"
 
-    thread_mon = Thread(target=queue_monitor, args=(futures_cache_sinks,
+    thread_mon = Thread(target=queue_monitor, args=(futures_registry,
                                                     queuedone,
                                                     queue_monitor_filename,))
 
-    thread_mon_totals = Thread(target=val_monitor, args=(futures_total,
-                                                    queuedone,
-                                                    total_filename,))
+    thread_mon_totals = Thread(target=val_monitor,
+                               args=(lambda: futures_registry.total,
+                                     queuedone, total_filename,))
 
     thread_mon.start()
     thread_mon_totals.start()
 
     cmsdb = databases['cms:data']
 
+    if asynchronous is None:
+        asynchronous = config.asynchronous
+    if asynchronous:
+        from SciStreams.core.asynchronous import run_in_loop
+    pending = deque()
+
     kwargs = dict()
     if stop_time is not None:
         kwargs['stop_time'] = stop_time
-    if start_time is not None:
-        kwargs['start_time'] = start_time
 
-    from uuid import uuid4
+    # where the last run ingested is kept, to resume from
+    cursor = IngestCursor(config.ingest_cursor)
+    if start_time is not None:
+        if isinstance(start_time, str):
+            try:
+                start_time = parse_time(start_time)
+            except ValueError:
+                # left to the databroker, the cursor then starts at the
+                # first run the query finds
+                kwargs['start_time'] = start_time
+                start_time = None
+        cursor.reset(start_time)
+    elif cursor.time is None:
+        print("No ingest cursor found, starting from 24 hours ago")
+        cursor.reset(time.time() - 24*3600)
+    else:
+        print("Resuming from the ingest cursor : {}".format(cursor))
+    poll = AdaptivePoll(min_poll_interval, poll_interval)
 
     def stream_gen(hdrs):
-        ''' Intercept FileNotFoundError from file handler.
-            Issue a stop if some error is raised
+        ''' The documents of hdrs, read ahead (see
+            interfaces/databroker/prefetch.py). A run that fails to be read
+            (FileNotFoundError from file handler etc) ends with a stop.
         '''
-        current_start = None
-        hdrs = iter(hdrs)
-        done = False
-
-        while True:
-            try:
-                hdr = next(hdrs)
-            except StopIteration:
-                done=True
-            except Exception as exc:
-                print("Exception in calling next of hdrs")
-                print(exc)
-            if done:
-                break
-            gen = hdr.documents(fill=False)
-            try:
-                for nds in gen:
-                    if nds[0] == 'start':
-                        current_start = nds[1]['uid']
-                    elif nds[0] == 'stop':
-                        # reset the start
-                        current_start = None
-                    yield nds
-            # except FileNotFoundError:
-            except Exception:
-                # don't yield event, just give a stop
-                yield ('stop', {'uid': str(uuid4()),
-                                'run_start': current_start})
+        for hdr, documents in prefetch_documents(hdrs,
+                                                 depth=PREFETCH_HEADERS):
+            for nds in documents:
+                yield nds
+            # the whole run was sent
+            if uids is None:
+                cursor.advance(hdr)
     if uids is not None:
         print("Starting a run only on selected uids")
-        hdrs = cmsdb[uids]
         loop_forever = False
 
     while True:
@@ -823,7 +699,11 @@ def start_run(start_time=None, stop_time=None, uids=None, loop_forever=True,
                         cnt +=1
             print("{} headers, {} events total".format(nhdrs, cnt))
 
-        hdrs = cmsdb(**kwargs)
+        if uids is not None:
+            hdrs = cmsdb[uids]
+        else:
+            # the runs after the cursor, oldest first
+            hdrs = new_headers(cmsdb, cursor, **kwargs)
         stream = stream_gen(hdrs)
 
         # stream converter
@@ -833,33 +713,36 @@ def start_run(start_time=None, stop_time=None, uids=None, loop_forever=True,
         # TODO look for FileNotFoundError in nds iteration
         # make sure it's an iterator
         #stream = iter(stream)
-        last_start = None
         while True:
             try:
                 # add a waiting loop
                 wait_on_client()
                 nds = stream_buffer(next(stream))
-                if nds[0] == 'start':
-                    last_start = nds[1][2]
                 #print("iterating : {}".format(nds[0]))
                 t0 = time.time()
                 print("sending to stream {} s".format(time.time()-t0))
-                stream_input(*nds)
+                if asynchronous:
+                    pending.append(run_in_loop(stream_input, *nds))
+                    while len(pending) > MAX_PENDING:
+                        pending.popleft().result()
+                else:
+                    stream_input(*nds)
                 print("done : {} s".format(time.time()-t0))
                 #plt.pause(.1)
                 if maxrun is not None and NUMBER_IMAGES() > maxrun:
                     print("Computed {} images and maxrun is {}".format(NUMBER_IMAGES(), maxrun))
                     print("Terminating...")
                     break
-                print("Data Sets\tProcessed\tIgnored\t\tJobs Running\tTotal")
+                print("Data Sets\tProcessed\tIgnored\t\tJobs Running\tTotal"
+                      "\tDone/s")
                 msg = "{}\t\t".format(NUMBER_IMAGES_ALL())
                 msg += "{}\t\t".format(NUMBER_IMAGES())
                 msg += "{}\t\t".format(NUMBER_IMAGES_ALL() - NUMBER_IMAGES())
-                msg += "{}\t\t".format(len(futures_cache_sinks))
-                msg += "{}".format(futures_total())
+                msg += "{}\t\t".format(len(futures_registry))
+                msg += "{}\t".format(futures_registry.total)
+                msg += "{:.2f}".format(futures_registry.throughput())
                 print(msg)
                 #print("\n\n\n\n####\n\nNumber of images sent : {}".format(NUMBER_IMAGES()))
-                #print("\n\n\n\n####\n\nNumber of Futures: {}".format(len(futures_cache_sinks)))
             except StopIteration:
                 break
             except FileNotFoundError:
@@ -868,32 +751,30 @@ def start_run(start_time=None, stop_time=None, uids=None, loop_forever=True,
             print("Exiting loop")
             break
 
-        # get the latest time, add 1 second to not overlap it
-        if last_start is not None:
-            last_time = last_start['time']
-        else:
-            last_time = time.time()
-        t1 = time.localtime(last_time)
-        start_time = time.strftime("%Y-%m-%d %H:%M:%S", t1)
-        kwargs['start_time'] = start_time
+        # the next query starts from the cursor
         # remove stop_time after first iteration
         if 'stop_time' in kwargs:
             kwargs.pop('stop_time')
-        # at the end, update time stamp for latest time
+        interval = poll.next(len(hdrs))
         msg = "Reached end, waiting "
-        msg += "{} sec for more data...".format(poll_interval)
+        msg += "{} sec for more data...".format(interval)
         print(msg)
-        time.sleep(poll_interval)
+        # the held results still expire while there's no data
+        futures_registry.expire()
+        time.sleep(interval)
+
+    # the documents still on the event loop
+    while len(pending) > 0:
+        pending.popleft().result()
 
     # set queuedone to 1
     queuedone.set(1)
     print("Final Count : {} images analyzed".format(NUMBER_IMAGES()))
     print("Now waiting for final results to finish")
-    while len(futures_cache_sinks) > 0:
-        time.sleep(1)
-        print("Not done, waiting, {} jobs left...".format(len(futures_cache_sinks)))
+    while not futures_registry.wait(timeout=1):
+        print("Not done, waiting, {} jobs left...".format(
+            len(futures_registry)))
 
-    thread.join()
     thread_mon.join()
     thread_mon_totals.join()
 
@@ -25,18 +25,17 @@ from ..processing.nn_fbbenet import infer
 from ..processing.peak_finding import peak_finding
 
 
-from ..config import config
-from ..config import required_attributes, typesdict
+from SciStreams import config
 
 
 from ..data.Calibration import Calibration
 import streamz as sc
 import SciStreams.core.scistreams as scs
 import SciStreams.core.StreamDoc as sd
+from SciStreams.core.fingerprint import task_key, fingerprint
+from SciStreams.core.batch import accepts_batches, stack
 
-from SciStreams.config import futures_cache
-
-keymaps = config['keymaps']
+from SciStreams.core.registry import futures_registry
 
 # NOTE : When defining streams, make sure to place the expected inputs
 # and outputs in the docstrings! See stream below for a good example.
@@ -89,7 +88,8 @@ def pick_allowed_detectors(sdoc):
             return {'image' : data}
 
         if isinstance(data, Future):
-            new_kwargs = client.submit(make_dict, key, data)
+            new_kwargs = client.submit(make_dict, key, data,
+                                       key=task_key(make_dict, key, data))
 
         # the key is now image
         sdoc_new = sd.StreamDoc(kwargs=new_kwargs, attributes=new_md,
@@ -105,13 +105,13 @@ def filter_attributes(sdoc, type='main'):
     #print("filterting attributes")
     attr = sdoc['attributes']
     # get the sub required attributes
-    reqattr = required_attributes['main']
+    reqattr = config.required_attributes['main']
     for key, val in reqattr.items():
         if key not in attr:
             print("bad attributes")
             print("{} not in attributes".format(key))
             return False
-        elif not isinstance(attr[key], typesdict[val]):
+        elif not isinstance(attr[key], config.typesdict[val]):
             print("bad attributes")
             print("key {} not an instance of {}".format(key, val))
             return False
@@ -281,7 +281,7 @@ def normalize_calib_dict(external_keymap=None, **md):
     '''
     if external_keymap is None:
         keymap_name = md.get("keymap_name", "cms")
-        keymap = keymaps[keymap_name]
+        keymap = config.config['keymaps'][keymap_name]
     else:
         keymap = external_keymap
 
@@ -408,7 +408,8 @@ def CalibrationStream():
 
     # this piece should be computed using Dask
     def _generate_qxyz_maps(calibration):
-        calibration.generate_maps()
+        # only the maps the streams use, the others are computed if asked for
+        calibration.generate_maps('q', 'r')
         return dict(calibration=calibration)
 
     # from streamz.dask import scatter, gather
@@ -432,9 +433,10 @@ def CalibrationStream():
     sout = scs.map(_generate_qxyz_maps, sout)
     # sout.map(lambda x :
     #          x['kwargs'].result()['calibration'].q_map).sink(print)
-    # sink the futures to a global list (deque)
-    sout.map(lambda x: x['kwargs']).sink(futures_cache.append)
-    sout.map(lambda x: x['args']).sink(futures_cache.append)
+    # hold the futures (so the calibrations are reused on the cluster), they
+    # are released when their run stops or after futures_ttl (see
+    # core/registry.py)
+    sout.sink(_hold_calibration)
 
     return sin, sout
 
@@ -504,7 +506,9 @@ def make_calibration(**md):
         raise TypeError
     calib_object = Calibration(wavelength_A=wavelength_A,
                                distance_m=distance_m,
-                               pixel_size_um=pixel_size_um)
+                               pixel_size_um=pixel_size_um,
+                               dtype=config.calibration_dtype,
+                               master_margin=config.calibration_master_margin)
     # NOTE : width, height reversed in calibration
     try:
         height, width = md['shape']
@@ -521,10 +525,21 @@ def make_calibration(**md):
 
 
 def _generate_qxyz_maps(calibration):
-    calibration.generate_maps()
+    calibration.generate_maps('q', 'r')
     return dict(calibration=calibration)
 
 
+def _hold_calibration(sdoc):
+    ''' Hold the calibration of sdoc in the futures_registry, owned by its
+        run (the start uid in its attributes).'''
+    attributes = sdoc['attributes']
+    # remote attributes aren't waited on, the calibration then only expires
+    run = attributes.get('uid', None) if isinstance(attributes, dict) \
+        else None
+    return futures_registry.track(sdoc, run=run, stage="calibration",
+                                  hold=True)
+
+
 def CircularAverageStream():
     ''' Circular average stream.
 
@@ -628,11 +643,25 @@ def CircularAverageStream():
     return sin, sout
 
 
-def circavg_from_calibration(image, calibration, mask=None, bins=None):
+@accepts_batches
+def circavg_from_calibration(image, calibration, mask=None, bins=None,
+                             batch=False):
     # print("circavg : qmap : {} ".format(calibration.q_map))
     # print("circavg : rmap: {} ".format(calibration.r_map))
+    if batch:
+        # there's one calibration per image
+        calibrations = calibration
+        calibration = calibrations[0]
+        geometry = fingerprint(calibration)
+        if not all(fingerprint(calib) == geometry for calib in calibrations):
+            q_map = stack([calib.q_map for calib in calibrations])
+            r_map = stack([calib.r_map for calib in calibrations])
+            return circavg(image, q_map=q_map, r_map=r_map, mask=mask,
+                           bins=bins, batch=True)
+    # the binning only depends on the geometry, the bins and the mask
     return circavg(image, q_map=calibration.q_map, r_map=calibration.r_map,
-                   mask=mask, bins=bins)
+                   mask=mask, bins=bins, binning_key=fingerprint(calibration),
+                   batch=batch)
 
 
 def QPHIMapStream(bins=(800, 360)):
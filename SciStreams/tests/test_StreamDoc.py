@@ -1,6 +1,40 @@
+from contextlib import contextmanager
+
 from streamz import Stream
+from SciStreams import config
 from SciStreams.core.StreamDoc import StreamDoc
 from SciStreams.core.StreamDoc import merge, psdm, psda
+from SciStreams.core.local_client import PoolClient
+
+
+@contextmanager
+def pool_client():
+    ''' Submit the tasks to a PoolClient (real Futures) in the block.'''
+    previous = config.get_client()
+    client = PoolClient('threads', 2)
+    config._client = client
+    try:
+        yield client
+    finally:
+        config._client = previous
+        client.close()
+
+
+def clients():
+    ''' The inline client, then a PoolClient (see pool_client), so that
+        a test runs on local results and on Futures.'''
+    yield config.get_client()
+    with pool_client() as client:
+        yield client
+
+
+def submitted(client, sdoc):
+    ''' sdoc with its args and kwargs submitted to client (Futures, on a
+        PoolClient), like the results of a stage.'''
+    for key in ('args', 'kwargs'):
+        value = sdoc[key]
+        sdoc[key] = client.submit(type(value), value)
+    return sdoc
 
 
 def test_stream_map():
@@ -96,3 +130,195 @@ def test_new_streamdoc():
     # update from another sdoc
     sdoc2 = StreamDoc(streamdoc=sdoc)
     assert sdoc2['kwargs']['a'] == 1
+
+
+def test_stream_map_fused():
+    ''' A fused stage should give the same result as the regular one.'''
+
+    def addfunc(arg, inc=1):
+        return dict(res=arg + inc)
+
+    for client in clients():
+        s = Stream()
+        sout = s.map(psdm(addfunc, fused=True), inc=2)
+        L = sout.sink_to_list()
+
+        s.emit(submitted(client, StreamDoc(args=[1],
+                                           attributes=dict(name="john"))))
+
+        assert client.gather(L[0]['kwargs'])['res'] == 3
+        assert client.gather(L[0]['args']) == []
+        attributes = client.gather(L[0]['attributes'])
+        assert attributes['function_list'] == ['addfunc']
+
+
+def test_streamdoc_slots():
+    import pickle
+
+    sdoc = StreamDoc(kwargs=dict(a=1), attributes=dict(name="john"))
+    # dict interface
+    assert '_StreamDoc' in sdoc
+    assert 'uid' in sdoc
+    assert sdoc['_StreamDoc_Type'] == 'full'
+    # the uid is only made once asked for, and then stays the same
+    uid = sdoc['uid']
+    assert sdoc['uid'] == uid
+
+    sdoc2 = pickle.loads(pickle.dumps(sdoc))
+    assert sdoc2['kwargs'] == dict(a=1)
+    assert sdoc2['attributes'] == dict(name="john")
+    assert sdoc2['uid'] == uid
+
+
+def test_merge_copy_on_write():
+    for client in clients():
+        sdoc1 = submitted(client, StreamDoc(args=[1], kwargs=dict(a=1),
+                                            attributes=dict(x=1)))
+        sdoc2 = submitted(client, StreamDoc(args=[2], kwargs=dict(a=2, b=3),
+                                            attributes=dict(y=2)))
+        sdoc3 = submitted(client, StreamDoc(kwargs=dict(c=4)))
+
+        # merging a merged streamdoc, then adding to it
+        sdoc = merge((merge((sdoc1, sdoc2)), sdoc3))
+        sdoc.add_attributes(z=3)
+
+        assert client.gather(sdoc['args']) == [1, 2]
+        kwargs = client.gather(sdoc['kwargs'])
+        assert kwargs == dict(a=2, b=3, c=4)
+        assert client.gather(sdoc['attributes']) == dict(x=1, y=2, z=3)
+
+        # the merged streamdocs are left untouched
+        kwargs['a'] = 5
+        assert client.gather(sdoc1['kwargs']) == dict(a=1)
+        assert client.gather(sdoc1['attributes']) == dict(x=1)
+        assert client.gather(sdoc2['kwargs']) == dict(a=2, b=3)
+
+
+def test_select_projection():
+    from SciStreams.core.StreamDoc import compile_mapping, \
+        compose_projections, EMPTY_PROJECTION
+
+    projection = compile_mapping(1, ('a', 'c'), 'b')
+    assert compile_mapping(projection) is projection
+
+    for client in clients():
+        sdoc = submitted(client, StreamDoc(args=[1, 2], kwargs=dict(a=3, b=4)))
+        # a select of a select
+        sdoc2 = sdoc.select(projection).select(('c', None), 'b')
+        assert client.gather(sdoc2['args']) == [3]
+        assert client.gather(sdoc2['kwargs']) == dict(b=4)
+
+        # a missing key in the first select blanks the result, even if the
+        # second select drops it
+        sdoc4 = sdoc.select(('a', 'x'), ('d', 'y')).select('x')
+        assert client.gather(sdoc4['args']) == []
+        assert client.gather(sdoc4['kwargs']) == dict()
+
+        # missing keys give blank args and kwargs
+        sdoc3 = sdoc.select('d')
+        assert client.gather(sdoc3['args']) == []
+        assert client.gather(sdoc3['kwargs']) == dict()
+
+    composed = compose_projections(projection,
+                                   compile_mapping(0, ('c', None), 'b'))
+    assert composed == compile_mapping(1, ('a', None), 'b')
+    # selecting what the first select dropped gives nothing
+    assert compose_projections(projection,
+                               compile_mapping(0, 'a', 'b', 'c')) == \
+        EMPTY_PROJECTION
+    # selects that drop part of the first aren't composed
+    assert compose_projections(projection,
+                               compile_mapping(('c', None), 'b')) is None
+
+
+def test_squash_unsquash():
+    import numpy as np
+    from SciStreams.core.StreamDoc import squash, unsquash
+
+    mask = np.ones((4, 4), dtype=bool)
+    sdocs = [StreamDoc(kwargs=dict(image=np.full((4, 4), i, dtype=np.int32),
+                                   mask=mask, name="img{}".format(i)),
+                       attributes=dict(seq_num=i))
+             for i in range(3)]
+
+    sdoc = squash(sdocs)
+    image = sdoc['kwargs']['image']
+    assert image.shape == (3, 4, 4)
+    assert image.dtype == np.int32
+    # the same array is broadcast, not copied
+    assert sdoc['kwargs']['mask'].strides[0] == 0
+    assert sdoc['kwargs']['name'] == ["img0", "img1", "img2"]
+
+    sdoc.add_attributes(stream_name="batch")
+    sdocs2 = unsquash(sdoc)
+    assert len(sdocs2) == 3
+    for i, sdoc2 in enumerate(sdocs2):
+        assert sdoc2['attributes']['seq_num'] == i
+        assert sdoc2['attributes']['stream_name'] == "batch"
+        assert sdoc2['kwargs']['name'] == "img{}".format(i)
+        # views of the batch
+        assert np.shares_memory(sdoc2['kwargs']['image'], image)
+
+
+def test_to_event_stream_bundle():
+    from SciStreams.core.StreamDoc import to_event_stream
+
+    sdoc = StreamDoc(kwargs=dict(a=1), attributes=dict(seq_num=3))
+    names = [name for name, doctuple in to_event_stream(sdoc, tolist=True)]
+    assert names == ['start', 'descriptor', 'event', 'stop']
+
+    event_stream = to_event_stream(sdoc, tolist=True, bundle=True)
+    assert len(event_stream) == 1
+    name, (parent_uid, start_uid, documents) = event_stream[0]
+    assert name == 'bundle'
+    assert documents['start']['uid'] == start_uid
+    assert documents['event']['data'] == dict(a=1)
+    assert documents['event']['seq_num'] == 3
+
+
+def test_to_event_stream_remote():
+    ''' Remote documents are made in one task, and gathered once unless
+        bundled.'''
+    from SciStreams.core.StreamDoc import to_event_stream
+
+    with pool_client() as client:
+        submit = client.submit
+        tasks = []
+
+        def counting_submit(func, *args, **kwargs):
+            tasks.append(func.__name__)
+            return submit(func, *args, **kwargs)
+        client.submit = counting_submit
+
+        sdoc = StreamDoc(attributes=dict(seq_num=3))
+        sdoc['kwargs'] = submit(dict, a=1)
+        event_stream = to_event_stream(sdoc, tolist=True)
+        assert tasks == ['_make_documents']
+        names = [name for name, doctuple in event_stream]
+        assert names == ['start', 'descriptor', 'event', 'stop']
+        event = event_stream[2][1][2]
+        assert event['data'] == dict(a=1)
+
+        name, (parent_uid, start_uid, documents) = \
+            to_event_stream(sdoc, tolist=True, bundle=True)[0]
+        assert tasks == ['_make_documents']*2
+        assert documents.result()['event']['seq_num'] == 3
+
+
+def test_batch_stage_flag():
+    ''' Stages that accept batches are told when they're given one, a 3d
+    image alone isn't a batch.'''
+    import numpy as np
+    from SciStreams.core.StreamDoc import squash
+    from SciStreams.core.batch import accepts_batches
+
+    @accepts_batches
+    def shape(image, batch=False):
+        return dict(batch=batch, ndim=image.ndim)
+
+    sdoc = StreamDoc(kwargs=dict(image=np.zeros((3, 4, 4))))
+    batch = squash([sdoc, sdoc])
+    for fused in (False, True):
+        stage = psdm(shape, fused=fused)
+        assert stage(sdoc)['kwargs'] == dict(batch=False, ndim=3)
+        assert stage(batch)['kwargs'] == dict(batch=True, ndim=4)
@@ -0,0 +1,49 @@
+import time
+
+from streamz import Stream
+import SciStreams.core.scistreams as scs
+from SciStreams.core.StreamDoc import StreamDoc
+from SciStreams.core.asynchronous import map_async, run_in_loop
+
+
+def test_map_async():
+    ''' Local stages on the event loop should overlap but keep the order of
+    the results.'''
+    def slow_inc(image):
+        # the first is the slowest
+        time.sleep(.1/(image + 1))
+        return dict(image=image + 1)
+
+    s = Stream()
+    sout = scs.map(slow_inc, s, remote=False, asynchronous=True)
+    L = sout.sink_to_list()
+
+    t0 = time.time()
+    for i in range(4):
+        run_in_loop(s.emit, StreamDoc(kwargs=dict(image=i)))
+    while len(L) < 4 and time.time() - t0 < 5:
+        time.sleep(.01)
+    # sleeps of .1, .05, .033 and .025 s run at the same time
+    assert time.time() - t0 < .2
+
+    assert [sdoc['kwargs']['image'] for sdoc in L] == [1, 2, 3, 4]
+
+
+def test_run_in_loop_error():
+    ''' An error downstream on the event loop should end up on the Future
+    run_in_loop returned.'''
+    def fail(sdoc):
+        raise ValueError("bad image {}".format(sdoc['kwargs']['image']))
+
+    s = Stream()
+    # streamz only holds on to the downstreams weakly
+    sout = map_async(s, fail)
+    assert sout.upstreams == [s]
+
+    future = run_in_loop(s.emit, StreamDoc(kwargs=dict(image=1)))
+    try:
+        future.result(timeout=5)
+    except ValueError as e:
+        assert "bad image 1" in str(e)
+    else:
+        assert False, "the error was lost"
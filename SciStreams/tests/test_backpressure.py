@@ -0,0 +1,82 @@
+from concurrent.futures import Future
+import threading
+import time
+
+from streamz import Stream
+import SciStreams.core.scistreams as scs
+from SciStreams.core.StreamDoc import StreamDoc
+from SciStreams.core.backpressure import Backpressure
+
+
+def test_backpressure():
+    ''' Tracking blocks at the cap and is released when a result is done.'''
+    bp = Backpressure(2)
+    futures = [Future() for i in range(3)]
+    bp.track(futures[0])
+    # a StreamDoc holds its slot until all its Futures are done
+    bp.track(StreamDoc(args=[futures[1]], kwargs=dict(a=futures[2])))
+    # no Futures, no slot
+    bp.track(StreamDoc(kwargs=dict(a=1)))
+    assert bp.in_flight == 2
+    assert not bp.wait(timeout=.01)
+
+    tracked = threading.Event()
+
+    def producer():
+        bp.track(Future())
+        tracked.set()
+
+    thread = threading.Thread(target=producer)
+    thread.start()
+    futures[1].set_result(1)
+    assert not tracked.wait(timeout=.05)
+    futures[2].set_result(2)
+    assert tracked.wait(timeout=1)
+    thread.join()
+    assert bp.in_flight == 2
+
+    futures[0].set_result(0)
+    assert bp.in_flight == 1
+    assert bp.wait(timeout=.01)
+
+
+def test_max_in_flight():
+    ''' A stage with max_in_flight blocks the producer while that many of
+    its results are computing.'''
+    futures = [Future() for i in range(4)]
+
+    def compute(image):
+        return dict(image=futures[image])
+
+    s = Stream()
+    sout = scs.map(compute, s, remote=False, asynchronous=False,
+                   max_in_flight=2)
+    L = sout.sink_to_list()
+
+    def wait_for(n):
+        t0 = time.time()
+        while len(L) < n and time.time() - t0 < 5:
+            time.sleep(.01)
+        # give the producer a chance to go past the cap
+        time.sleep(.05)
+
+    def producer():
+        for i in range(4):
+            s.emit(StreamDoc(kwargs=dict(image=i)))
+
+    thread = threading.Thread(target=producer)
+    thread.start()
+    wait_for(2)
+    assert len(L) == 2
+    assert sout.backpressure.in_flight == 2
+
+    futures[0].set_result(0)
+    wait_for(3)
+    assert len(L) == 3
+    assert sout.backpressure.in_flight == 2
+
+    for i, future in enumerate(futures[1:]):
+        future.set_result(i + 1)
+    thread.join(timeout=1)
+    assert len(L) == 4
+    assert sout.backpressure.in_flight == 0
@@ -0,0 +1,45 @@
+import numpy as np
+
+from SciStreams.core.cache import DiskCache, LRUCache, nbytes
+from SciStreams.core.instrumentation import instrument
+
+
+def test_lru_cache():
+    ''' Least recently used entries are evicted to stay under the budget.'''
+    lru = LRUCache(3000, name="test")
+    arrs = [np.zeros(100) for i in range(4)]
+    assert nbytes(arrs[0]) == 800
+    for i in range(3):
+        lru.put(i, arrs[i])
+    # 0 is now more recently used than 1
+    assert lru.get(0) is arrs[0]
+    lru.put(3, arrs[3])
+    assert 1 not in lru
+    assert lru.get(1) is None
+    assert lru.get(2) is arrs[2]
+    # larger than the budget, not cached
+    lru.put(4, np.zeros(1000))
+    assert 4 not in lru
+
+    assert lru.stats() == dict(hits=2, misses=1, evictions=1, entries=3,
+                               bytes=2400)
+
+
+def test_disk_cache(tmpdir):
+    ''' Arrays are kept in files, unreadable ones are counted as errors and
+        missed.'''
+    store = DiskCache(str(tmpdir))
+    store.put(('r', 1), np.arange(4))
+    assert np.array_equal(store.get(('r', 1)), np.arange(4))
+    assert store.get(('r', 2)) is None
+
+    with open(store.filename(('r', 2)), "w") as f:
+        f.write("not an array")
+    enabled = instrument.enabled
+    instrument.enable()
+    try:
+        errors = instrument.counters['disk_cache']['read_error']
+        assert store.get(('r', 2)) is None
+    finally:
+        instrument.enabled = enabled
+    assert instrument.counters['disk_cache']['read_error'] == errors + 1
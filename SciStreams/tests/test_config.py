@@ -0,0 +1,20 @@
+from SciStreams import config
+
+
+def test_init(tmpdir):
+    ''' init should load the given files and set the client.'''
+    filename = str(tmpdir.join("scistreams.yml"))
+    with open(filename, "w") as f:
+        f.write("debug: True\nresultsroot: ['/GPFS', '/tmp']\n")
+
+    client = config.LocalClient()
+    config.init(config_path=filename,
+                masks_path=str(tmpdir.join("masks.yml")), client=client)
+
+    assert config.debug is True
+    assert config.resultsrootmap == ['/GPFS', '/tmp']
+    assert config.resultsroot is None
+    assert config.masks_config == {}
+    assert config.get_client() is client
+    # the client imported before init is a proxy to the new client
+    assert config.client.submit(lambda x: x + 1, 1) == 2
@@ -0,0 +1,53 @@
+from collections import namedtuple
+import time
+
+import pytest
+
+from SciStreams.interfaces.databroker.cursor import IngestCursor, \
+    AdaptivePoll, new_headers, parse_time
+
+
+Header = namedtuple('Header', ['start'])
+
+
+def test_ingest_cursor(tmpdir):
+    ''' Runs are ingested once, in order, and a new cursor resumes.'''
+    hdrs = [Header(dict(time=t, uid=uid))
+            for t, uid in [(20., 'b'), (10., 'a'), (20., 'a'), (30., 'c')]]
+
+    def db(start_time=None, stop_time=None):
+        # queries are to the second, so the boundary runs come back
+        return hdrs
+
+    filename = str(tmpdir.join("cursor.json"))
+    cursor = IngestCursor(filename)
+    cursor.reset(15.)
+    new = new_headers(db, cursor)
+    assert [hdr.start['uid'] for hdr in new] == ['a', 'b', 'c']
+    for hdr in new[:2]:
+        cursor.advance(hdr)
+
+    # a restart resumes after (20, 'b')
+    cursor = IngestCursor(filename)
+    assert cursor.position == (20., 'b')
+    assert [hdr.start['uid'] for hdr in new_headers(db, cursor)] == ['c']
+
+    poll = AdaptivePoll(1, 8)
+    assert [poll.next(0) for i in range(4)] == [2, 4, 8, 8]
+    assert poll.next(3) == 1
+
+
+def test_parse_time(tmpdir):
+    ''' Local time strings are parsed, a cleared cursor takes every run.'''
+    assert parse_time("2017-11-05 14:00") == \
+        time.mktime((2017, 11, 5, 14, 0, 0, 0, 0, -1))
+    assert parse_time("2017-11-05") == parse_time("2017-11-05 00:00:00")
+    with pytest.raises(ValueError):
+        parse_time("yesterday")
+
+    filename = str(tmpdir.join("cursor.json"))
+    cursor = IngestCursor(filename)
+    cursor.reset(15.)
+    cursor.reset()
+    assert cursor.is_new(Header(dict(time=10., uid='a')))
+    assert IngestCursor(filename).position is None
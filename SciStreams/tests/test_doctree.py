@@ -0,0 +1,21 @@
+from SciStreams.callbacks.doctree import DocumentTree
+
+
+def test_document_tree():
+    ''' A run is removed once every holder released it.'''
+    tree = DocumentTree()
+    # two callbacks get the same run
+    for i in range(2):
+        tree.add(None, 'start', dict(uid='start'))
+        tree.add('start', 'desc', dict(uid='desc', run_start='start'))
+    tree.add(None, 'other', dict(uid='other'))
+
+    assert tree['desc'] == ('start', dict(uid='desc', run_start='start'))
+    assert tree.children('start') == {'desc'}
+
+    assert tree.release('start')
+    assert 'desc' in tree
+    assert tree.release('start')
+    assert 'start' not in tree and 'desc' not in tree
+    assert not tree.release('start')
+    assert len(tree) == 1
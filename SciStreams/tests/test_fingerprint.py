@@ -0,0 +1,47 @@
+import pickle
+
+import numpy as np
+
+from SciStreams.core.StreamDoc import StreamDoc
+from SciStreams.core.batch import stack
+from SciStreams.core.fingerprint import fingerprint, task_key, keyed
+
+
+def test_task_key():
+    # unfilled data (datum_ids) is cheap to key, and keys are deterministic
+    sdoc = StreamDoc(kwargs=dict(image='datum-1234'))
+    assert task_key(len, sdoc, bins=10) == task_key(len, sdoc, bins=10)
+    assert task_key(len, sdoc, bins=10) != task_key(len, sdoc, bins=11)
+    assert task_key(len, sdoc).startswith("len-")
+
+
+def test_fingerprint_large_data():
+    # large arrays are never hashed
+    img = np.ones((1000, 1000))
+    assert fingerprint(img) is None
+    # so a task on them gets a unique key
+    assert task_key("f", img) != task_key("f", img)
+
+    # a StreamDoc falls back to its uid (the event uid)
+    sdoc = StreamDoc(kwargs=dict(image=img))
+    sdoc['uid'] = "event-uid"
+    assert fingerprint(sdoc) == ('StreamDoc', ('uid', 'event-uid'))
+
+
+def test_fingerprint_dict_keys():
+    # keys of different types don't collide
+    assert fingerprint({1: 'a'}) != fingerprint({'1': 'a'})
+    assert fingerprint({1: 'a', 'b': 2}) == fingerprint({'b': 2, 1: 'a'})
+
+
+def test_keyed_array():
+    # a KeyedArray is fingerprinted by its key, not its data
+    mask = keyed(np.ones((1000, 1000)), ('mask', 'mask.h5', 1.))
+    assert fingerprint(mask) == fingerprint(pickle.loads(pickle.dumps(mask)))
+    # the frames of a batch of it too
+    batch = stack([mask, mask, mask])
+    assert fingerprint(batch[1]) == fingerprint(mask)
+    # not what's computed from it, or parts of it
+    assert fingerprint(mask*2) is None
+    assert fingerprint(mask[0]) is None
+    assert fingerprint(mask.T) != fingerprint(mask)
@@ -0,0 +1,102 @@
+from streamz import Stream
+import SciStreams.core.scistreams as scs
+from SciStreams.core.StreamDoc import StreamDoc
+from SciStreams.core.fusion import fuse_chains
+
+
+def test_fuse_chains():
+    ''' A linear chain of maps and selects should become one node and give
+    the same result.'''
+    def inc(image):
+        return dict(image=image + 1)
+
+    def double(image):
+        return dict(image=image * 2)
+
+    s = Stream()
+    sout = scs.add_attributes(s, stream_name="test")
+    sout = scs.map(inc, sout)
+    sout = scs.map(double, sout)
+    sout = scs.select(sout, ('image', 'result'))
+    L = sout.sink_to_list()
+
+    fused = fuse_chains(s)
+    assert fused == [['add_attributes', 'inc', 'double', 'select']]
+    # the chain is now one node
+    assert len(s.downstreams) == 1
+    assert list(s.downstreams)[0] is sout
+
+    s.emit(StreamDoc(kwargs=dict(image=1)))
+
+    assert L[0]['kwargs'] == dict(result=4)
+    assert L[0]['attributes']['stream_name'] == "test"
+    assert L[0]['attributes']['function_list'] == ['inc', 'double']
+
+
+def test_fuse_chains_branch():
+    ''' Nodes with more than one downstream end a chain.'''
+    def inc(image):
+        return dict(image=image + 1)
+
+    s = Stream()
+    s1 = scs.map(inc, s)
+    s2 = scs.map(inc, s1)
+    s3 = scs.map(inc, s1)
+    L2 = s2.sink_to_list()
+    L3 = s3.sink_to_list()
+
+    assert fuse_chains(s) == []
+
+    s.emit(StreamDoc(kwargs=dict(image=1)))
+    assert L2[0]['kwargs']['image'] == 3
+    assert L3[0]['kwargs']['image'] == 3
+
+
+def test_fuse_chains_upstreams():
+    ''' The head of a chain with more than one upstream gets the data of all
+    of them once fused.'''
+    def inc(image):
+        return dict(image=image + 1)
+
+    s1 = Stream()
+    s2 = Stream()
+    head = scs.map(inc, s1)
+    s2.connect(head)
+    sout = scs.map(inc, head)
+    L = sout.sink_to_list()
+
+    assert fuse_chains(s1, s2) == [['inc', 'inc']]
+
+    s1.emit(StreamDoc(kwargs=dict(image=1)))
+    s2.emit(StreamDoc(kwargs=dict(image=10)))
+    assert [sdoc['kwargs']['image'] for sdoc in L] == [3, 12]
+
+
+def test_fuse_chains_batch():
+    ''' The stages of a fused chain that accept batches are told when they
+    run on one, up to the first that doesn't.'''
+    import numpy as np
+    from SciStreams.core.StreamDoc import squash
+    from SciStreams.core.batch import accepts_batches
+
+    @accepts_batches
+    def inc(image, batch=False):
+        return dict(image=image + 1, batch=batch)
+
+    def count(image, batch):
+        return dict(batches=[batch])
+
+    @accepts_batches
+    def last(batches, batch=False):
+        return dict(batches=batches + [batch])
+
+    s = Stream()
+    sout = scs.map(inc, s)
+    sout = scs.map(count, sout)
+    sout = scs.map(last, sout)
+    L = sout.sink_to_list()
+    assert fuse_chains(s) == [['inc', 'count', 'last']]
+
+    sdoc = StreamDoc(kwargs=dict(image=np.zeros(4)))
+    s.emit(squash([sdoc, sdoc]))
+    assert L[0]['kwargs']['batches'] == [True, False]
@@ -0,0 +1,37 @@
+from SciStreams.core.instrumentation import Instrumentation
+
+
+def test_instrumentation_disabled():
+    ''' Nothing should be recorded when disabled.'''
+    instr = Instrumentation()
+    instr.count('foo', 'calls')
+    instr.timing('foo', 'runtime', .1)
+    instr.log('foo', 'hello')
+    instr.record('foo', dict(runtime=.1, status="Success"))
+    assert instr.summary() == {}
+    assert instr.events() == []
+
+
+def test_instrumentation_record():
+    instr = Instrumentation(enabled=True)
+    instr.record('foo', dict(runtime=.1, runstart=0., status="Success"))
+    instr.record('foo', dict(runtime=.3, runstart=0., status="Failure",
+                             error_message="bad"))
+    instr.count('bar', 'mask_generated')
+
+    stats = instr.stage_stats('foo')
+    assert stats['counters'] == dict(calls=2, Success=1, Failure=1)
+    runtime = stats['timings']['runtime']
+    assert runtime['num'] == 2
+    assert abs(runtime['mean'] - .2) < 1e-12
+    assert runtime['min'] == .1
+    assert runtime['max'] == .3
+    assert sum(runtime['counts'].values()) == 2
+
+    assert instr.stages() == ['bar', 'foo']
+    events = instr.events('foo')
+    assert len(events) == 1
+    assert events[0]['info']['error_message'] == "bad"
+
+    instr.reset()
+    assert instr.summary() == {}
@@ -0,0 +1,37 @@
+import time
+
+from distributed import Future
+
+from SciStreams.core.local_client import PoolClient
+
+
+def test_pool_client():
+    ''' Tasks run on the pool, after the Futures they're given.'''
+    client = PoolClient('threads', 4)
+
+    def slow_inc(x):
+        time.sleep(.1)
+        return x + 1
+
+    t0 = time.time()
+    futures = [client.submit(slow_inc, i) for i in range(4)]
+    # Futures are replaced by their results, also in lists and dicts
+    total = client.submit(lambda args, kwargs: sum(args) + kwargs['a'],
+                          futures, dict(a=futures[0]))
+    assert isinstance(total, Future)
+    assert total.result() == 10 + 1
+    # they ran at the same time
+    assert time.time() - t0 < .3
+    assert client.gather(futures) == [1, 2, 3, 4]
+    assert total.status == 'finished' and total.done()
+
+    # the same key is the same task
+    assert client.submit(slow_inc, 1, key='inc-1') is \
+        client.submit(slow_inc, 1, key='inc-1')
+
+    # errors are passed on to the dependent tasks
+    error = client.submit(slow_inc, None)
+    dependent = client.submit(slow_inc, error)
+    assert isinstance(dependent.exception(), TypeError)
+    assert dependent.status == 'error'
+    client.close()
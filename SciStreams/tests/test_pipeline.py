@@ -0,0 +1,53 @@
+from streamz import Stream
+from SciStreams.core.StreamDoc import StreamDoc
+from SciStreams.core.pipeline import Pipeline, mapping, streams
+import SciStreams.core.scistreams as scs
+
+
+def test_pipeline():
+    ''' Only the stages an enabled sink needs should be built.'''
+    built = list()
+
+    def inc(image):
+        return dict(image=image + 1)
+
+    def double(image):
+        return dict(image=image * 2)
+
+    def IncStream():
+        built.append('IncStream')
+        sin = Stream()
+        sout = scs.map(inc, sin)
+        return sin, sout
+
+    results = dict()
+
+    def to_list(stream, name):
+        results[name] = stream.sink_to_list()
+
+    spec = dict(stages=dict(inc=dict(factory='IncStream', inputs=['input']),
+                            double=dict(factory='double', inputs=['inc']),
+                            unused=dict(factory='IncStream',
+                                        inputs=['double']),
+                            image=dict(factory='select', inputs=['double'],
+                                       kwargs=dict(mapping=[['image',
+                                                             'result']]))),
+                sinks=dict(result=dict(factory='list', input='image',
+                                       kwargs=dict(name='result')),
+                           unused=dict(factory='list', input='unused',
+                                       kwargs=dict(name='unused'),
+                                       enabled=False)))
+    pipeline = Pipeline(spec, factories=dict(IncStream=streams(IncStream),
+                                             double=mapping(double)),
+                        sinks=dict(list=to_list))
+
+    assert pipeline.needed() == ['inc', 'double', 'image']
+
+    s = Stream()
+    nodes = pipeline.build(s)
+    assert 'unused' not in nodes
+    assert built == ['IncStream']
+
+    s.emit(StreamDoc(kwargs=dict(image=1)))
+    assert results['result'][0]['kwargs'] == dict(result=4)
+    assert 'unused' not in results
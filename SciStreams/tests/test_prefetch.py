@@ -0,0 +1,38 @@
+import threading
+import time
+
+from SciStreams.interfaces.databroker.prefetch import prefetch_documents
+
+
+class Header:
+    def __init__(self, uid, fail=False):
+        self.uid = uid
+        self.fail = fail
+        self.read = threading.Event()
+
+    def documents(self, fill=False):
+        self.read.set()
+        yield 'start', dict(uid=self.uid)
+        time.sleep(.05)
+        if self.fail:
+            raise FileNotFoundError("missing file")
+        yield 'event', dict(uid=self.uid + '-event')
+        yield 'stop', dict(uid=self.uid + '-stop', run_start=self.uid)
+
+
+def test_prefetch_documents():
+    ''' The next runs are read ahead, a run that fails ends with a stop.'''
+    hdrs = [Header('a'), Header('b', fail=True), Header('c')]
+    docs = prefetch_documents(hdrs, depth=2)
+
+    hdr, documents = next(docs)
+    assert hdr is hdrs[0]
+    assert [name for name, doc in documents] == ['start', 'event', 'stop']
+    # b was read while a was handed over
+    assert hdrs[1].read.wait(timeout=1)
+
+    hdr, documents = next(docs)
+    assert [name for name, doc in documents] == ['start', 'stop']
+    assert documents[-1][1]['run_start'] == 'b'
+
+    assert [hdr.uid for hdr, documents in docs] == ['c']
@@ -0,0 +1,75 @@
+import time
+
+import numpy as np
+
+from SciStreams.core.instrumentation import instrument
+from SciStreams.core.local_client import LocalFuture
+from SciStreams.core.registry import FutureRegistry
+
+
+def _future(key, result=None):
+    future = LocalFuture(key)
+    if result is not None:
+        future._future.set_result(result)
+    return future
+
+
+def test_registry():
+    ''' Results are released when done, held ones when their run stops or
+        when too many are held.'''
+    registry = FutureRegistry(ttl=None, max_held=2)
+    pending = _future("sink")
+    registry.track(pending, run="run1", stage="circavg")
+    assert len(registry) == 1
+    pending._future.set_result(None)
+    assert len(registry) == 0 and registry.wait(timeout=0)
+
+    held = [_future("calib{}".format(i), np.zeros(100)) for i in range(3)]
+    registry.track(held[0], run="run1", stage="calibration", hold=True)
+    registry.track(held[1:], run="run2", stage="calibration", hold=True)
+    # the oldest went first
+    stats = registry.stats()
+    assert stats['held'] == 2 and stats['total'] == 4
+    assert stats['bytes'] == 1600
+    registry.release_run("run2")
+    assert registry.stats()['held'] == 0
+
+
+def test_registry_expire():
+    ''' Held results expire after ttl, without another track.'''
+    registry = FutureRegistry(ttl=.05, max_held=None)
+    registry.track(_future("calib", np.zeros(10)), run="run1",
+                   stage="calibration", hold=True)
+    assert registry.stats()['held'] == 1
+    time.sleep(.1)
+    assert registry.stats()['held'] == 0
+
+
+def test_registry_errors():
+    ''' Failed results go to the error queue, completions are counted.'''
+    registry = FutureRegistry()
+    futures = [_future("ok{}".format(i)) for i in range(3)] + \
+        [_future("failed")]
+    registry.track(futures, run="run1", stage="circavg", sink="store")
+    enabled = instrument.enabled
+    instrument.enable()
+    try:
+        for future in futures[:3]:
+            future._future.set_result(None)
+        try:
+            raise ValueError("bad image")
+        except ValueError as e:
+            futures[3]._future.set_exception(e)
+    finally:
+        instrument.enabled = enabled
+    # the error is logged, not printed
+    entry = instrument.eventlog[-1]
+    assert entry['stage'] == "circavg" and entry['message'] == "error"
+    assert entry['info']['key'] == "failed"
+
+    assert len(registry) == 0
+    failed = registry.errors.popleft()
+    assert failed.key == "failed" and failed.owner.stage == "circavg"
+    assert isinstance(failed.exception, ValueError)
+    assert "test_registry_errors" in failed.traceback
+    assert registry.stats()['throughput'] == 4/60.
@@ -1,8 +1,7 @@
 import os
 
 from .. import config
-_ROOTDIR = config.resultsroot
-_ROOTMAP = config.resultsrootmap
+from ..core.instrumentation import instrument
 
 
 def make_dir(directory):
@@ -63,10 +62,11 @@ def _make_fname_from_attrs(attrs, filetype="xml", strict=False,
     # remove the trailing slash
     rootdir = experiment_alias_directory.strip("/")
 
-    if _ROOTMAP is not None:
-        rootdir = rootdir.replace(_ROOTMAP[0], _ROOTMAP[1])
-    elif _ROOTDIR is not None:
-        rootdir = _ROOTDIR
+    if config.resultsrootmap is not None:
+        rootmap = config.resultsrootmap
+        rootdir = rootdir.replace(rootmap[0], rootmap[1])
+    elif config.resultsroot is not None:
+        rootdir = config.resultsroot
 
     detector_name = check_and_get(attrs, 'detector_name', strict=strict,
                                   default="unnamed")
@@ -86,7 +86,8 @@ def _make_fname_from_attrs(attrs, filetype="xml", strict=False,
 
     seq_num = check_and_get(attrs, 'seq_num', strict=strict, default=0)
     seq_num = str(seq_num)
-    print("Got sequence number : {}\n\n".format(seq_num))
+    instrument.log('_make_fname_from_attrs', "got sequence number",
+                   seq_num=seq_num)
 
     outdir = rootdir + "/" + detector_savedir + "/" + stream_name \
         + "/" + filetype
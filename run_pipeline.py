@@ -1,5 +1,4 @@
 import argparse
-import re
 import time
 import matplotlib
 matplotlib.use("Agg")  # noqa
@@ -8,29 +7,6 @@ from SciStreams.startup import run_stream
 
 VERSION = "0.2"
 
-re_time_pairs = [
-    (re.compile("^[0-9]{4}-[0-9]{2}-[0-9]{2}$"), "%Y-%m-%d"),
-    (re.compile("^[0-9]{4}-[0-9]{2}-[0-9]{2} [0-9]{2}$"), "%Y-%m-%d %H"),
-    (re.compile("^[0-9]{4}-[0-9]{2}-[0-9]{2}" +
-                "[0-9]{2}:[0-9]{2}$"), "%Y-%m-%d %H:%M"),
-    (re.compile("^[0-9]{4}-[0-9]{2}-[0-9]{2}" +
-                "[0-9]{2}:[0-9]{2}:[0-9]{2}$"), "%Y-%m-%d %H:%M:%S"),
-]
-
-
-def check_time(strtime):
-    for rexp, strform in re_time_pairs:
-        if rexp.match(strtime):
-            tstruct = time.strptime(strtime, strform)
-            return time.mktime(tstruct)
-    errormsg = "Error, time not understood\n"
-    errormsg += "Formats accepted: \n"
-
-    for r, t in re_time_pairs:
-        errormsg += "{}\n".format(t)
-
-    raise ValueError(errormsg)
-
 
 if __name__ == '__main__':
     print("CMS pipeline, version {}".format(VERSION))
@@ -50,13 +26,9 @@ if __name__ == '__main__':
         time.sleep(3600)
     else:
         # help="The start time for the pipeline " +
-        # "(default is 24 hrs prior to now)")
-        if args.start_time is not None:
-            # will raise a ValueError
-            start_time = args.start_time
-        else:
-            # 1 day earlier
-            start_time = time.time()-24*3600
+        # "(default is to resume from the ingest cursor)")
+        # None resumes from where the last run left off
+        start_time = args.start_time
         stop_time = args.stop_time
 
         print("Searching for results from {} to {}".format(start_time, stop_time))